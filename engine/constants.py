@@ -34,6 +34,9 @@ if ENGINE_MODE == 'mi' and PROMPT_MODE != 'calc':
 
 ONLY_RENDER_ROOT = True
 
+# wall-clock seconds for rendering a task (split across trials) or, within a trial, across views; 0 for unlimited
+RENDER_BUDGET: float = float(os.environ.get('RENDER_BUDGET', 0))
+
 if 'DRY_RUN' in os.environ:
     DRY_RUN = bool(os.environ['DRY_RUN'])
 else:
@@ -41,10 +44,15 @@ else:
 print(f'DRY_RUN={DRY_RUN}')
 
 # LLM configs
-LLM_PROVIDER: Literal['gpt', 'claude', 'llama', 'gemini'] = ''
+# 'replay' serves recorded responses, see `engine/utils/replay_client.py`
+LLM_PROVIDER: Literal['gpt', 'claude', 'llama', 'gemini', 'replay'] = os.environ.get('LLM_PROVIDER', '')
 TEMPERATURE: float = 0.05
 NUM_COMPLETIONS: int = 1
 MAX_TOKENS: int = 4000
+# execute each program as soon as its code block is streamed, instead of after all completions
+STREAM_PROGRAMS: bool = os.environ.get('STREAM_PROGRAMS', '0') == '1'
+# renderings shown to the critic, tiled into one image; more views cost more vision tokens
+CRITIC_VIEWS: int = int(os.environ.get('CRITIC_VIEWS', 1))
 
 assert 0 <= TEMPERATURE <= 1, TEMPERATURE
 if NUM_COMPLETIONS > 1:
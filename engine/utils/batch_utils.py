@@ -0,0 +1,19 @@
+import os
+import time
+from typing import Callable, TypeVar
+
+T = TypeVar('T')
+
+# seconds between status requests of a submitted batch; provider batches take minutes to hours
+BATCH_POLL_INTERVAL: float = float(os.environ.get('BATCH_POLL_INTERVAL', 30))
+
+
+def poll_batch(retrieve: Callable[[], T], is_done: Callable[[T], bool], describe: Callable[[T], str],
+               interval: float = BATCH_POLL_INTERVAL) -> T:
+    # retrieves the batch status until `is_done`
+    start = time.time()
+    while not is_done(batch := retrieve()):
+        print(f'[INFO] batch {describe(batch)}, {time.time() - start:.0f}s elapsed')
+        time.sleep(interval)
+    print(f'[INFO] batch {describe(batch)}, done after {time.time() - start:.0f}s')
+    return batch
@@ -0,0 +1,80 @@
+import time
+from typing import Callable
+import numpy as np
+
+PILOT_SPP = 4
+MIN_SCALE = .25  # lowest resolution scale when the budget can't even afford the pilot pass
+
+
+def schedule_spp(costs: list[float], remaining: float, max_extra_spp: int) -> list[int]:
+    """
+    Extra samples per view given the measured cost of one sample of each view (seconds).
+    All views are equally important, so samples go to a uniform level first, and leftovers to the cheapest views.
+    """
+    extra = [0] * len(costs)
+    total_cost = sum(costs)
+    if max_extra_spp <= 0 or len(costs) == 0:
+        return extra
+    level = max_extra_spp if total_cost <= 0 else int(min(max_extra_spp, max(remaining, 0) // total_cost))
+    extra = [level] * len(costs)
+    remaining -= level * total_cost
+    for ind in np.argsort(costs):
+        if extra[ind] < max_extra_spp and costs[ind] <= remaining:
+            extra[ind] += 1
+            remaining -= costs[ind]
+    return extra
+
+
+def _upsample(image: np.ndarray, width: int, height: int) -> np.ndarray:
+    # nearest neighbor, to exactly (height, width) even if the scaled resolution was rounded
+    rows = np.arange(height) * image.shape[0] // height
+    cols = np.arange(width) * image.shape[1] // width
+    return image[rows][:, cols]
+
+
+def render_with_budget(render_fn: Callable[[str, int, int, float], np.ndarray], keys: list[str],
+                       sizes: dict[str, tuple[int, int]], budget: float, target_spp: int, pilot_spp: int = PILOT_SPP,
+                       setup_time: Callable[[], float] = lambda: 0.) -> dict[str, np.ndarray]:
+    """
+    `render_fn(key, spp, seed, scale)` renders view `key` at `scale` times its full resolution `sizes[key]`
+    (width, height). `setup_time()` is the time spent so far on one-time work inside `render_fn`, e.g. loading the
+    scene on the first render cache miss; it counts against the budget but not towards the cost of a view.
+    Renders a low-spp pilot pass of every view, measures it, and spends what is left of `budget` (seconds) on more
+    samples, up to `target_spp`. Views whose pilot pass would overrun the budget are rendered at a lower resolution.
+    Returns full-resolution images.
+    """
+    start = time.time()
+    pilot_spp = min(pilot_spp, target_spp)
+    images: dict[str, np.ndarray] = {}
+    scales: dict[str, float] = {}
+    costs: list[float] = []  # seconds per sample at the view's own scale
+    scale = 1.
+    for i, key in enumerate(keys):
+        view_start = time.time()
+        setup_start = setup_time()
+        images[key] = render_fn(key, pilot_spp, 0, scale)
+        scales[key] = scale
+        view_time = time.time() - view_start - (setup_time() - setup_start)
+        costs.append(view_time / pilot_spp)
+
+        # cost scales with the number of pixels
+        full_cost = view_time / scale ** 2
+        remaining = budget - (time.time() - start)
+        num_left = len(keys) - i - 1
+        while scale > MIN_SCALE and num_left * full_cost * scale ** 2 > remaining:
+            scale /= 2
+
+    remaining = budget - (time.time() - start)
+    extra_spp = schedule_spp(costs, remaining, max_extra_spp=target_spp - pilot_spp)
+    for key, spp in zip(keys, extra_spp):
+        if spp == 0:
+            continue
+        image = render_fn(key, spp, 1, scales[key])  # a different seed, so that samples are independent
+        images[key] = (images[key] * pilot_spp + image * spp) / (pilot_spp + spp)
+
+    for key in keys:
+        if scales[key] < 1:
+            images[key] = _upsample(images[key], *sizes[key])
+    print(f'[INFO] render budget {budget:.1f}s, used {time.time() - start:.1f}s, '
+          f'spp={[pilot_spp + spp for spp in extra_spp]}, scale={[scales[key] for key in keys]}')
+    return images
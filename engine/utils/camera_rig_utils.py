@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from typing import Optional, Sequence, Union
+import numpy as np
+import mitsuba as mi
+
+SENSOR_CACHE_SIZE = 1024
+_sensors: OrderedDict[tuple, mi.Sensor] = OrderedDict()  # least recently used evicted first
+
+
+def orbit_cameras(elevation: float, azimuths: Union[Sequence[float], np.ndarray], radius: float = 1,
+                  is_degree: bool = True, target: Optional[np.ndarray] = None) -> np.ndarray:
+    # vectorized `mi_helper.orbit_camera` over all azimuths; returns (n, 3) eyes
+    # elevation in (-90, 90), from +y to -y; azimuth from +z to +x is (0, 90)
+    azimuths = np.asarray(azimuths, dtype=np.float64)
+    if is_degree:
+        elevation = np.deg2rad(elevation)
+        azimuths = np.deg2rad(azimuths)
+    eyes = radius * np.stack([np.cos(elevation) * np.sin(azimuths),
+                              np.full_like(azimuths, -np.sin(elevation)),
+                              np.cos(elevation) * np.cos(azimuths)], axis=-1)
+    if target is None:
+        target = np.zeros([3], dtype=np.float32)
+    return eyes + np.asarray(target)
+
+
+def _sensor_key(eye, target, fov: float, resolution: tuple[int, int], up) -> tuple:
+    return (mi.variant(), *np.round(np.concatenate([np.asarray(eye, dtype=np.float64).ravel(),
+                                                     np.asarray(target, dtype=np.float64).ravel(),
+                                                     np.asarray(up, dtype=np.float64).ravel()]), 6).tolist(),
+            round(float(fov), 6), *resolution)
+
+
+def load_sensor(eye, target, fov: float, resolution: Union[int, tuple[int, int]], up=(0, 1, 0)) -> mi.Sensor:
+    # cached by (eye, target, fov, resolution); sensors are shared, so don't update their parameters in place, and
+    # don't render the same sensor from several threads at once since `mi.render` develops into its film
+    if isinstance(resolution, int):
+        resolution = (resolution, resolution)
+    key = _sensor_key(eye, target, fov, resolution, up)
+    if key not in _sensors:
+        _sensors[key] = mi.load_dict({
+            'type': 'perspective',
+            'to_world': mi.scalar_rgb.Transform4f.look_at(origin=np.asarray(eye), target=np.asarray(target), up=list(up)),
+            'fov': fov,
+            'film': {
+                'type': 'hdrfilm',
+                'width': resolution[0],
+                'height': resolution[1],
+                'pixel_format': 'rgba',
+            }
+        })
+        while len(_sensors) > SENSOR_CACHE_SIZE:
+            _sensors.popitem(last=False)
+    _sensors.move_to_end(key)
+    return _sensors[key]
+
+
+def create_orbit_rig(target: np.ndarray, radius: float, elevation: float, num_frames: int, fov: float) -> dict:
+    # `sensor_info` of `num_frames` cameras evenly spaced in azimuth around `target`
+    azims = np.linspace(0, 360, num_frames, endpoint=False).tolist()
+    eyes = orbit_cameras(elevation, azims, radius=radius, target=target)
+    return {
+        'elev': [elevation] * num_frames,
+        'radius': [radius] * num_frames,
+        'azim': azims,
+        'eyes': list(eyes),
+        'targets': [target] * num_frames,
+        'fov': [fov] * num_frames,
+    }
+
+
+def load_rig_sensors(sensor_info: dict, resolution: Union[int, tuple[int, int]], prefix: str = 'bestview') -> dict[str, mi.Sensor]:
+    # `sensor_info` is the serialization of a rig; the same info gives the same sensor objects while they are cached
+    return {f'{prefix}_{i:02d}': load_sensor(eye, target, fov, resolution)
+            for i, (eye, target, fov) in enumerate(zip(sensor_info['eyes'], sensor_info['targets'], sensor_info['fov']))}
+
+
+def clear_sensor_cache():
+    _sensors.clear()
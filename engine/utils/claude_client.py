@@ -2,33 +2,42 @@ from engine.constants import PROJ_DIR, ANTHROPIC_API_KEY, MAX_TOKENS, TEMPERATUR
 import copy
 from pathlib import Path
 import base64
-import json
 import os
 import time
 import random
 from PIL import Image
 import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import anthropic
+from engine.utils.llm_cache_utils import LLMCache, cache_task
+from engine.utils.batch_utils import poll_batch
+from engine.utils.lm_utils import CodeFenceParser, CODE_FENCE_STOP
+from engine.utils.rate_limit_utils import get_rate_limiter, estimate_tokens
+from engine.utils.prompt_cache_utils import claude_system, claude_content, claude_usage, prompt_cache_stats
+from engine.utils.image_payload_utils import encode_images, group_images, estimate_message_tokens
 
 
 CLAUDE_MODEL_NAME = 'claude-3-5-sonnet-20240620'  # this the model used throughout the paper
 CLAUDE_MODEL_NAME = 'claude-3-5-sonnet-20241022'
+# completions requested concurrently by one `generate` call
+CLAUDE_MAX_IN_FLIGHT: int = int(os.environ.get('CLAUDE_MAX_IN_FLIGHT', 4))
+# stop generating at the closing fence of the code block, i.e. skip the explanation after it
+CLAUDE_STOP_AT_FENCE: bool = os.environ.get('CLAUDE_STOP_AT_FENCE', '0') == '1'
 
 class ClaudeClient:
-    def __init__(self, model_name=CLAUDE_MODEL_NAME, cache="cache.json"):
-        self.cache_file = cache
+    def __init__(self, model_name=CLAUDE_MODEL_NAME, cache="cache.json", max_in_flight=CLAUDE_MAX_IN_FLIGHT,
+                 base_url=None):
         self.model_name = model_name
-        self.exponential_backoff = 1
-        # Load the cache JSON file, if cache file exists. Else, cache is {}
-        if os.path.exists(cache):
-            while os.path.exists(self.cache_file + ".tmp") or os.path.exists(self.cache_file + ".lock"):
-                time.sleep(0.1)
-            with open(cache, "r") as f:
-                self.cache = json.load(f)
-        else:
-            self.cache = {}
+        self.max_in_flight = max_in_flight
+        # shared with the other processes on the account
+        self.rate_limiter = get_rate_limiter('claude')
+        # shared across processes; a JSON cache is migrated on first use
+        self.cache = LLMCache(cache)
+        self.cache_file = self.cache.path
 
-        self.client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        # `base_url` defaults to $ANTHROPIC_BASE_URL, e.g. `engine/utils/mock_llm_server.py`
+        self.client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, base_url=base_url)
 
         # Tip, if you want to extend MAX_TOKENS to 8000, attach default_headers after the api_key arg above.
         # default_headers={
@@ -36,7 +45,9 @@ class ClaudeClient:
          #}
 
     def generate(self, user_prompt, system_prompt, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, stop_sequences=None, verbose=False,
-                 num_completions=NUM_COMPLETIONS, skip_cache_completions=0, skip_cache=False):
+                 num_completions=NUM_COMPLETIONS, skip_cache_completions=0, skip_cache=False, on_code=None):
+        # on_code(index, lines) is called from a worker thread as soon as a streamed completion has closed its code
+        # block; `index` is the position in the returned list. Not called for cached completions.
 
         print(f'[INFO] Claude: querying for {num_completions=}, {skip_cache_completions=}')
         if skip_cache:
@@ -45,89 +56,175 @@ class ClaudeClient:
             print(user_prompt)
             print("-----")
 
+        messages = self.build_messages(user_prompt)
+
+        if CLAUDE_STOP_AT_FENCE and stop_sequences is None:
+            stop_sequences = [CODE_FENCE_STOP]
+
+        cache_key = None
+        results = []
+        if not skip_cache:
+            cache_key, legacy_key = self.cache_key(user_prompt, system_prompt, max_tokens, temperature, stop_sequences)
+
+            num_completions = skip_cache_completions + num_completions
+            cached = self.cache.get(cache_key, legacy_key=legacy_key)
+            if cached is not None:
+                print(f'[INFO] Claude: cache hit {len(cached)}')
+                if len(cached) < num_completions:
+                    num_completions -= len(cached)
+                    results = cached
+                else:
+                    return cache_key, cached[skip_cache_completions:num_completions]
+
+        new_results = []
+        if num_completions > 0:
+            # results are merged in submission order, so that the cache is independent of response timing
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_in_flight, num_completions))) as executor:
+                offset = len(results) - skip_cache_completions
+                futures = [executor.submit(self.complete, messages, system_prompt, max_tokens, temperature, stop_sequences,
+                                           None if on_code is None or offset + i < 0 else partial(on_code, offset + i))
+                           for i in range(num_completions)]
+                for future in futures:
+                    new_results.extend(future.result())
+            print(f'[INFO] Claude prompt cache: {prompt_cache_stats.summary()}')
+            print(f'[INFO] Claude rate limit: {self.rate_limiter.summary()}')
+
+        if not skip_cache:
+            self.cache.append(cache_key, new_results)
+
+        return cache_key, (results + new_results)[skip_cache_completions:]
+
+    def generate_batch(self, prompts, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, stop_sequences=None,
+                       num_completions=NUM_COMPLETIONS, tasks=None, **kwargs):
+        """
+        Completions of many `(user_prompt, system_prompt)` prompts through the Message Batches API, which is cheaper and
+        not subject to the interactive rate limits, for sweeps. Completions missing from the cache are submitted as one
+        batch, and cached under the same keys as `generate`, indexed by `tasks`.
+        """
+        if CLAUDE_STOP_AT_FENCE and stop_sequences is None:
+            stop_sequences = [CODE_FENCE_STOP]
+
+        keys = []
+        results = []
+        requests = []
+        for j, (user_prompt, system_prompt) in enumerate(prompts):
+            cache_key, legacy_key = self.cache_key(user_prompt, system_prompt, max_tokens, temperature, stop_sequences)
+            with cache_task(None if tasks is None else tasks[j]):  # hits are indexed under the task too
+                cached = self.cache.get(cache_key, legacy_key=legacy_key) or []
+            keys.append(cache_key)
+            results.append(cached[:num_completions])
+            if len(cached) >= num_completions:
+                continue
+            params = dict(model=self.model_name, messages=self.build_messages(user_prompt), max_tokens=max_tokens,
+                          temperature=temperature)
+            if system_prompt is not None:
+                params['system'] = claude_system(system_prompt)
+            if stop_sequences is not None:
+                params['stop_sequences'] = stop_sequences
+            requests.extend({'custom_id': f'{j}-{i}', 'params': params} for i in range(len(cached), num_completions))
+        print(f'[INFO] Claude: {len(requests)} of {len(prompts) * num_completions} completions missing from the cache')
+        if len(requests) == 0:
+            return results
+
+        batch = self.client.messages.batches.create(requests=requests)
+        batch = poll_batch(lambda: self.client.messages.batches.retrieve(batch.id),
+                           lambda batch: batch.processing_status == 'ended',
+                           lambda batch: f'{batch.id}: {batch.request_counts}')
+        new_results = {}
+        for entry in self.client.messages.batches.results(batch.id):
+            j, i = map(int, entry.custom_id.split('-'))
+            if entry.result.type != 'succeeded':
+                print(f'[ERROR] Claude: batch request {entry.custom_id} {entry.result.type}')
+                continue
+            message = entry.result.message
+            text = ''.join(block.text for block in message.content)
+            if message.stop_reason == 'stop_sequence' and message.stop_sequence == CODE_FENCE_STOP:
+                text += CODE_FENCE_STOP.rstrip('\n')
+            new_results.setdefault(j, []).append((i, text.split('\n')))
+        for j, completions in sorted(new_results.items()):
+            completions = [lines for _, lines in sorted(completions)]
+            with cache_task(None if tasks is None else tasks[j]):
+                self.cache.append(keys[j], completions)
+            results[j] = results[j] + completions
+        return results
+
+    def build_messages(self, user_prompt):
         # Prepare messages for the API request
         if isinstance(user_prompt, str):
             content = [{"type": "text", "text": user_prompt}]
         elif isinstance(user_prompt, list):
             content = []
-            for content_item in user_prompt:
-                if content_item['type'] == 'image_url' and os.path.exists(content_item['image_url']):
-                    with open(content_item['image_url'], "rb") as f:
-                        image_data = base64.b64encode(f.read()).decode("utf-8")
+            for content_item in group_images(user_prompt):
+                if isinstance(content_item, list):
+                    # downsized, re-encoded, and memoized, see `image_payload_utils`
+                    media_type, image_data = encode_images(content_item, 'claude')
                     content_item = {
                         'type': 'image',
                         "source": {
                             "type": "base64",
-                            "media_type": f'image/{Path(content_item["image_url"]).suffix.removeprefix(".")}',
+                            "media_type": media_type,
                             "data": image_data,
                         },
                     }
                 content.append(content_item)
         else:
             raise RuntimeError(user_prompt)
-        messages = [{"role": "user", "content": content}]
+        return [{"role": "user", "content": claude_content(content)}]
 
-        cache_key = None
-        results = []
-        if not skip_cache:
-            cache_key = str((user_prompt, system_prompt, max_tokens, temperature, stop_sequences, 'claude'))
-
-            num_completions = skip_cache_completions + num_completions
-            if cache_key in self.cache:
-                print(f'[INFO] Claude: cache hit {len(self.cache[cache_key])}')
-                if len(self.cache[cache_key]) < num_completions:
-                    num_completions -= len(self.cache[cache_key])
-                    results = self.cache[cache_key]
-                else:
-                    return cache_key, self.cache[cache_key][skip_cache_completions:num_completions]
-
-        while num_completions > 0:
-            while True:
-                try:
-                    response = self.client.messages.create(
-                        model=self.model_name,
-                        system=system_prompt,
-                        messages=messages,
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                        stop_sequences=stop_sequences
-                    )
-                    break
-                except anthropic.RateLimitError:
-                    print("Rate limit reached. Waiting before retrying...")
-                    time.sleep(16 * self.exponential_backoff)
-                    self.exponential_backoff *= 2
-            num_completions -= 1
+    def cache_key(self, user_prompt, system_prompt, max_tokens, temperature, stop_sequences):
+        # the key, and a function building the key used before `LLMCache.make_key`
+        cache_key = self.cache.make_key(self.model_name, system_prompt, user_prompt, max_tokens=max_tokens,
+                                        temperature=temperature, stop_sequences=stop_sequences)
+        return cache_key, lambda: str((user_prompt, system_prompt, max_tokens, temperature, stop_sequences, 'claude'))
 
-            content = []
-            if response.content:
-                for text_block in response.content:
-                    content.append(text_block.text)
-                print(F'[INFO] Claude usage', response.usage)
+    def complete(self, messages, system_prompt, max_tokens, temperature, stop_sequences, on_code=None):
+        # a single completion, split into lines per text block; streamed to measure the time to first token
+        def stream_response():
+            start = time.time()
+            ttft = None
+            parser = CodeFenceParser()
+            with self.client.messages.stream(
+                model=self.model_name,
+                system=claude_system(system_prompt),
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stop_sequences=stop_sequences
+            ) as stream:
+                for text in stream.text_stream:
+                    if ttft is None:
+                        ttft = time.time() - start
+                    if on_code is not None and (lines := parser.feed(text)) is not None:
+                        on_code(lines)
+                response = stream.get_final_message()
+            if response.stop_reason == 'stop_sequence' and response.stop_sequence == CODE_FENCE_STOP:
+                response.content[-1].text += CODE_FENCE_STOP.rstrip('\n')
+                if on_code is not None and (lines := parser.feed(CODE_FENCE_STOP)) is not None:
+                    on_code(lines)
+            return response, ttft
 
-            indented = []
-            for c in content:
-                indented.append(c.split('\n'))
-            results.extend(indented)
+        # charged for the full `max_tokens` until the usage is known
+        tokens = estimate_tokens(system_prompt or '') + estimate_message_tokens(messages, 'claude') + max_tokens
+        response, ttft = self.rate_limiter.call(
+            stream_response, tokens=tokens, retry_on=(anthropic.RateLimitError,),
+            usage=lambda out: sum(claude_usage(out[0].usage)[1:]) + out[0].usage.output_tokens)
+        cache_read, cache_write, uncached = claude_usage(response.usage)
 
-        if not skip_cache:
-            self.update_cache(cache_key, results)
+        content = []
+        if response.content:
+            for text_block in response.content:
+                content.append(text_block.text)
+            print(F'[INFO] Claude usage', response.usage)
+        print(f'[INFO] Claude prompt cache: {prompt_cache_stats.record(cache_read, cache_write, uncached, ttft)}')
 
-        return cache_key, results[skip_cache_completions:]
+        indented = []
+        for c in content:
+            indented.append(c.split('\n'))
+        return indented
 
     def update_cache(self, cache_key, results):
-        while os.path.exists(self.cache_file + ".tmp") or os.path.exists(self.cache_file + ".lock"):
-            time.sleep(0.1)
-        with open(self.cache_file + ".lock", "w") as f:
-            pass
-        if os.path.exists(self.cache_file):
-            with open(self.cache_file, "r") as f:
-                self.cache = json.load(f)
+        # replaces all completions of `cache_key`
         self.cache[cache_key] = results
-        with open(self.cache_file + ".tmp", "w") as f:
-            json.dump(self.cache, f)
-        os.rename(self.cache_file + ".tmp", self.cache_file)
-        os.remove(self.cache_file + ".lock")
 
 
 def setup_claude():
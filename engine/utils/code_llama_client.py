@@ -6,118 +6,167 @@ from pathlib import Path
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
 from engine.constants import MAX_TOKENS, TEMPERATURE, NUM_COMPLETIONS
+from engine.utils.llm_cache_utils import LLMCache, cache_task
+
+
+# e.g. HuggingFaceTB/SmolLM2-135M-Instruct for testing on CPU
+LLAMA_MODEL_NAME: str = os.environ.get('LLAMA_MODEL_NAME', "meta-llama/Meta-Llama-3-8B-Instruct")
+# sequences per forward pass, i.e. prompts x samples
+LLAMA_BATCH_SIZE: int = int(os.environ.get('LLAMA_BATCH_SIZE', 8))
 
 
 class LlamaClient:
-    def __init__(self, model_name="meta-llama/Meta-Llama-3-8B-Instruct", cache="llama_cache.json"):
-        self.cache_file = cache
+    def __init__(self, model_name=LLAMA_MODEL_NAME, cache="llama_cache.json", batch_size=LLAMA_BATCH_SIZE):
         self.model_name = model_name
+        self.batch_size = batch_size
 
-        # Load cache
-        if os.path.exists(cache):
-            while os.path.exists(self.cache_file + ".tmp") or os.path.exists(self.cache_file + ".lock"):
-                time.sleep(0.1)
-            with open(cache, "r") as f:
-                self.cache = json.load(f)
-        else:
-            self.cache = {}
+        # Load cache; a JSON cache is migrated on first use
+        self.cache = LLMCache(cache)
+        self.cache_file = self.cache.path
 
         # Load model and tokenizer
         print("Loading tokenizer and model...")
         load_start = time.time()
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.tokenizer.pad_token = self.tokenizer.eos_token
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.bfloat16,
-            device_map="auto",
-        )
+        # prompts of different lengths are batched with left padding, so that generation continues right after each
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side="left")
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        if torch.cuda.is_available():
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=torch.bfloat16,
+                device_map="auto",
+            )
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32)
+        self.model.eval()
         load_end = time.time()
         print(f"Model loading time: {load_end - load_start:.2f} seconds")
         print("Model device:", self.model.device)
 
     def generate(self, user_prompt, system_prompt, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, stop_sequences=None, verbose=False,
-                 num_completions=NUM_COMPLETIONS, skip_cache_completions=0):
+                 num_completions=NUM_COMPLETIONS, skip_cache_completions=0, **kwargs):
         
         print(f'[INFO] Llama3: querying for {num_completions=}, {skip_cache_completions=} before searching cache')
         if verbose:
             print(user_prompt)
             print("-----")
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-
-        cache_key = str((user_prompt, system_prompt, max_tokens, temperature, stop_sequences, 'llama'))
+        cache_key, legacy_key = self.cache_key(user_prompt, system_prompt, max_tokens, temperature, stop_sequences)
 
         num_completions = skip_cache_completions + num_completions
-        if cache_key in self.cache:
-            print(f'[INFO] Llama: cache hit {len(self.cache[cache_key])}')
-            if len(self.cache[cache_key]) < num_completions:
-                num_completions -= len(self.cache[cache_key])
-                results = self.cache[cache_key]
+        results = self.cache.get(cache_key, legacy_key=legacy_key)
+        if results is not None:
+            print(f'[INFO] Llama: cache hit {len(results)}')
+            if len(results) < num_completions:
+                num_completions -= len(results)
             else:
-                return cache_key, self.cache[cache_key][skip_cache_completions:num_completions]
+                return cache_key, results[skip_cache_completions:num_completions]
         else:
             results = []
 
         print(f'[INFO] Llama: querying for {num_completions=}')
 
-        while num_completions > 0:
-            response, _ = self.generate_response(messages, max_tokens, temperature)
-            results.append(response.split('\n'))
-            num_completions -= 1
-
-        self.update_cache(cache_key, results)
-        return cache_key, results[skip_cache_completions:]
-
-    def generate_response(self, messages, max_tokens, temperature):
-        inputs = self.tokenizer.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            return_tensors="pt"
-        )
-        
-        input_ids = inputs.to(self.model.device)
-        
-        attention_mask = torch.ones_like(input_ids)
-        attention_mask = attention_mask.to(self.model.device)
-
-        terminators = [
-            self.tokenizer.eos_token_id,
-            self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        new_results = self.generate_responses([self.build_messages(user_prompt, system_prompt)], [num_completions],
+                                              max_tokens, temperature)[0]
+
+        self.cache.append(cache_key, new_results)
+        return cache_key, (results + new_results)[skip_cache_completions:]
+
+    def generate_batch(self, prompts, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, stop_sequences=None,
+                       num_completions=NUM_COMPLETIONS, tasks=None, **kwargs):
+        # completions of many `(user_prompt, system_prompt)` prompts, batched across prompts; see `run_utils.generate_batch`
+        keys = []
+        results = []
+        for j, (user_prompt, system_prompt) in enumerate(prompts):
+            cache_key, legacy_key = self.cache_key(user_prompt, system_prompt, max_tokens, temperature, stop_sequences)
+            keys.append(cache_key)
+            with cache_task(None if tasks is None else tasks[j]):  # hits are indexed under the task too
+                results.append((self.cache.get(cache_key, legacy_key=legacy_key) or [])[:num_completions])
+        missing = [j for j in range(len(prompts)) if len(results[j]) < num_completions]
+        print(f'[INFO] Llama: {len(missing)} of {len(prompts)} prompts missing completions in the cache')
+        new_results = self.generate_responses([self.build_messages(*prompts[j]) for j in missing],
+                                              [num_completions - len(results[j]) for j in missing],
+                                              max_tokens, temperature)
+        for j, completions in zip(missing, new_results):
+            with cache_task(None if tasks is None else tasks[j]):
+                self.cache.append(keys[j], completions)
+            results[j] = results[j] + completions
+        return results
+
+    def build_messages(self, user_prompt, system_prompt):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
         ]
 
+    def cache_key(self, user_prompt, system_prompt, max_tokens, temperature, stop_sequences):
+        # the key, and a function building the key used before `LLMCache.make_key`
+        cache_key = self.cache.make_key(self.model_name, system_prompt, user_prompt, max_tokens=max_tokens,
+                                        temperature=temperature, stop_sequences=stop_sequences)
+        return cache_key, lambda: str((user_prompt, system_prompt, max_tokens, temperature, stop_sequences, 'llama'))
+
+    def generate_responses(self, prompts_messages, nums, max_tokens, temperature) -> list[list[list[str]]]:
+        """
+        `nums[j]` completions of each prompt, as lines. The samples of a prompt come from one `generate` call
+        (`num_return_sequences`) instead of one call each; prompts are batched together, sorted by length to minimize
+        padding, up to `batch_size` sequences per call.
+        """
+        texts = [self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+                 for messages in prompts_messages]
+        lengths = [len(self.tokenizer(text, add_special_tokens=False).input_ids) for text in texts]
+        order = sorted(range(len(texts)), key=lambda j: lengths[j])
+        results = [[] for _ in texts]
+        # samples of a prompt are split across calls if there are more than `batch_size`
+        queue = [(j, min(self.batch_size, nums[j] - k)) for j in order for k in range(0, nums[j], self.batch_size)]
+        total_tokens = 0
         start_time = time.time()
-        outputs = self.model.generate(
-            input_ids,
-            attention_mask=attention_mask,
-            max_new_tokens=max_tokens,
-            eos_token_id=terminators,
-            do_sample=True,
-            temperature=temperature,
-            top_p=0.9,
-            pad_token_id=self.tokenizer.eos_token_id,
-        )
-        end_time = time.time()
-        
-        response = outputs[0][input_ids.shape[-1]:]
-        return self.tokenizer.decode(response, skip_special_tokens=True), end_time - start_time
+        while len(queue) > 0:
+            # calls sample the same number of sequences per prompt
+            num_return_sequences = queue[0][1]
+            group = [j for j, n in queue if n == num_return_sequences][:max(1, self.batch_size // num_return_sequences)]
+            for j in group:
+                queue.remove((j, num_return_sequences))
+            responses, num_tokens = self.sample([texts[j] for j in group], num_return_sequences, max_tokens, temperature)
+            total_tokens += num_tokens
+            for i, j in enumerate(group):
+                results[j].extend(response.split('\n') for response in
+                                  responses[i * num_return_sequences:(i + 1) * num_return_sequences])
+        elapsed = time.time() - start_time
+        print(f'[INFO] Llama: {sum(nums)} samples of {len(texts)} prompts, {total_tokens} new tokens in {elapsed:.1f}s, '
+              f'{total_tokens / max(elapsed, 1e-6):.1f} tokens/s')
+        return results
+
+    def sample(self, texts, num_return_sequences, max_tokens, temperature) -> tuple[list[str], int]:
+        # `num_return_sequences` samples of each text, grouped by text, and the number of generated tokens
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, add_special_tokens=False).to(self.model.device)
+
+        terminators = [self.tokenizer.eos_token_id]
+        eot_id = self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        if eot_id is not None and eot_id != self.tokenizer.unk_token_id:
+            terminators.append(eot_id)
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_tokens,
+                eos_token_id=terminators,
+                do_sample=True,
+                temperature=temperature,
+                top_p=0.9,
+                num_return_sequences=num_return_sequences,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+
+        # left padding, so all generations start after the padded prompts
+        generated = outputs[:, inputs.input_ids.shape[-1]:]
+        num_tokens = int((~torch.isin(generated, torch.tensor(terminators + [self.tokenizer.pad_token_id],
+                                                                 device=generated.device))).sum())
+        return self.tokenizer.batch_decode(generated, skip_special_tokens=True), num_tokens
 
     def update_cache(self, cache_key, results):
-        while os.path.exists(self.cache_file + ".tmp") or os.path.exists(self.cache_file + ".lock"):
-            time.sleep(0.1)
-        with open(self.cache_file + ".lock", "w") as f:
-            pass
-        if os.path.exists(self.cache_file):
-            with open(self.cache_file, "r") as f:
-                self.cache = json.load(f)
+        # replaces all completions of `cache_key`
         self.cache[cache_key] = results
-        with open(self.cache_file + ".tmp", "w") as f:
-            json.dump(self.cache, f)
-        os.rename(self.cache_file + ".tmp", self.cache_file)
-        os.remove(self.cache_file + ".lock")
 
 def setup_llama():
     try:
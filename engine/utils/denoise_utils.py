@@ -0,0 +1,119 @@
+import os
+import time
+from typing import Union
+import numpy as np
+import mitsuba as mi
+
+DENOISE: bool = os.environ.get('DENOISE', '0') == '1'
+DENOISE_SPP = 16  # spp used when denoising, instead of `mi_helper.SPP`
+AOVS = 'albedo:albedo,nn:sh_normal'  # appended after the RGBA channels of the nested integrator
+NUM_AOV_CHANNELS = 6
+
+BILATERAL_RADIUS = 3
+BILATERAL_SIGMA_SPATIAL = 2.
+BILATERAL_SIGMA_ALBEDO = .1
+BILATERAL_SIGMA_NORMAL = .2
+BILATERAL_SIGMA_COLOR = .5
+
+
+def create_denoise_integrator(integrator: Union[dict, mi.Integrator]) -> dict:
+    # wraps `integrator` so that albedo and normals are rendered in the same pass as RGB
+    return {'type': 'aov', 'aovs': AOVS, 'integrator': integrator}
+
+
+def split_aovs(image: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (color, albedo, normal) of an image rendered with `create_denoise_integrator`
+    image = np.asarray(image, dtype=np.float32)
+    return image[..., :-NUM_AOV_CHANNELS], image[..., -6:-3], image[..., -3:]
+
+
+def denoise_oidn(color: np.ndarray, albedo: np.ndarray, normal: np.ndarray) -> np.ndarray:
+    import oidn
+    height, width = color.shape[:2]
+    color = np.ascontiguousarray(color, dtype=np.float32)
+    albedo = np.ascontiguousarray(albedo, dtype=np.float32)
+    normal = np.ascontiguousarray(normal, dtype=np.float32)
+    output = np.zeros_like(color)
+    device = oidn.NewDevice()
+    oidn.CommitDevice(device)
+    oidn_filter = oidn.NewFilter(device, 'RT')
+    for name, buffer in [('color', color), ('albedo', albedo), ('normal', normal), ('output', output)]:
+        oidn.SetSharedFilterImage(oidn_filter, name, buffer, oidn.FORMAT_FLOAT3, width, height)
+    oidn.SetFilterBool(oidn_filter, 'hdr', True)
+    oidn.CommitFilter(oidn_filter)
+    oidn.ExecuteFilter(oidn_filter)
+    oidn.ReleaseFilter(oidn_filter)
+    oidn.ReleaseDevice(device)
+    return output
+
+
+def denoise_bilateral(color: np.ndarray, albedo: np.ndarray, normal: np.ndarray,
+                      radius: int = BILATERAL_RADIUS) -> np.ndarray:
+    """
+    Joint (cross) bilateral filter guided by albedo and normals. Filters the albedo-demodulated irradiance so that
+    texture and edges between materials stay sharp.
+    """
+    eps = 1e-3
+    irradiance = color / (albedo + eps)
+    pad = [(radius, radius), (radius, radius), (0, 0)]
+    irradiance_pad = np.pad(irradiance, pad, mode='edge')
+    albedo_pad = np.pad(albedo, pad, mode='edge')
+    normal_pad = np.pad(normal, pad, mode='edge')
+    color_pad = np.pad(color, pad, mode='edge')
+    height, width = color.shape[:2]
+
+    total = np.zeros_like(irradiance)
+    total_weight = np.zeros(color.shape[:2] + (1,), dtype=np.float32)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            window = np.s_[radius + dy:radius + dy + height, radius + dx:radius + dx + width]
+            log_weight = (-(dy ** 2 + dx ** 2) / (2 * BILATERAL_SIGMA_SPATIAL ** 2)
+                          - np.sum((albedo_pad[window] - albedo) ** 2, axis=-1, keepdims=True) / (2 * BILATERAL_SIGMA_ALBEDO ** 2)
+                          - np.sum((normal_pad[window] - normal) ** 2, axis=-1, keepdims=True) / (2 * BILATERAL_SIGMA_NORMAL ** 2)
+                          - np.sum((color_pad[window] - color) ** 2, axis=-1, keepdims=True) / (2 * BILATERAL_SIGMA_COLOR ** 2))
+            weight = np.exp(log_weight)
+            total += weight * irradiance_pad[window]
+            total_weight += weight
+    return (total / total_weight * (albedo + eps)).astype(np.float32)
+
+
+def denoise_image(image: np.ndarray) -> np.ndarray:
+    # takes the output of an integrator from `create_denoise_integrator`, returns the denoised RGB(A) image
+    color, albedo, normal = split_aovs(image)
+    rgb = color[..., :3]
+    try:
+        rgb = denoise_oidn(rgb, albedo, normal)
+    except ImportError:
+        rgb = denoise_bilateral(rgb, albedo, normal)
+    except Exception as e:  # e.g. no supported device, or a driver error
+        print(f'[WARNING] OIDN failed, falling back to the bilateral filter: {e}')
+        rgb = denoise_bilateral(rgb, albedo, normal)
+    return np.concatenate([rgb, color[..., 3:]], axis=-1)
+
+
+def benchmark_denoise(spps: tuple[int, ...] = (8, 16, 32, 128), reference_spp: int = 1024):
+    scene = mi.load_dict(mi.cornell_box())
+    scene_aov = mi.load_dict(mi.cornell_box() | {'integrator': create_denoise_integrator({'type': 'path', 'max_depth': 8})})
+    reference = np.asarray(mi.render(scene, spp=reference_spp))[..., :3]
+
+    def psnr(image: np.ndarray) -> float:
+        mse = np.mean((np.clip(image[..., :3], 0, 1) - np.clip(reference, 0, 1)) ** 2)
+        return float(10 * np.log10(1 / max(mse, 1e-12)))
+
+    print(f'{"spp":>6} {"render (s)":>11} {"PSNR":>7} {"render+aov (s)":>15} {"denoise (s)":>12} {"PSNR":>7}')
+    for spp in spps:
+        start = time.time()
+        image = np.asarray(mi.render(scene, spp=spp))
+        render_time = time.time() - start
+        start = time.time()
+        image_aov = np.asarray(mi.render(scene_aov, spp=spp))
+        render_aov_time = time.time() - start
+        start = time.time()
+        denoised = denoise_image(image_aov)
+        denoise_time = time.time() - start
+        print(f'{spp:>6} {render_time:>11.3f} {psnr(image):>7.2f} {render_aov_time:>15.3f} {denoise_time:>12.3f} {psnr(denoised):>7.2f}')
+
+
+if __name__ == "__main__":
+    mi.set_variant('scalar_rgb')
+    benchmark_denoise()
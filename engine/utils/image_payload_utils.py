@@ -0,0 +1,175 @@
+import base64
+import hashlib
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+from typing import Union
+from PIL import Image
+
+IMAGE_FORMAT: str = os.environ.get('IMAGE_FORMAT', 'webp')  # 'png' to send renders losslessly
+IMAGE_QUALITY: int = int(os.environ.get('IMAGE_QUALITY', 90))
+# consecutive image items marked with `'contact_sheet': True`, e.g. the views of one scene shown to the critic, are
+# sent as one tiled image; other images are always sent on their own
+IMAGE_CONTACT_SHEET: bool = os.environ.get('IMAGE_CONTACT_SHEET', '1') == '1'
+# (long edge, pixels) of the largest image a provider uses as is; it downsizes larger ones, which only cost upload time
+PROVIDER_MAX_SIZE: dict[str, tuple[int, int]] = {
+    'claude': (1568, 1_150_000),
+    'gpt': (512, 512 * 512),  # `detail: low`
+}
+MEDIA_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+# least recently used evicted first; payloads are a few hundred KB of base64 each, so only recent ones are kept
+DIGEST_CACHE_SIZE = 1024
+PAYLOAD_CACHE_SIZE = 32
+_digests: OrderedDict[tuple, str] = OrderedDict()  # (path, mtime, size) -> sha256 of the file
+_payloads: OrderedDict[tuple, tuple[str, str]] = OrderedDict()
+_lock = threading.Lock()
+
+
+def _lru_put(cache: OrderedDict, key, value, size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+
+def file_digest(path: str) -> str:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _lock:
+        if key in _digests:
+            _digests.move_to_end(key)
+            return _digests[key]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    with _lock:
+        _lru_put(_digests, key, digest, DIGEST_CACHE_SIZE)
+    return digest
+
+
+def estimate_tokens(width: int, height: int, provider: str) -> int:
+    if provider == 'claude':
+        return math.ceil(width * height / 750)
+    return 85  # `detail: low` is a flat rate
+
+
+def estimate_message_tokens(value, provider: str) -> int:
+    # input tokens of API messages: text by its length, and images by their size as `provider` counts them, not by the
+    # length of their base64 payloads
+    if isinstance(value, dict):
+        data = None
+        if value.get('type') == 'image' and value.get('source', {}).get('type') == 'base64':
+            data = value['source']['data']
+        elif value.get('type') == 'image_url' and isinstance(value['image_url'], dict) \
+                and value['image_url'].get('url', '').startswith('data:'):
+            data = value['image_url']['url'].split(',', 1)[1]
+        if data is None:
+            return sum(estimate_message_tokens(v, provider) for v in value.values())
+        # only the header is decoded
+        size = Image.open(io.BytesIO(base64.b64decode(data))).size if provider == 'claude' else (0, 0)
+        return estimate_tokens(*size, provider)
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_message_tokens(v, provider) for v in value)
+    if isinstance(value, str):
+        return len(value) // 4
+    return 0
+
+
+def fit(image: Image.Image, max_edge: int, max_pixels: int) -> Image.Image:
+    scale = min(1., max_edge / max(image.size), math.sqrt(max_pixels / (image.size[0] * image.size[1])))
+    if scale == 1.:
+        return image
+    return image.resize((max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale))),
+                        Image.LANCZOS)
+
+
+def contact_sheet(images: list[Image.Image]) -> Image.Image:
+    # near-square grid, in order, each image centered in its cell
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    cell_w = max(image.size[0] for image in images)
+    cell_h = max(image.size[1] for image in images)
+    sheet = Image.new('RGBA', (columns * cell_w, rows * cell_h), (255, 255, 255, 255))
+    for i, image in enumerate(images):
+        x = (i % columns) * cell_w + (cell_w - image.size[0]) // 2
+        y = (i // columns) * cell_h + (cell_h - image.size[1]) // 2
+        sheet.paste(image, (x, y), image)
+    return sheet
+
+
+def encode(image: Image.Image, fmt: str = IMAGE_FORMAT, quality: int = IMAGE_QUALITY) -> bytes:
+    if fmt == 'jpeg':
+        # no alpha, the transparent background of renders becomes white
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt.upper(), **({} if fmt == 'png' else {'quality': quality}))
+    return buffer.getvalue()
+
+
+def encode_images(paths: list[str], provider: str) -> tuple[str, str]:
+    """
+    Media type and base64 of the images for `provider`, tiled into one contact sheet if there are several, downsized
+    to the provider's size, and re-encoded as `IMAGE_FORMAT`. Memoized by the content of the files, so the same
+    rendering sent again (judge, retries, `skip_cache`) is encoded once per process.
+    """
+    key = (tuple(file_digest(path) for path in paths), provider, IMAGE_FORMAT, IMAGE_QUALITY)
+    with _lock:
+        if key in _payloads:
+            _payloads.move_to_end(key)
+            return _payloads[key]
+    max_edge, max_pixels = PROVIDER_MAX_SIZE[provider]
+    images = [Image.open(path).convert('RGBA') for path in paths]
+    if len(images) > 1:
+        # views are downsized first, so that the sheet isn't built at full resolution
+        n = len(images)
+        images = [fit(image, max_edge, max_pixels // n) for image in images]
+        image = contact_sheet(images)
+    else:
+        image = images[0]
+    image = fit(image, max_edge, max_pixels)
+    data = encode(image)
+    source_bytes = sum(os.path.getsize(path) for path in paths)
+    print(f'[INFO] image payload for {provider}: {len(paths)} image(s), {source_bytes / 1024:.0f}KB -> '
+          f'{len(data) / 1024:.0f}KB {IMAGE_FORMAT} at {image.size[0]}x{image.size[1]}, '
+          f'~{estimate_tokens(*image.size, provider)} tokens')
+    payload = (MEDIA_TYPES[IMAGE_FORMAT], base64.b64encode(data).decode('utf-8'))
+    with _lock:
+        _lru_put(_payloads, key, payload, PAYLOAD_CACHE_SIZE)
+    return payload
+
+
+def group_images(content: list[dict]) -> list[Union[dict, list[str]]]:
+    # content items, with the paths of local images grouped into lists, one per payload; consecutive images marked
+    # with `contact_sheet` share one
+    items = []
+    sheet_open = False  # whether `items[-1]` is a contact sheet that the next marked image joins
+    for item in content:
+        if item['type'] == 'image_url' and isinstance(item['image_url'], str) and os.path.exists(item['image_url']):
+            marked = IMAGE_CONTACT_SHEET and item.get('contact_sheet', False)
+            if marked and sheet_open:
+                items[-1].append(item['image_url'])
+            else:
+                items.append([item['image_url']])
+            sheet_open = marked
+        else:
+            items.append(item)
+            sheet_open = False
+    return items
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='renderings, tiled if there are several')
+    parser.add_argument('--provider', default='claude', choices=list(PROVIDER_MAX_SIZE.keys()))
+    args = parser.parse_args()
+    for _ in range(2):
+        start = time.time()
+        media_type, data = encode_images(args.paths, args.provider)
+        print(f'[INFO] {media_type}, {len(data) / 1024:.0f}KB base64 in {time.time() - start:.3f}s')
@@ -0,0 +1,221 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+DIGEST_CACHE_SIZE = 64  # recent prompt texts, e.g. system prompts shared by all calls of a run
+_task: Optional[str] = None
+
+
+def hash_key(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+@lru_cache(maxsize=DIGEST_CACHE_SIZE)
+def digest(text: str) -> str:
+    # str hashes are cached by Python, so repeated lookups of the same prompt are cheap
+    return hash_key(text)
+
+
+def _to_text(prompt) -> str:
+    return prompt if isinstance(prompt, str) else json.dumps(prompt, sort_keys=True)
+
+
+@contextmanager
+def cache_task(task: Optional[str]):
+    # completions cached within this scope are indexed under `task`, see `LLMCache.completions_for_task`
+    global _task
+    prev, _task = _task, task
+    try:
+        yield
+    finally:
+        _task = prev
+
+
+def _encode(value) -> bytes:
+    return zlib.compress(json.dumps(value).encode())
+
+
+def _decode(value: bytes):
+    return json.loads(zlib.decompress(value).decode())
+
+
+class LLMCache:
+    """
+    LLM completions keyed by the hash of the prompt key, one compressed row per completion, in a SQLite database in WAL
+    mode so that any number of processes read while one writes. Supports `in`, `[]` and `[] =` like the JSON dict it
+    replaces. A `*.json` path is mapped to `*.db`, and the JSON cache is migrated into it on first use. Keys from
+    `make_key` reference prompt bodies stored once in a blob table, and are indexed by the task they were issued for.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        json_path = None
+        if path.suffix == '.json':
+            json_path, path = path, path.with_suffix('.db')
+        self.path = path.as_posix()
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS completions ('
+                     'key TEXT NOT NULL, ind INTEGER NOT NULL, value BLOB NOT NULL, created REAL NOT NULL, '
+                     'PRIMARY KEY (key, ind))')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        # prompt bodies are stored once, keys only reference their digests
+        conn.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS keys ('
+                     'key TEXT PRIMARY KEY, model TEXT, system_digest TEXT, user_digest TEXT, params TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS task_keys (task TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (task, key))')
+        if json_path is not None and json_path.exists():
+            migrate_json(json_path.as_posix(), self)
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per thread; transactions are explicit
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _write(self, fn):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')  # takes the write lock up front, so that counts can't go stale
+        try:
+            out = fn(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return out
+
+    def make_key(self, model: str, system_prompt, user_prompt, **params) -> str:
+        """
+        Compact key from the digests of the prompts, the parameters and the model name. Prompt bodies are stored once
+        in the blob table, e.g. the `helper.py` header shared by all system prompts.
+        """
+        system_text, user_text = _to_text(system_prompt), _to_text(user_prompt)
+        system_digest, user_digest = digest(system_text), digest(user_text)
+        params = json.dumps(params, sort_keys=True, default=str)
+        key = hash_key(json.dumps([model, system_digest, user_digest, params]))
+        conn = self._connect()
+        if conn.execute('SELECT 1 FROM keys WHERE key = ?', (key,)).fetchone() is None:
+            def fn(conn: sqlite3.Connection):
+                conn.executemany('INSERT OR IGNORE INTO blobs VALUES (?, ?)',
+                                 [(system_digest, _encode(system_text)), (user_digest, _encode(user_text))])
+                conn.execute('INSERT OR IGNORE INTO keys VALUES (?, ?, ?, ?, ?)',
+                             (key, model, system_digest, user_digest, params))
+            self._write(fn)
+        return key
+
+    def get_blob(self, digest: str) -> Optional[str]:
+        row = self._connect().execute('SELECT value FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        return None if row is None else _decode(row[0])
+
+    def get(self, key: str, legacy_key: Optional[Callable[[], str]] = None, index: bool = True) -> Optional[list]:
+        # `legacy_key` builds the key of entries cached before `make_key`; they are moved to `key` when found;
+        # hits are indexed under the current task like new completions, so that a task covers runs served from cache
+        rows = self._connect().execute('SELECT value FROM completions WHERE key = ? ORDER BY ind',
+                                       (hash_key(key),)).fetchall()
+        if len(rows) == 0:
+            if legacy_key is not None:
+                completions = self.get(legacy_key(), index=False)
+                if completions is not None:
+                    self.put(key, completions)
+                return completions
+            return None
+        if index and _task is not None and self._connect().execute(
+                'SELECT 1 FROM task_keys WHERE task = ? AND key = ?', (_task, key)).fetchone() is None:
+            self._write(lambda conn: self._index_task(conn, key))
+        return [_decode(value) for value, in rows]
+
+    def _index_task(self, conn: sqlite3.Connection, key: str):
+        if _task is not None:
+            conn.execute('INSERT OR IGNORE INTO task_keys VALUES (?, ?)', (_task, key))
+
+    def completions_for_task(self, task: str) -> dict[str, list]:
+        # all cached completions of all prompts issued for `task`, by key
+        conn = self._connect()
+        keys = [key for key, in conn.execute('SELECT key FROM task_keys WHERE task = ? ORDER BY rowid', (task,))]
+        return {key: self.get(key, index=False) or [] for key in keys}
+
+    def append(self, key: str, completions: list):
+        # adds completions after the existing ones, including those appended by other processes meanwhile
+        if len(completions) == 0:
+            return
+
+        def fn(conn: sqlite3.Connection):
+            h = hash_key(key)
+            count, = conn.execute('SELECT COUNT(*) FROM completions WHERE key = ?', (h,)).fetchone()
+            now = time.time()
+            conn.executemany('INSERT INTO completions VALUES (?, ?, ?, ?)',
+                             [(h, count + i, _encode(c), now) for i, c in enumerate(completions)])
+            self._index_task(conn, key)
+        self._write(fn)
+
+    def put(self, key: str, completions: list):
+        def fn(conn: sqlite3.Connection):
+            h = hash_key(key)
+            conn.execute('DELETE FROM completions WHERE key = ?', (h,))
+            now = time.time()
+            conn.executemany('INSERT INTO completions VALUES (?, ?, ?, ?)',
+                             [(h, i, _encode(c), now) for i, c in enumerate(completions)])
+            self._index_task(conn, key)
+        self._write(fn)
+
+    def __contains__(self, key: str) -> bool:
+        return self._connect().execute('SELECT 1 FROM completions WHERE key = ? LIMIT 1',
+                                       (hash_key(key),)).fetchone() is not None
+
+    def __getitem__(self, key: str) -> list:
+        completions = self.get(key)
+        if completions is None:
+            raise KeyError(key)
+        return completions
+
+    def __setitem__(self, key: str, completions: list):
+        self.put(key, completions)
+
+    def __len__(self) -> int:
+        return self._connect().execute('SELECT COUNT(DISTINCT key) FROM completions').fetchone()[0]
+
+
+def migrate_json(json_path: str, cache: LLMCache, force: bool = False) -> int:
+    # copies a JSON cache into `cache` once; returns the number of migrated keys
+    name = f'migrated:{Path(json_path).resolve().as_posix()}'
+    conn = cache._connect()
+    if not force and conn.execute('SELECT 1 FROM meta WHERE name = ?', (name,)).fetchone() is not None:
+        return 0
+    print(f'[INFO] migrating {json_path} into {cache.path}...')
+    with open(json_path, 'r') as f:
+        entries = json.load(f)
+
+    def fn(conn: sqlite3.Connection):
+        now = time.time()
+        for key, completions in entries.items():
+            conn.executemany('INSERT OR IGNORE INTO completions VALUES (?, ?, ?, ?)',
+                             [(hash_key(key), i, _encode(c), now) for i, c in enumerate(completions)])
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, str(now)))
+    cache._write(fn)
+    print(f'[INFO] migrated {len(entries)} keys')
+    return len(entries)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('json_paths', nargs='+', help='cache.json files to migrate')
+    parser.add_argument('--db', default=None, help='defaults to the .db next to each json file')
+    parser.add_argument('--force', action='store_true', help='migrate again, keeping existing completions')
+    args = parser.parse_args()
+    for json_path in args.json_paths:
+        cache = LLMCache(args.db if args.db is not None else Path(json_path).with_suffix('.db'))
+        migrate_json(json_path, cache, force=args.force)
+        print(f'[INFO] {cache.path}: {len(cache)} keys, {os.path.getsize(cache.path) / 2 ** 20:.1f} MB')
@@ -1,4 +1,7 @@
-from typing import Union
+from typing import Union, Optional
+
+# stop sequence right at the closing fence of the code block; the fence itself is not returned by the API
+CODE_FENCE_STOP = '\n```\n'
 
 def unwrap_results(lines: list[str], code_only: bool = False) -> Union[list[str], None]:
     """
@@ -28,7 +31,40 @@ def unwrap_results(lines: list[str], code_only: bool = False) -> Union[list[str]
                 ['"""']))
 
 
+class CodeFenceParser:
+    """
+    Incremental `unwrap_results` for streamed responses: `feed` returns the lines up to the closing fence once the
+    ```python block is complete, so that the program can be executed while the explanation is still being generated.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.buffer = ''
+        self.opened = False
+        self.closed = False
+        self.done = False
+
+    def feed(self, text: str) -> Optional[list[str]]:
+        if self.done:
+            return None
+        *lines, self.buffer = (self.buffer + text).split('\n')
+        for line in lines:
+            line = line.rstrip()
+            self.lines.append(line)
+            self.opened = self.opened or line == '```python'
+            self.closed = self.closed or line == '```'
+            if self.opened and self.closed:
+                self.done = True
+                return self.lines
+        return None
+
+
 if __name__ == "__main__":
     test = ['Here is a possible implementation of a colorful Jenga tower in Minecraft using the provided DSL:\n\n```python\nfrom helper import *\n\n"""\na colorful Jenga tower\n"""\n\n@register(\'a colorful Jenga tower\')\ndef jenga_tower(height: int = 18, width: int = 3) -> Shape:\n    return loop(height, lambda i, n: transform_shape(\n        library_call(\'jenga_layer\', width=width, color=BlockType(jenga_color(i))), \n        translation_matrix([0, i, 0])\n    ))\n\n@register(\'a single layer of a Jenga tower\')\ndef jenga_layer(width: int = 3, color: BlockType = BlockType.PLANKS) -> Shape:\n    return primitive_call(\'set_cuboid\', block_type=color, scale=(width, 1, width), fill=True)\n\ndef jenga_color(i: int) -> str:\n    colors = [\'red_wool\', \'orange_wool\', \'yellow_wool\', \'lime_wool\', \'light_blue_wool\', \'magenta_wool\']\n    return colors[i % len(colors)]\n```\n\nExplanation:\n- The main `jenga_tower` function takes a `height` and `width` parameter to specify the dimensions of the tower. It uses a `loop` to stack `height` number of `jenga_layer`s on top of each other, each translated upwards by their index `i`.\n- The `jenga_layer` function creates a single solid layer of the tower with the specified `width` and `color`. It uses `primitive_call` to create a filled cuboid.\n- The `jenga_color` helper function returns a different wool color based on the index `i`, cycling through a predefined list of colors. This is used to make each layer of the tower a different color.\n\nThe result is a tower with the specified `height` and `width`, composed of solid layers each with a different vibrant color. The layers are stacked directly on top of each other to form the tower structure.\n\nLet me know if you have any other questions!']
     test = test[0].split('\n')
-    print(unwrap_results(test))
\ No newline at end of file
+    print(unwrap_results(test))
+
+    parser = CodeFenceParser()
+    text = '\n'.join(test)
+    streamed = next(lines for i in range(0, len(text), 7) if (lines := parser.feed(text[i:i + 7])) is not None)
+    assert unwrap_results(streamed, code_only=True) == unwrap_results(test, code_only=True)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import NamedTuple, Optional
+import numpy as np
+import mitsuba as mi
+from engine.constants import PROJ_DIR
+from engine.utils.type_utils import BBox
+
+MESH_CACHE_DIR: str = os.environ.get('MESH_CACHE_DIR', (Path(PROJ_DIR) / 'cache' / 'meshes').as_posix())
+BUFFERS = ['vertex_positions', 'vertex_normals', 'vertex_texcoords', 'faces']
+
+
+class MeshAsset(NamedTuple):
+    # memory-mapped buffers, shaped (n, k)
+    vertex_positions: np.ndarray
+    vertex_normals: Optional[np.ndarray]
+    vertex_texcoords: Optional[np.ndarray]
+    faces: np.ndarray
+    attributes: dict[str, np.ndarray]  # e.g. `vertex_color`
+    bounds: np.ndarray  # (2, 3), object space min and max
+
+
+_assets: dict[str, MeshAsset] = {}
+
+
+def _asset_key(path: str) -> str:
+    stat = os.stat(path)
+    return hashlib.sha256(f'{Path(path).resolve().as_posix()}:{stat.st_mtime_ns}:{stat.st_size}'.encode()).hexdigest()
+
+
+def convert_ply(path: str, save_dir: str):
+    # parses the PLY once with Mitsuba and stores its buffers as .npy files
+    mesh = mi.load_dict({'type': 'ply', 'filename': path})
+    params = mi.traverse(mesh)
+    vertex_count = mesh.vertex_count()
+    save_dir = Path(save_dir)
+    tmp_dir = save_dir.with_name(f'{save_dir.name}_{uuid.uuid4()}.tmp')
+    tmp_dir.mkdir(parents=True)
+    for key in params.keys():
+        # the buffers, and attributes such as `vertex_color`; `vertex_count` and `face_count` are scalars
+        if key in ['vertex_count', 'face_count'] or (
+                key not in BUFFERS and not key.startswith('vertex_') and not key.startswith('face_')):
+            continue
+        values = np.asarray(params[key])
+        if values.ndim == 0 or values.size == 0:
+            continue
+        count = mesh.face_count() if key.startswith('face') else vertex_count
+        np.save((tmp_dir / f'{key}.npy').as_posix(), values.reshape(count, -1))
+    positions = np.asarray(params['vertex_positions']).reshape(-1, 3)
+    np.save((tmp_dir / 'bounds.npy').as_posix(), np.stack([positions.min(axis=0), positions.max(axis=0)]))
+    try:
+        os.rename(tmp_dir.as_posix(), save_dir.as_posix())  # atomic; another process may have won the race
+    except OSError:
+        shutil.rmtree(tmp_dir.as_posix(), ignore_errors=True)
+
+
+def load_mesh_asset(path: str) -> MeshAsset:
+    # converted once per file version, loaded once per process
+    key = _asset_key(path)
+    if key in _assets:
+        return _assets[key]
+    save_dir = Path(MESH_CACHE_DIR) / key
+    if not (save_dir / 'bounds.npy').exists():
+        save_dir.parent.mkdir(parents=True, exist_ok=True)
+        convert_ply(path, save_dir.as_posix())
+    buffers = {p.stem: np.load(p.as_posix(), mmap_mode='r') for p in save_dir.glob('*.npy')}
+    asset = MeshAsset(
+        vertex_positions=buffers.pop('vertex_positions'),
+        vertex_normals=buffers.pop('vertex_normals', None),
+        vertex_texcoords=buffers.pop('vertex_texcoords', None),
+        faces=buffers.pop('faces'),
+        bounds=buffers.pop('bounds'),
+        attributes=buffers,
+    )
+    _assets[key] = asset
+    return asset
+
+
+def compute_asset_bbox(path: str, to_world: Optional[np.ndarray] = None) -> BBox:
+    # exact for translations and scales; otherwise the box of the transformed object-space box
+    box_min, box_max = np.asarray(load_mesh_asset(path).bounds)
+    if to_world is not None:
+        to_world = np.asarray(to_world.matrix if hasattr(to_world, 'matrix') else to_world, dtype=np.float64).reshape(4, 4)
+        corners = np.stack(np.meshgrid(*zip(box_min, box_max), indexing='ij'), axis=-1).reshape(-1, 3)
+        corners = corners @ to_world[:3, :3].T + to_world[:3, 3]
+        box_min, box_max = corners.min(axis=0), corners.max(axis=0)
+    box_sizes = box_max - box_min
+    return BBox(center=(box_min + box_max) / 2, min=box_min, max=box_max, sizes=box_sizes, size=float(max(box_sizes)))
+
+
+def create_asset_mesh(name: str, path: str, to_world=None, bsdf: Optional[dict] = None) -> mi.Mesh:
+    # in-memory equivalent of {'type': 'ply', 'filename': path, 'to_world': to_world, 'bsdf': bsdf}
+    asset = load_mesh_asset(path)
+    mat = np.eye(4) if to_world is None else np.asarray(
+        to_world.matrix if hasattr(to_world, 'matrix') else to_world, dtype=np.float64).reshape(4, 4)
+    props = mi.Properties()
+    if bsdf is not None:
+        props['bsdf'] = bsdf if isinstance(bsdf, mi.BSDF) else mi.load_dict(bsdf)
+    mesh = mi.Mesh(name, vertex_count=len(asset.vertex_positions), face_count=len(asset.faces), props=props,
+                   has_vertex_normals=asset.vertex_normals is not None,
+                   has_vertex_texcoords=asset.vertex_texcoords is not None)
+    for key, values in asset.attributes.items():
+        mesh.add_attribute(key, values.shape[1], np.ascontiguousarray(values, dtype=np.float32).ravel())
+    params = mi.traverse(mesh)
+    params['vertex_positions'] = (asset.vertex_positions @ mat[:3, :3].T + mat[:3, 3]).astype(np.float32).ravel()
+    if asset.vertex_normals is not None:
+        normals = asset.vertex_normals @ np.linalg.inv(mat[:3, :3])  # inverse transpose
+        normals = normals / np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-12)
+        params['vertex_normals'] = normals.astype(np.float32).ravel()
+    if asset.vertex_texcoords is not None:
+        params['vertex_texcoords'] = np.ascontiguousarray(asset.vertex_texcoords, dtype=np.float32).ravel()
+    params['faces'] = np.ascontiguousarray(asset.faces, dtype=np.uint32).ravel()
+    params.update()
+    return mesh
@@ -4,7 +4,9 @@ import mitsuba as mi
 from PIL import Image
 from pathlib import Path
 import numpy as np
+from collections import OrderedDict
 from .type_utils import BBox
+from .render_cache_utils import hash_scene, cached_render
 from typing import Optional
 
 T = mi.scalar_rgb.Transform4f
@@ -83,8 +85,25 @@ def set_scene_dict_default(scene_dict: dict) -> dict:
     return scene_dict
 
 
+BBOX_CACHE_SIZE = 1024
+_bboxes: OrderedDict[str, BBox] = OrderedDict()  # least recently used evicted first
+
+
 def compute_bbox(scene_dict: dict) -> BBox:
-    boxes = compute_bboxes(scene_dict)
+    # memoized by scene content; the same shapes are measured again by `set_auto_camera`, calc helpers, and per frame
+    key = hash_scene(scene_dict, verbose=False, exact=True)
+    if key is None or key not in _bboxes:
+        box = union_bboxes(compute_bboxes(scene_dict))
+        if key is None:
+            return box
+        _bboxes[key] = box
+        while len(_bboxes) > BBOX_CACHE_SIZE:
+            _bboxes.popitem(last=False)
+    _bboxes.move_to_end(key)
+    return BBox(*[np.copy(v) if isinstance(v, np.ndarray) else v for v in _bboxes[key]])
+
+
+def union_bboxes(boxes: list[BBox]) -> BBox:
     if len(boxes) == 0:
         box_min = np.ones((3,)) * -.5
         box_max = np.ones((3,)) * .5
@@ -96,6 +115,7 @@ def compute_bbox(scene_dict: dict) -> BBox:
     box_sizes = box_max - box_min
     return BBox(center=box_center, sizes=box_sizes, min=box_min, max=box_max, size=float(max(box_sizes)))
 
+
 def compute_bboxes(scene_dict: dict) -> list[BBox]:
     scene_dict = preprocess_scene_dict(scene_dict)
     boxes = []
@@ -226,8 +246,9 @@ def render_scene_dict(scene_dict: dict, verbose: bool = True, save_to: Optional[
     scene_dict = set_auto_camera(scene_dict)
     if verbose:
         print(scene_dict)
-    scene = mi.load_dict(scene_dict)
-    image = mi.render(scene, sensor=sensor)
+    # key order decides the sensor index
+    scene_key = hash_scene({'scene_dict': scene_dict, 'keys': list(scene_dict.keys())}, verbose=False)
+    image = cached_render(lambda: mi.load_dict(scene_dict), scene_key, sensor=sensor)
     # mi.Bitmap(image).write(f'outputs/{filename}.exr')  # debug
     image = mi.util.convert_to_bitmap(image)
     image = Image.fromarray(np.asarray(image))
@@ -0,0 +1,241 @@
+"""
+Local server speaking the Anthropic messages and OpenAI chat completions wire format, for testing the clients
+without API keys. Emulates provider prompt caching: Anthropic caches the prefixes marked with `cache_control`, OpenAI
+caches prompts of >= 1024 tokens in 128-token increments, and cached tokens are reported in the usage fields.
+Uncached input tokens delay the first token, so that TTFT savings are measurable.
+
+With `--replay`, responses are recorded `raw.txt` files (see `replay_client.ReplaySource`), and `--error-rate` of the
+requests fail with a 429 and a retry-after header, for load tests.
+
+Point the clients at it with `ANTHROPIC_BASE_URL=http://127.0.0.1:<port>` or `OPENAI_BASE_URL=http://127.0.0.1:<port>/v1`.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+MIN_CACHE_TOKENS = 1024
+OPENAI_CACHE_INCREMENT = 128
+DEFAULT_RESPONSE = '```python\nfrom helper import *\n\n\n@register()\ndef root() -> Shape:\n    return primitive_call("cube", shape_kwargs={"scale": (1, 1, 1)})\n```'
+
+
+def count_tokens(text: str) -> int:
+    return len(text) // 4  # rough, but consistent across requests
+
+
+def _text(content) -> str:
+    if isinstance(content, str):
+        return content
+    return ''.join(item.get('text', '') for item in content if isinstance(item, dict))
+
+
+class MockState:
+    def __init__(self, response: str = DEFAULT_RESPONSE, latency: float = .05, prefill: float = .2,
+                 replay=None, error_rate: float = 0., retry_after: float = 1., seed: int = 0):
+        self.response = response
+        self.latency = latency  # seconds before the first token
+        self.prefill = prefill  # additional seconds per 1k uncached input tokens
+        self.replay = replay  # `replay_client.ReplaySource`
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.counts: dict[str, int] = {}  # requests per prompt, to replay a different completion for each
+        self.prefixes: set[str] = set()
+        self.lock = threading.Lock()
+
+    def fail(self) -> bool:
+        with self.lock:
+            return self.rng.random() < self.error_rate
+
+    def respond(self, system, user, index: Optional[int]) -> str:
+        if self.replay is None:
+            return self.response
+        if index is None:
+            key = json.dumps([system, user])
+            with self.lock:
+                index = self.counts.get(key, 0)
+                self.counts[key] = index + 1
+        return '\n'.join(self.replay.sample(system, user, index))
+
+    def anthropic_usage(self, body: dict) -> dict:
+        blocks = body.get('system') or []
+        if isinstance(blocks, str):
+            blocks = [{'type': 'text', 'text': blocks}]
+        for message in body['messages']:
+            content = message['content']
+            blocks = blocks + ([{'type': 'text', 'text': content}] if isinstance(content, str) else content)
+        h = hashlib.sha256()
+        tokens = 0
+        breakpoints = []
+        for block in blocks:
+            text = block.get('text', json.dumps(block.get('source', '')))
+            h.update(text.encode())
+            tokens += count_tokens(text)
+            if 'cache_control' in block and tokens >= MIN_CACHE_TOKENS:
+                breakpoints.append((h.copy().hexdigest(), tokens))
+        with self.lock:
+            read = max([n for p, n in breakpoints if p in self.prefixes], default=0)
+            write = max([n for p, n in breakpoints], default=0) - read
+            self.prefixes.update(p for p, _ in breakpoints)
+        return {'input_tokens': tokens - read - write, 'cache_read_input_tokens': read,
+                'cache_creation_input_tokens': write}
+
+    def openai_usage(self, body: dict) -> dict:
+        text = ''.join(_text(message['content']) for message in body['messages'])
+        tokens = count_tokens(text)
+        prefixes = [(hashlib.sha256(text[:n * 4].encode()).hexdigest(), n)
+                    for n in range(MIN_CACHE_TOKENS, tokens + 1, OPENAI_CACHE_INCREMENT)]
+        with self.lock:
+            cached = max([n for p, n in prefixes if p in self.prefixes], default=0)
+            self.prefixes.update(p for p, _ in prefixes)
+        return {'prompt_tokens': tokens, 'prompt_tokens_details': {'cached_tokens': cached}}
+
+    def wait_first_token(self, uncached: int):
+        time.sleep(self.latency + self.prefill * uncached / 1000)
+
+
+class Handler(BaseHTTPRequestHandler):
+    state: MockState
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.state.fail():
+            self.send_rate_limit_error()
+        elif self.path.endswith('/messages'):
+            self.anthropic(body)
+        elif self.path.endswith('/chat/completions'):
+            self.openai(body)
+        else:
+            self.send_error(404)
+
+    def send_json(self, data: dict):
+        data = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_rate_limit_error(self):
+        if self.path.endswith('/messages'):
+            error = {'type': 'error', 'error': {'type': 'rate_limit_error', 'message': 'injected by mock_llm_server'}}
+        else:
+            error = {'error': {'type': 'requests', 'code': 'rate_limit_exceeded', 'message': 'injected by mock_llm_server'}}
+        data = json.dumps(error).encode()
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('retry-after', str(self.state.retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def replay_index(self) -> Optional[int]:
+        index = self.headers.get('x-replay-index')
+        return None if index is None else int(index)
+
+    def start_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+    def send_event(self, data, event: Optional[str] = None):
+        s = '' if event is None else f'event: {event}\n'
+        s += f'data: {data if isinstance(data, str) else json.dumps(data)}\n\n'
+        self.wfile.write(s.encode())
+        self.wfile.flush()
+
+    def anthropic(self, body: dict):
+        usage = self.state.anthropic_usage(body)
+        system = _text(body.get('system') or '')
+        user = body['messages'][-1]['content']
+        text = self.state.respond(system, user if isinstance(user, str) else _text(user), self.replay_index())
+        message = {'id': f'msg_{uuid.uuid4().hex}', 'type': 'message', 'role': 'assistant', 'model': body['model'],
+                   'content': [], 'stop_reason': None, 'stop_sequence': None,
+                   'usage': {**usage, 'output_tokens': 0}}
+        self.state.wait_first_token(usage['input_tokens'] + usage['cache_creation_input_tokens'])
+        output_tokens = count_tokens(text)
+        if not body.get('stream', False):
+            self.send_json({**message, 'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn',
+                            'usage': {**usage, 'output_tokens': output_tokens}})
+            return
+        self.start_events()
+        self.send_event({'type': 'message_start', 'message': message}, 'message_start')
+        self.send_event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}},
+                        'content_block_start')
+        for line in text.splitlines(keepends=True):
+            self.send_event({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': line}},
+                            'content_block_delta')
+        self.send_event({'type': 'content_block_stop', 'index': 0}, 'content_block_stop')
+        self.send_event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                         'usage': {'output_tokens': output_tokens}}, 'message_delta')
+        self.send_event({'type': 'message_stop'}, 'message_stop')
+
+    def openai(self, body: dict):
+        usage = self.state.openai_usage(body)
+        system = ''.join(_text(m['content']) for m in body['messages'] if m['role'] == 'system')
+        user = _text(body['messages'][-1]['content'])
+        text = self.state.respond(system, user, self.replay_index())
+        n = body.get('n') or 1
+        output_tokens = n * count_tokens(text)
+        usage = {**usage, 'completion_tokens': output_tokens, 'total_tokens': usage['prompt_tokens'] + output_tokens}
+        self.state.wait_first_token(usage['prompt_tokens'] - usage['prompt_tokens_details']['cached_tokens'])
+        header = {'id': f'chatcmpl-{uuid.uuid4().hex}', 'created': int(time.time()), 'model': body['model']}
+        if not body.get('stream', False):
+            self.send_json({**header, 'object': 'chat.completion', 'usage': usage, 'choices': [
+                {'index': i, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}
+                for i in range(n)]})
+            return
+        self.start_events()
+        chunk = {**header, 'object': 'chat.completion.chunk'}
+        for i in range(n):
+            self.send_event({**chunk, 'choices': [{'index': i, 'delta': {'role': 'assistant', 'content': ''},
+                                                   'finish_reason': None}]})
+        for line in text.splitlines(keepends=True):
+            for i in range(n):
+                self.send_event({**chunk, 'choices': [{'index': i, 'delta': {'content': line}, 'finish_reason': None}]})
+        for i in range(n):
+            self.send_event({**chunk, 'choices': [{'index': i, 'delta': {}, 'finish_reason': 'stop'}]})
+        if (body.get('stream_options') or {}).get('include_usage', False):
+            self.send_event({**chunk, 'choices': [], 'usage': usage})
+        self.send_event('[DONE]')
+
+
+def start_server(port: int = 0, **kwargs) -> tuple[ThreadingHTTPServer, str]:
+    # serves from a daemon thread; returns the server and its base url
+    handler = type('MockHandler', (Handler,), {'state': MockState(**kwargs)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=.05, help='seconds before the first token')
+    parser.add_argument('--prefill', type=float, default=.2, help='additional seconds per 1k uncached input tokens')
+    parser.add_argument('--replay', nargs='?', const='', default=None,
+                        help='replay recorded raw.txt files, from resources/results by default')
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of requests failing with a 429')
+    parser.add_argument('--retry-after', type=float, default=1., help='seconds, sent with the 429s')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    replay = None
+    if args.replay is not None:
+        from engine.utils.replay_client import ReplaySource
+        replay = ReplaySource(args.replay, seed=args.seed)
+    server, url = start_server(args.port, latency=args.latency, prefill=args.prefill, replay=replay,
+                               error_rate=args.error_rate, retry_after=args.retry_after, seed=args.seed)
+    print(f'[INFO] serving on {url}, use ANTHROPIC_BASE_URL={url} or OPENAI_BASE_URL={url}/v1')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -5,6 +5,13 @@ try:
 except ModuleNotFoundError:
     print("[ERROR] OpenAI package not installed. Please ignore this error if you intend to use other language models.")
 from typing import Optional
+from engine.utils.llm_cache_utils import LLMCache, cache_task
+from engine.utils.batch_utils import poll_batch
+from engine.utils.lm_utils import CodeFenceParser
+from engine.utils.rate_limit_utils import get_rate_limiter
+from engine.utils.prompt_cache_utils import openai_usage, prompt_cache_stats
+from engine.utils.image_payload_utils import (encode_images, group_images, file_digest, estimate_message_tokens,
+                                              IMAGE_FORMAT, IMAGE_QUALITY)
 from PIL import Image
 import io
 import base64
@@ -25,30 +32,17 @@ MAX_TOKENS = 16000
 
 class CodeGen:
 
-    def __init__(self, model_name=MODEL_NAME, cache="cache.json"):
+    def __init__(self, model_name=MODEL_NAME, cache="cache.json", base_url=None):
 
-        self.cache_file = cache
         self.model_name = model_name
-        self.exponential_backoff = 1
-        # Load the cache JSON file, if cache file exists. Else, cache is {}
-        if os.path.exists(self.cache_file):
-            cache = None
-            print(f'[INFO] Loading cache file from {self.cache_file}...')
-            while cache is None:
-                while os.path.exists(self.cache_file + ".tmp") or os.path.exists(self.cache_file + ".lock"):
-                    time.sleep(1)
-                try:
-                    with open(self.cache_file, "r") as f:
-                        cache = json.load(f)
-                except Exception as e:
-                    print(e)
-                    time.sleep(1)
-            print('[INFO] Loading cache done!')
-            self.cache = cache
-        else:
-            self.cache = {}
+        # shared with the other processes on the account
+        self.rate_limiter = get_rate_limiter('gpt')
+        # shared across processes; a JSON cache is migrated on first use
+        self.cache = LLMCache(cache)
+        self.cache_file = self.cache.path
 
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
+        # `base_url` defaults to $OPENAI_BASE_URL, e.g. `engine/utils/mock_llm_server.py`
+        self.client = OpenAI(api_key=OPENAI_API_KEY, base_url=base_url)
 
     def generate(self,
                  user_prompt: Optional[str],
@@ -57,8 +51,9 @@ class CodeGen:
                  num_completions=NUM_COMPLETIONS, max_tokens=MAX_TOKENS, temperature=TEMPERATURE, presence_penalty=0.0,
                  stop=None, indented=False,
                  indented_after_first_line=False, require=None, cache_key=None,
-                 rate_limit_tokens=MAX_TOKENS, verbose=False
+                 rate_limit_tokens=MAX_TOKENS, verbose=False, on_code=None
                  ):
+        # on_code(index, lines) is called as soon as a streamed completion has closed its code block
         if verbose:
             print(user_prompt)
             print("-----")
@@ -69,6 +64,110 @@ class CodeGen:
                 print(f'[ERROR] temperature must be > 0 for num_completions > 1, but got {temperature=}, {num_completions=}')
                 num_completions = 1
 
+        # images are encoded only on a cache miss
+        key_messages = self.build_messages(user_prompt, system_prompt, prepend_messages, encode=False)
+        cache_key, legacy_key = self.cache_key(key_messages, cache_key, max_tokens, temperature, stop, indented,
+                                               indented_after_first_line, require, presence_penalty)
+        cached = self.cache.get(cache_key, legacy_key=legacy_key)
+        if cached is not None:
+            if len(cached) < num_completions:
+                num_completions -= len(cached)
+                results = cached
+            else:
+                cur_implementations = cached
+                # if "shuffle_implementations" in CONSTS and CONSTS["shuffle_implementations"]:
+                #     random.shuffle(cur_implementations)
+                return None, cur_implementations[:num_completions]
+        else:
+            results = []
+
+        messages = self.build_messages(user_prompt, system_prompt, prepend_messages)
+        print(f"Calling {self.model_name} for {num_completions=}!")
+        # raise Exception("Codex is not available")
+        total_tokens = num_completions * max_tokens
+        completions_per_call = rate_limit_tokens // max_tokens
+        while total_tokens > 0:
+            num_completions = min(total_tokens // max_tokens, completions_per_call)
+            print(num_completions, "completions", max_tokens, "tokens each")
+            assert stop is None, stop
+            # charged for the full `max_tokens` until the usage is known
+            tokens = estimate_message_tokens(messages, 'gpt') + num_completions * max_tokens
+            offset = len(results)
+            completions, usage = self.rate_limiter.call(
+                lambda: self.complete(messages, max_tokens, temperature, presence_penalty, num_completions,
+                                      None if on_code is None else lambda i, lines: on_code(offset + i, lines)),
+                tokens=tokens, retry_on=(openai.RateLimitError,),
+                usage=lambda out: None if out[1] is None else out[1].total_tokens)
+            new_results = []
+            for completion in completions:
+                result = []
+                for line_idx, line in enumerate(completion.split("\n")):
+                    if (indented or (indented_after_first_line and line_idx > 0)) and line.lstrip() == line and line.strip() != "":
+                        break
+                    if require is not None and line.strip() != "" and require not in line:
+                        break
+                    result += [line]
+                new_results.append(result)
+            results.extend(new_results)
+
+            # appended as one transaction, other processes may append to the same key concurrently
+            self.cache.append(cache_key, new_results)
+            total_tokens -= num_completions * max_tokens
+        print(f'[INFO] GPT prompt cache: {prompt_cache_stats.summary()}')
+        print(f'[INFO] GPT rate limit: {self.rate_limiter.summary()}')
+        return None, results
+
+    def generate_batch(self, prompts, num_completions=NUM_COMPLETIONS, max_tokens=MAX_TOKENS, temperature=TEMPERATURE,
+                       presence_penalty=0.0, tasks=None, **kwargs):
+        """
+        Completions of many `(user_prompt, system_prompt)` prompts through the Batch API, which is cheaper and has its
+        own rate limits, for sweeps. Completions missing from the cache are submitted as one batch, and cached under
+        the same keys as `generate`, indexed by `tasks`.
+        """
+        keys = []
+        results = []
+        lines = []
+        for j, (user_prompt, system_prompt) in enumerate(prompts):
+            key_messages = self.build_messages(user_prompt, system_prompt, encode=False)
+            cache_key, legacy_key = self.cache_key(key_messages, None, max_tokens, temperature, None, False, False, None,
+                                                   presence_penalty)
+            with cache_task(None if tasks is None else tasks[j]):  # hits are indexed under the task too
+                cached = self.cache.get(cache_key, legacy_key=legacy_key) or []
+            keys.append(cache_key)
+            results.append(cached[:num_completions])
+            if len(cached) >= num_completions:
+                continue
+            messages = self.build_messages(user_prompt, system_prompt)
+            body = dict(model=self.model_name, messages=messages, max_tokens=max_tokens, temperature=temperature,
+                        presence_penalty=presence_penalty, n=num_completions - len(cached))
+            lines.append(json.dumps({'custom_id': str(j), 'method': 'POST', 'url': '/v1/chat/completions', 'body': body}))
+        print(f'[INFO] GPT: {len(lines)} of {len(prompts)} prompts missing completions in the cache')
+        if len(lines) == 0:
+            return results
+
+        input_file = self.client.files.create(file=io.BytesIO('\n'.join(lines).encode()), purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint='/v1/chat/completions',
+                                           completion_window='24h')
+        batch = poll_batch(lambda: self.client.batches.retrieve(batch.id),
+                           lambda batch: batch.status in ['completed', 'failed', 'expired', 'cancelled'],
+                           lambda batch: f'{batch.id}: {batch.status}, {batch.request_counts}')
+        if batch.output_file_id is None:
+            print(f'[ERROR] GPT: batch {batch.id} {batch.status}, {batch.errors}')
+            return results
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            output = json.loads(line)
+            j = int(output['custom_id'])
+            if output.get('error') is not None or output['response']['status_code'] != 200:
+                print(f'[ERROR] GPT: batch request {j}: {output.get("error") or output["response"]["body"]}')
+                continue
+            completions = [choice['message']['content'].split('\n') for choice in output['response']['body']['choices']]
+            with cache_task(None if tasks is None else tasks[j]):
+                self.cache.append(keys[j], completions)
+            results[j] = results[j] + completions
+        return results
+
+    def build_messages(self, user_prompt, system_prompt, prepend_messages=None, encode=True):
+        # `encode=False`: local images by the digests of their files instead of their payloads, for cache keys
         messages = []
         if system_prompt is not None:
             messages = messages + [{"role": "system", "content": system_prompt}]
@@ -81,20 +180,33 @@ class CodeGen:
         assert all(messages[i]['role'] == 'assistant' for i in range(2, len(messages), 2)), messages
         assert messages[-1]['role'] == 'user', messages[-1]
 
-        for message in messages:
+        for i, message in enumerate(messages):
             if isinstance(message['content'], list):
-                for content_item in message['content']:
-                    if content_item['type'] == 'image_url' and os.path.exists(content_item['image_url']):
+                # new messages, the prompts of the caller are reused across calls
+                content = []
+                for item in group_images(message['content']):
+                    if isinstance(item, list) and not encode:
+                        item = {'type': 'image_url', 'image_url': {
+                            'digests': [file_digest(path) for path in item],
+                            'format': IMAGE_FORMAT, 'quality': IMAGE_QUALITY,
+                            'detail': 'low',
+                        }}
+                    elif isinstance(item, list):
                         assert message['role'] == 'user', message
-                        image = content_item['image_url']
-                        base64_image = encode_image(image)
-                        content_item['image_url'] = {
-                            "url": f"data:image/png;base64,{base64_image}",
+                        media_type, base64_image = encode_images(item, 'gpt')
+                        item = {'type': 'image_url', 'image_url': {
+                            "url": f"data:{media_type};base64,{base64_image}",
                             'detail': 'low',
-                        }
+                        }}
+                    content.append(item)
+                messages[i] = {**message, 'content': content}
             else:
                 assert isinstance(message['content'], str)
+        return messages
 
+    def cache_key(self, messages, cache_key, max_tokens, temperature, stop, indented, indented_after_first_line,
+                  require, presence_penalty):
+        # the key, and a function building the key used before `LLMCache.make_key`
         if cache_key is not None:
             cache_key_base = cache_key
         else:
@@ -103,80 +215,51 @@ class CodeGen:
         cache_key_list = (cache_key_base, max_tokens, temperature, stop, indented, indented_after_first_line, require)
         if presence_penalty != 0.0:
             cache_key_list = cache_key_list + (presence_penalty,)
-        cache_key = str(cache_key_list)
-        if cache_key in self.cache:
-            if len(self.cache[cache_key]) < num_completions:
-                num_completions -= len(self.cache[cache_key])
-                results = self.cache[cache_key]
-            else:
-                cur_implementations = self.cache[cache_key].copy()
-                # if "shuffle_implementations" in CONSTS and CONSTS["shuffle_implementations"]:
-                #     random.shuffle(cur_implementations)
-                return None, cur_implementations[:num_completions]
+        params = dict(max_tokens=max_tokens, temperature=temperature, stop=stop, indented=indented,
+                      indented_after_first_line=indented_after_first_line, require=require,
+                      presence_penalty=presence_penalty)
+        if cache_key is not None:
+            cache_key = self.cache.make_key(self.model_name, None, cache_key, **params)
         else:
-            results = []
+            cache_key = self.cache.make_key(self.model_name, messages[0]['content'], messages[1:], **params)
+        return cache_key, lambda: str(cache_key_list)
 
-        print(f"Calling {self.model_name} for {num_completions=}!")
-        # raise Exception("Codex is not available")
-        total_tokens = num_completions * max_tokens
-        completions_per_call = rate_limit_tokens // max_tokens
-        while total_tokens > 0:
-            num_completions = min(total_tokens // max_tokens, completions_per_call)
-            print(num_completions, "completions", max_tokens, "tokens each")
-            while True:
-                try:
-                    time.sleep(8)
-                    assert stop is None, stop
-                    completions = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=messages,
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                        presence_penalty=presence_penalty,
-                        # stop=stop,  # otherwise it errors with vision inputs for unknown reasons
-                        n=num_completions,
-                    ).choices
-                    self.exponential_backoff = 1
-                    break
-                except openai.RateLimitError:
-                    import traceback; traceback.print_exc()
-                    import ipdb; ipdb.set_trace()
-                    print("Rate limit reached. Waiting before retrying...")
-                    time.sleep(16 * self.exponential_backoff)
-                    self.exponential_backoff *= 2
-            for completion in completions:
-                result = []
-                for line_idx, line in enumerate(completion.message.content.split("\n")):
-                    if (indented or (indented_after_first_line and line_idx > 0)) and line.lstrip() == line and line.strip() != "":
-                        break
-                    if require is not None and line.strip() != "" and require not in line:
-                        break
-                    result += [line]
-                results.append(result)
-
-            # Save updated cache - reopen in case multiple processes running
-            # Save to a temp file first, then rename
-            # Check if a temp file exists, and if so, wait for it to be deleted
-            while os.path.exists(self.cache_file + ".tmp") or os.path.exists(self.cache_file + ".lock"):
-                time.sleep(0.1)
-            # create an empty file to indicate that we are writing to the cache
-            with open(self.cache_file + ".lock", "w") as f:
-                pass
-            if os.path.exists(self.cache_file):
-                with open(self.cache_file, "r") as f:
-                    self.cache = json.load(f)
-            self.cache[cache_key] = results
-            with open(self.cache_file + ".tmp", "w") as f:
-                json.dump(self.cache, f)
-            os.rename(self.cache_file + ".tmp", self.cache_file)
-            os.remove(self.cache_file + ".lock")
-            total_tokens -= num_completions * max_tokens
-        return None, results
+    def complete(self, messages, max_tokens, temperature, presence_penalty, n, on_code=None) -> tuple[list[str], Optional[object]]:
+        # streamed to measure the time to first token; the static system prompt and examples come first in
+        # `messages`, so that they are a prefix the API caches automatically
+        start = time.time()
+        ttft = None
+        usage = None
+        contents = [''] * n
+        parsers = [CodeFenceParser() for _ in range(n)]
+        for chunk in self.client.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            presence_penalty=presence_penalty,
+            # stop=stop,  # otherwise it errors with vision inputs for unknown reasons
+            n=n,
+            stream=True,
+            stream_options={"include_usage": True},
+        ):
+            if chunk.usage is not None:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    if ttft is None:
+                        ttft = time.time() - start
+                    contents[choice.index] += choice.delta.content
+                    if on_code is not None and (lines := parsers[choice.index].feed(choice.delta.content)) is not None:
+                        on_code(choice.index, lines)
+        if usage is not None:
+            print(f'[INFO] GPT prompt cache: {prompt_cache_stats.record(*openai_usage(usage), ttft)}')
+        return contents, usage
 
 
 def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    # base64 of the downsized and re-encoded image, see `image_payload_utils`
+    return encode_images([image_path], 'gpt')[1]
 
 
 def setup_gpt():
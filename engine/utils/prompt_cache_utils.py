@@ -0,0 +1,98 @@
+import os
+import threading
+from typing import Optional
+
+# mark the static system prompt and in-context examples as cacheable prompt prefixes
+PROMPT_CACHE: bool = os.environ.get('PROMPT_CACHE', '1') == '1'
+# the in-context examples of `get_user_prompt` end with this line; only the task comes after
+EXAMPLE_END = 'THE FUNCTIONS ABOVE ARE JUST EXAMPLES, YOU CANNOT USE THEM IN YOUR PROGRAM!'
+
+
+def split_examples(text: str) -> list[str]:
+    # [examples, rest] if `text` starts with in-context examples, otherwise [text]
+    ind = text.find(EXAMPLE_END)
+    if ind < 0:
+        return [text]
+    ind += len(EXAMPLE_END)
+    return [text[:ind], text[ind:]]
+
+
+def claude_system(system_prompt: Optional[str]):
+    if not PROMPT_CACHE or not system_prompt:
+        return system_prompt
+    return [{'type': 'text', 'text': system_prompt, 'cache_control': {'type': 'ephemeral'}}]
+
+
+def claude_content(content: list[dict]) -> list[dict]:
+    # splits the first text block after the examples, which are marked as the second cache breakpoint (of 4 allowed)
+    if not PROMPT_CACHE:
+        return content
+    for i, item in enumerate(content):
+        if item['type'] != 'text':
+            continue
+        parts = split_examples(item['text'])
+        if len(parts) == 1:
+            return content
+        prefix = {'type': 'text', 'text': parts[0], 'cache_control': {'type': 'ephemeral'}}
+        rest = [{'type': 'text', 'text': parts[1]}] if parts[1].strip() != '' else []
+        return content[:i] + [prefix] + rest + content[i + 1:]
+    return content
+
+
+def claude_usage(usage) -> tuple[int, int, int]:
+    # (cache read, cache write, uncached) input tokens
+    return (getattr(usage, 'cache_read_input_tokens', None) or 0,
+            getattr(usage, 'cache_creation_input_tokens', None) or 0,
+            usage.input_tokens)
+
+
+def openai_usage(usage) -> tuple[int, int, int]:
+    # prefixes of >= 1024 tokens are cached automatically; there is no separate write accounting
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+    return cached, 0, usage.prompt_tokens - cached
+
+
+class PromptCacheStats:
+    """
+    Cached vs. uncached input tokens and time to first token (TTFT) of the requests of a process, split by whether the
+    request read from the provider's prompt cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.hits = 0
+        self.cache_read = 0
+        self.cache_write = 0
+        self.uncached = 0
+        self.ttft = {True: [], False: []}
+
+    def record(self, cache_read: int, cache_write: int, uncached: int, ttft: Optional[float]) -> str:
+        with self.lock:
+            self.calls += 1
+            self.hits += cache_read > 0
+            self.cache_read += cache_read
+            self.cache_write += cache_write
+            self.uncached += uncached
+            if ttft is not None:
+                self.ttft[cache_read > 0].append(ttft)
+        ttft = 'n/a' if ttft is None else f'{ttft:.2f}s'
+        return f'cache read {cache_read}, cache write {cache_write}, uncached {uncached} input tokens, TTFT {ttft}'
+
+    def summary(self) -> str:
+        with self.lock:
+            total = self.cache_read + self.cache_write + self.uncached
+            s = (f'{self.hits}/{self.calls} requests hit the prompt cache, '
+                 f'{self.cache_read}/{total} input tokens read from cache, {self.cache_write} written')
+            if len(self.ttft[True]) > 0 and len(self.ttft[False]) > 0:
+                hit = sum(self.ttft[True]) / len(self.ttft[True])
+                miss = sum(self.ttft[False]) / len(self.ttft[False])
+                s += f', mean TTFT {hit:.2f}s on hits vs. {miss:.2f}s on misses ({miss - hit:.2f}s saved per hit)'
+        return s
+
+
+prompt_cache_stats = PromptCacheStats()
@@ -0,0 +1,230 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+from engine.constants import PROJ_DIR
+
+# shared by all processes of the machine (or of the cluster, on a shared filesystem) that use the same account
+RATE_LIMIT_DB: str = os.environ.get('RATE_LIMIT_DB', (Path(PROJ_DIR) / 'cache' / 'rate_limit.db').as_posix())
+# (requests per minute, tokens per minute); 0 for unlimited
+RATE_LIMITS: dict[str, tuple[float, float]] = {
+    'claude': (float(os.environ.get('CLAUDE_RPM', 50)), float(os.environ.get('CLAUDE_TPM', 80000))),
+    'gpt': (float(os.environ.get('GPT_RPM', 500)), float(os.environ.get('GPT_TPM', 300000))),
+}
+BACKOFF_BASE: float = 2
+BACKOFF_CAP: float = 120
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    # seconds suggested by the server, from the headers of a rate limit error
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is None:
+        return None
+    for name, scale in [('retry-after-ms', 1e-3), ('retry-after', 1)]:
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+class Backoff:
+    # full jitter: uniform in [0, min(cap, base * 2 ** attempt)], back to attempt 0 on success
+    def __init__(self, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self) -> float:
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, shared across processes through a SQLite database. Each bucket
+    holds up to one minute of its limit and refills continuously. A retry-after from the server pauses all processes.
+    Without limits the database is never used. Use `get_rate_limiter` for one limiter per name in a process.
+    """
+
+    def __init__(self, name: str, rpm: Optional[float] = None, tpm: Optional[float] = None, path: str = RATE_LIMIT_DB):
+        default_rpm, default_tpm = RATE_LIMITS.get(name, (0, 0))
+        self.name = name
+        self.rpm = default_rpm if rpm is None else rpm
+        self.tpm = default_tpm if tpm is None else tpm
+        self.path = path
+        self._local = threading.local()
+        self.lock = threading.Lock()
+        # metrics of this process
+        self.requests = 0
+        self.rate_limit_errors = 0
+        self.throttled = 0.  # seconds waiting for the buckets
+        self.backed_off = 0.  # seconds waiting after rate limit errors
+        self.paused_until = 0.  # without limits, pauses only apply to this process
+        if not self.unlimited:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._connect().execute('CREATE TABLE IF NOT EXISTS buckets ('
+                                    'name TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL, paused_until REAL)')
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _update(self, fn: Callable[[float, float, float, float], tuple]):
+        # fn(requests, tokens, paused_until, now) -> (requests, tokens, paused_until, out), applied atomically
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT requests, tokens, updated, paused_until FROM buckets WHERE name = ?',
+                               (self.name,)).fetchone()
+            if row is None:
+                requests, tokens, paused_until = self.rpm, self.tpm, 0.
+            else:
+                requests, tokens, updated, paused_until = row
+                elapsed = max(0., now - updated)
+                requests = min(self.rpm, requests + elapsed * self.rpm / 60)
+                tokens = min(self.tpm, tokens + elapsed * self.tpm / 60)
+            requests, tokens, paused_until, out = fn(requests, tokens, paused_until, now)
+            conn.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)',
+                         (self.name, requests, tokens, now, paused_until))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return out
+
+    def acquire(self, tokens: int = 0) -> int:
+        # blocks until a request of `tokens` tokens fits in the limits; returns the tokens charged, see `settle`
+        tokens = min(tokens, self.tpm)  # larger requests would never fit
+
+        def fn(requests, available, paused_until, now):
+            wait = paused_until - now
+            if self.rpm > 0 and requests < 1:
+                wait = max(wait, (1 - requests) * 60 / self.rpm)
+            if self.tpm > 0 and available < tokens:
+                wait = max(wait, (tokens - available) * 60 / self.tpm)
+            if wait > 0:
+                return requests, available, paused_until, wait
+            return requests - (self.rpm > 0), available - tokens * (self.tpm > 0), paused_until, 0.
+
+        start = time.time()
+        if self.unlimited:
+            time.sleep(max(0., self.paused_until - start))
+        else:
+            while (wait := self._update(fn)) > 0:
+                time.sleep(wait + random.uniform(0, .1))  # jitter, so that waiting processes don't wake up together
+        waited = time.time() - start
+        with self.lock:
+            self.requests += 1
+            self.throttled += waited
+        return tokens if self.tpm > 0 else 0
+
+    def settle(self, charged: int, actual: int):
+        # charges the difference between the tokens charged by `acquire` and the reported token usage
+        if self.tpm > 0 and actual != charged:
+            self._update(lambda requests, tokens, paused_until, now: (requests, tokens + charged - actual, paused_until, None))
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rpm <= 0 and self.tpm <= 0
+
+    def pause(self, seconds: float):
+        # all processes wait `seconds` before their next request, or only this one without limits
+        if self.unlimited:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.time() + seconds)
+            return
+        self._update(lambda requests, tokens, paused_until, now: (requests, tokens, max(paused_until, now + seconds), None))
+
+    def call(self, fn: Callable, tokens: int = 0, retry_on: tuple = (), usage: Optional[Callable] = None):
+        # fn() within the limits, retrying on `retry_on` errors; `usage(result)` is the reported token usage (or None),
+        # settled against what was charged for `tokens`
+        backoff = Backoff()
+        while True:
+            charged = self.acquire(tokens)
+            try:
+                result = fn()
+                if usage is not None and (actual := usage(result)) is not None:
+                    self.settle(charged, actual)
+                return result
+            except retry_on as e:
+                self.settle(charged, 0)  # a rejected request uses no tokens
+                hint = retry_after(e)
+                delay = backoff.next() if hint is None else hint + random.uniform(0, 1)
+                with self.lock:
+                    self.rate_limit_errors += 1
+                print(f'[WARNING] {self.name}: rate limit reached, retrying in {delay:.1f}s '
+                      f'({"server hint" if hint is not None else f"attempt {backoff.attempt}"})')
+                if hint is not None:
+                    self.pause(delay)  # waited for in `acquire`, i.e. counted as throttled
+                else:
+                    time.sleep(delay)
+                    with self.lock:
+                        self.backed_off += delay
+
+    def summary(self) -> str:
+        with self.lock:
+            return (f'{self.requests} requests, {self.throttled:.1f}s throttled, '
+                    f'{self.rate_limit_errors} rate limit errors, {self.backed_off:.1f}s backed off')
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str) -> RateLimiter:
+    # one limiter per name in a process, shared by all clients, so that metrics and pauses are not reset per client
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name)
+        return _limiters[name]
+
+
+def _benchmark_worker(path: str, rpm: float, num_requests: int) -> str:
+    limiter = RateLimiter('benchmark', rpm=rpm, tpm=0, path=path)
+    for _ in range(num_requests):
+        limiter.acquire()
+    return limiter.summary()
+
+
+if __name__ == "__main__":
+    # requests of several processes stay within the limit
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rpm', type=float, default=120)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=10, help='per process')
+    args = parser.parse_args()
+
+    db = (Path(PROJ_DIR) / 'cache' / 'rate_limit_benchmark.db').as_posix()
+    for suffix in ['', '-wal', '-shm']:
+        Path(db + suffix).unlink(missing_ok=True)
+
+    start = time.time()
+    with ProcessPoolExecutor(args.processes) as executor:
+        futures = [executor.submit(_benchmark_worker, db, args.rpm, args.requests) for _ in range(args.processes)]
+        for future in futures:
+            print(f'[INFO] {future.result()}')
+    total = args.processes * args.requests
+    # the first minute's worth of requests is the burst
+    print(f'[INFO] {total} requests in {time.time() - start:.1f}s, '
+          f'expected >= {max(0, total - args.rpm) * 60 / args.rpm:.1f}s')
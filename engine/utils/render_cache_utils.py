@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import re
+import uuid
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Callable, Optional, Union
+import numpy as np
+import mitsuba as mi
+from engine.constants import PROJ_DIR
+
+RENDER_CACHE: bool = os.environ.get('RENDER_CACHE', '1') == '1'
+RENDER_CACHE_DIR: str = os.environ.get('RENDER_CACHE_DIR', (Path(PROJ_DIR) / 'cache' / 'render').as_posix())
+RENDER_CACHE_MAX_BYTES: int = int(float(os.environ.get('RENDER_CACHE_MAX_GB', 4)) * 2 ** 30)
+SMALL_FILE_BYTES = 2 ** 20
+
+
+def _canonicalize(v, key: Optional[str] = None, exact: bool = False):
+    # `exact`: numbers by their exact bytes instead of rounded, for results that must not be shared by nearby scenes
+    if isinstance(v, dict):
+        return {k: _canonicalize(vv, key=k, exact=exact) for k, vv in sorted(v.items()) if k != 'info'}
+    if isinstance(v, (list, tuple)):
+        return [_canonicalize(vv, exact=exact) for vv in v]
+    if isinstance(v, str):
+        if key == 'filename' and os.path.exists(v):
+            # content may change under the same path; small files (e.g. curves) are hashed by content, so that
+            # the same content under a different temporary path is still a hit
+            stat = os.stat(v)
+            if stat.st_size <= SMALL_FILE_BYTES:
+                with open(v, 'rb') as f:
+                    return hashlib.sha256(f.read()).hexdigest()
+            return [Path(v).resolve().as_posix(), stat.st_mtime_ns, stat.st_size]
+        return v
+    if isinstance(v, bool) or v is None:
+        return v
+    if isinstance(v, (int, float, np.number)):
+        return float(v).hex() if exact else round(float(v), 6)
+    if hasattr(v, 'matrix'):  # mi.Transform4f
+        v = v.matrix
+    try:
+        arr = np.asarray(v, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise TypeError(f'cannot hash {type(v)}')
+    if exact:
+        return [list(arr.shape), hashlib.sha256(np.ascontiguousarray(arr).tobytes()).hexdigest()]
+    return [round(float(vv), 6) for vv in arr.ravel()]
+
+
+def hash_scene(obj, verbose: bool = True, exact: bool = False) -> Optional[str]:
+    # canonical hash of a (preprocessed) scene dict or shape; `None` if it holds objects that can't be hashed by value
+    try:
+        s = json.dumps(_canonicalize(obj, exact=exact), sort_keys=True)
+    except TypeError as e:
+        if verbose:
+            print(f'[INFO] render cache: scene is not hashable, {e}')
+        return None
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def xml_dependencies(xml_path: str) -> list[dict]:
+    """
+    The scene xml and every file it references (meshes, textures, included xmls), as `filename` entries of a scene
+    key, so that the key changes when any of them does and not only when the xml does.
+    """
+    files = [Path(xml_path).resolve().as_posix()]
+    i = 0
+    while i < len(files):
+        path = files[i]
+        i += 1
+        if not path.endswith('.xml') or not os.path.exists(path):
+            continue
+        root = ET.parse(path).getroot()
+        defaults = {e.get('name'): e.get('value') for e in root.iter('default')}
+        for e in root.iter():
+            if e.tag == 'include':
+                filename = e.get('filename')
+            elif e.tag == 'string' and e.get('name') == 'filename':
+                filename = e.get('value')
+            else:
+                continue
+            for name, value in defaults.items():
+                filename = filename.replace(f'${name}', value)
+            filename = (Path(path).parent / filename).resolve().as_posix()
+            if filename not in files:
+                files.append(filename)
+    return [{'filename': filename} for filename in files]
+
+
+def sensor_params(sensor: mi.Sensor) -> dict:
+    params = mi.traverse(sensor)
+    film = sensor.film()
+    # not exposed as a parameter; e.g. an rgb film renders fewer channels than an rgba one
+    pixel_format = re.search(r'pixel_format\s*=\s*"?(\w+)', str(film))
+    return {
+        'to_world': np.asarray(params['to_world'].matrix).reshape(4, 4),
+        'x_fov': np.asarray(params['x_fov']).item(),
+        'film.size': np.asarray(params['film.size']).ravel(),
+        'film.crop_offset': np.asarray(film.crop_offset()).ravel(),
+        'film.crop_size': np.asarray(film.crop_size()).ravel(),
+        'film.rfilter': film.rfilter().class_().name(),
+        'film.pixel_format': None if pixel_format is None else pixel_format.group(1),
+        'class': sensor.class_().name(),
+    }
+
+
+class RenderCache:
+    """
+    On-disk cache of `mi.render` outputs keyed by scene hash, sensor parameters, spp and Mitsuba version.
+    Entries are evicted least-recently-used first once the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str = RENDER_CACHE_DIR, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = sum(p.stat().st_size for p in self.cache_dir.glob('*/*.npy'))
+
+    def make_key(self, scene_key: Optional[str], sensor: Union[mi.Sensor, int], spp: Optional[int],
+                 seed: int = 0) -> Optional[str]:
+        if scene_key is None:
+            return None
+        key = {
+            'scene': scene_key,
+            'sensor': sensor if isinstance(sensor, int) else sensor_params(sensor),
+            'spp': spp,
+            'mitsuba': mi.__version__,
+            'variant': mi.variant(),
+        }
+        if seed != 0:
+            key['seed'] = seed
+        return hash_scene(key)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f'{key}.npy'
+
+    def get(self, key: Optional[str]) -> Optional[np.ndarray]:
+        if key is None:
+            return None
+        path = self._path(key)
+        try:
+            image = np.load(path.as_posix())
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        os.utime(path.as_posix())  # mark as recently used
+        self.hits += 1
+        return image
+
+    def put(self, key: Optional[str], image: np.ndarray):
+        if key is None:
+            return
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f'{path.stem}_{uuid.uuid4()}.tmp')
+        with open(tmp_path.as_posix(), 'wb') as f:
+            np.save(f, image)
+        os.replace(tmp_path.as_posix(), path.as_posix())  # atomic, other processes never see partial entries
+        self.size_bytes += path.stat().st_size
+        if self.size_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for p in self.cache_dir.glob('*/*.npy'):
+            try:
+                stat = p.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, p))
+        entries.sort(key=lambda x: x[0])
+        self.size_bytes = sum(size for _, size, _ in entries)
+        target = self.max_bytes * .9
+        for _, size, p in entries:
+            if self.size_bytes <= target:
+                break
+            p.unlink(missing_ok=True)
+            self.size_bytes -= size
+            self.evictions += 1
+
+    def render(self, scene: Union[mi.Scene, Callable[[], mi.Scene]], scene_key: Optional[str],
+               sensor: Union[mi.Sensor, int] = 0, spp: Optional[int] = None, seed: int = 0,
+               render_fn: Optional[Callable[[], np.ndarray]] = None) -> np.ndarray:
+        # `scene` may be a callable so that the scene is only loaded on a cache miss;
+        # `render_fn` renders on a miss instead of `mi.render`, e.g. tiled across processes
+        key = self.make_key(scene_key, sensor, spp, seed=seed)
+        image = self.get(key)
+        if image is not None:
+            return image
+        if render_fn is not None:
+            image = render_fn()
+            self.put(key, image)
+            return image
+        if callable(scene):
+            scene = scene()
+        image = np.asarray(mi.render(scene, sensor=sensor, spp=0 if spp is None else spp, seed=seed))
+        self.put(key, image)
+        return image
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.,
+                'evictions': self.evictions, 'size_mb': self.size_bytes / 2 ** 20}
+
+    def print_stats(self):
+        print('[INFO] render cache:', ', '.join(f'{k}={v:.2f}' if isinstance(v, float) else f'{k}={v}'
+                                                  for k, v in self.stats().items()))
+
+
+_render_cache: Optional[RenderCache] = None
+
+
+def get_render_cache() -> Optional[RenderCache]:
+    global _render_cache
+    if not RENDER_CACHE:
+        return None
+    if _render_cache is None:
+        _render_cache = RenderCache()
+    return _render_cache
+
+
+def cached_render(scene: Union[mi.Scene, Callable[[], mi.Scene]], scene_key: Optional[str],
+                  sensor: Union[mi.Sensor, int] = 0, spp: Optional[int] = None, seed: int = 0,
+                  render_fn: Optional[Callable[[], np.ndarray]] = None) -> np.ndarray:
+    cache = get_render_cache()
+    if cache is None:
+        if render_fn is not None:
+            return render_fn()
+        if callable(scene):
+            scene = scene()
+        return np.asarray(mi.render(scene, sensor=sensor, spp=0 if spp is None else spp, seed=seed))
+    return cache.render(scene, scene_key=scene_key, sensor=sensor, spp=spp, seed=seed, render_fn=render_fn)
@@ -0,0 +1,177 @@
+"""
+Stand-in for the LLM clients that replays recorded responses, for end-to-end throughput benchmarks without API calls.
+Completion `i` of a prompt is always the same recorded response. Responses are either read from `raw.txt` files
+directly, or requested from `mock_llm_server.py --replay` over HTTP in the Anthropic wire format.
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+from engine.constants import PROJ_DIR, ENGINE_MODE, MAX_TOKENS, TEMPERATURE, NUM_COMPLETIONS
+from engine.utils.rate_limit_utils import get_rate_limiter
+from engine.utils.batch_utils import poll_batch
+
+# a directory of recorded `raw.txt` files, or the url of `mock_llm_server.py`; defaults to `resources/results`
+REPLAY_SOURCE: str = os.environ.get('REPLAY_SOURCE', '')
+REPLAY_LATENCY: float = float(os.environ.get('REPLAY_LATENCY', 0))  # seconds per completion
+REPLAY_ERROR_RATE: float = float(os.environ.get('REPLAY_ERROR_RATE', 0))  # fraction of requests failing with a rate limit error
+REPLAY_SEED: int = int(os.environ.get('REPLAY_SEED', 0))
+REPLAY_MAX_IN_FLIGHT: int = int(os.environ.get('REPLAY_MAX_IN_FLIGHT', 4))
+
+
+class ReplayRateLimitError(Exception):
+    # injected; `response.headers` is read like those of the API errors
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__('injected rate limit error')
+        self.response = SimpleNamespace(headers={} if retry_after is None else {'retry-after': str(retry_after)})
+
+
+def is_critic_prompt(system_prompt: Optional[str]) -> bool:
+    # see `run_utils.get_system_prompt`
+    return system_prompt is not None and 'You are a code critic' in system_prompt[:200]
+
+
+def prompt_text(prompt) -> str:
+    if prompt is None or isinstance(prompt, str):
+        return prompt or ''
+    return json.dumps(prompt, sort_keys=True)
+
+
+class ReplaySource:
+    """
+    Recorded responses, split into programs and critiques. By default, programs of the current engine mode, i.e.
+    `resources/results/minecraft` for minecraft and the others otherwise, and the critiques of all engine modes.
+    """
+
+    def __init__(self, source: Optional[str] = None, engine_mode: str = ENGINE_MODE, seed: int = REPLAY_SEED):
+        results = Path(PROJ_DIR) / 'resources' / 'results'
+        if source:
+            paths = sorted(Path(source).rglob('raw.txt'))
+        else:
+            paths = sorted(p for p in results.rglob('raw.txt')
+                           if (p.relative_to(results).parts[0] == 'minecraft') == (engine_mode == 'minecraft')
+                           or p.parent.parent.name.endswith('_critic'))
+        self.programs = []
+        self.critiques = []
+        for path in paths:
+            with open(path, 'r') as f:
+                lines = f.read().split('\n')
+            # critiques may quote code, so recorded critic responses are told apart by their directory
+            is_critique = path.parent.parent.name.endswith('_critic') or '```python' not in [line.rstrip() for line in lines]
+            (self.critiques if is_critique else self.programs).append(lines)
+        if len(self.programs) == 0:
+            raise RuntimeError(f'no recorded programs in {source or results}')
+        self.seed = seed
+        print(f'[INFO] replaying {len(self.programs)} programs and {len(self.critiques)} critiques')
+
+    def sample(self, system_prompt, user_prompt, index: int) -> list[str]:
+        pool = self.critiques if is_critic_prompt(system_prompt) and len(self.critiques) > 0 else self.programs
+        key = json.dumps([self.seed, prompt_text(system_prompt), prompt_text(user_prompt), index])
+        return pool[int(hashlib.sha256(key.encode()).hexdigest(), 16) % len(pool)]
+
+
+class ReplayClient:
+    def __init__(self, source: str = REPLAY_SOURCE, latency: float = REPLAY_LATENCY, error_rate: float = REPLAY_ERROR_RATE,
+                 seed: int = REPLAY_SEED, max_in_flight: int = REPLAY_MAX_IN_FLIGHT):
+        self.url = source.rstrip('/') if source.startswith('http') else None
+        self.source = None if self.url is not None else ReplaySource(source, seed=seed)
+        self.model_name = 'replay'
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_in_flight = max_in_flight
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # unlimited, but retries the injected errors like the real clients
+        self.rate_limiter = get_rate_limiter('replay')
+
+    def generate(self, user_prompt, system_prompt, prepend_messages=None, max_tokens=MAX_TOKENS,
+                 temperature=TEMPERATURE, stop_sequences=None, num_completions=NUM_COMPLETIONS,
+                 skip_cache_completions=0, skip_cache=False, on_code=None, **kwargs):
+        # same interface as `ClaudeClient.generate`; nothing is cached, replays are deterministic anyway
+        if prepend_messages is not None:
+            user_prompt = [*prepend_messages, user_prompt]
+        print(f'[INFO] Replay: querying for {num_completions=}, {skip_cache_completions=}')
+
+        def complete(i: int) -> list[str]:
+            lines = self.rate_limiter.call(
+                lambda: self.complete(system_prompt, user_prompt, skip_cache_completions + i, max_tokens, temperature),
+                retry_on=(ReplayRateLimitError,))
+            if on_code is not None:
+                on_code(i, lines)
+            return lines
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_in_flight, num_completions))) as executor:
+            results = list(executor.map(complete, range(num_completions)))
+        print(f'[INFO] Replay rate limit: {self.rate_limiter.summary()}')
+        return None, results
+
+    def generate_batch(self, prompts, num_completions=NUM_COMPLETIONS, max_tokens=MAX_TOKENS, temperature=TEMPERATURE,
+                       poll_interval: float = 1, **kwargs):
+        # emulates the provider batch endpoints with a local queue, drained by `max_in_flight` workers in the background
+        def complete(j: int, i: int) -> list[str]:
+            user_prompt, system_prompt = prompts[j]
+            return self.rate_limiter.call(lambda: self.complete(system_prompt, user_prompt, i, max_tokens, temperature),
+                                          retry_on=(ReplayRateLimitError,))
+
+        executor = ThreadPoolExecutor(max_workers=max(1, self.max_in_flight))
+        futures = [[executor.submit(complete, j, i) for i in range(num_completions)] for j in range(len(prompts))]
+        poll_batch(lambda: sum(future.done() for f in futures for future in f),
+                   lambda done: done == len(prompts) * num_completions,
+                   lambda done: f'replay: {done}/{len(prompts) * num_completions} completions', interval=poll_interval)
+        executor.shutdown()
+        return [[future.result() for future in f] for f in futures]
+
+    def complete(self, system_prompt, user_prompt, index: int, max_tokens: int, temperature: float) -> list[str]:
+        if self.url is not None:
+            return self.request(system_prompt, user_prompt, index, max_tokens, temperature)
+        with self.lock:
+            fail = self.rng.random() < self.error_rate
+        time.sleep(self.latency)
+        if fail:
+            raise ReplayRateLimitError()
+        return self.source.sample(system_prompt, user_prompt, index)
+
+    def request(self, system_prompt, user_prompt, index: int, max_tokens: int, temperature: float) -> list[str]:
+        # images are replaced by their paths, the mock only hashes the prompt
+        content = prompt_text(user_prompt)
+        body = {'model': self.model_name, 'system': system_prompt or '', 'max_tokens': max_tokens,
+                'temperature': temperature, 'messages': [{'role': 'user', 'content': content}]}
+        request = urllib.request.Request(f'{self.url}/v1/messages', json.dumps(body).encode(),
+                                         {'Content-Type': 'application/json', 'anthropic-version': '2023-06-01',
+                                          'x-replay-index': str(index)})
+        try:
+            with urllib.request.urlopen(request) as response:
+                message = json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 429:
+                raise ReplayRateLimitError(float(e.headers.get('retry-after', 0)) or None)
+            raise
+        return ''.join(block['text'] for block in message['content']).split('\n')
+
+
+_client: Optional[ReplayClient] = None
+_client_lock = threading.Lock()
+
+
+def setup_replay() -> ReplayClient:
+    # one client per process, so that recorded responses are scanned once
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ReplayClient()
+    return _client
+
+
+if __name__ == "__main__":
+    model = setup_replay()
+    _, results = model.generate('a chair', 'You are a code completion model', num_completions=2)
+    for result in results:
+        print('\n'.join(result[:10]))
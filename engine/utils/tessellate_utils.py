@@ -0,0 +1,309 @@
+import json
+import os
+import time
+from typing import Optional, Union
+import numpy as np
+import mitsuba as mi
+
+# primitives that can be baked into a triangle mesh; everything else (ply, curves, emitters, ...) is kept as is
+TESSELLATED_TYPES = ['cube', 'sphere', 'cylinder']
+MERGEABLE_KEYS = {'type', 'to_world', 'bsdf', 'p0', 'p1', 'radius', 'center'}
+
+SPHERE_RESOLUTION = (16, 32)  # (latitude, longitude)
+CYLINDER_RESOLUTION = 32
+
+# level of detail: primitives smaller than `LOD_PIXELS` (projected diameter) in every view become coarse proxy meshes,
+# and those smaller than `LOD_PIXELS * LOD_CULL_RATIO` are dropped; 0 disables, larger values trade quality for speed
+LOD_PIXELS: float = float(os.environ.get('LOD_PIXELS', 0))
+LOD_CULL_RATIO = .1
+LOD_SPHERE_RESOLUTION = (4, 8)
+LOD_CYLINDER_RESOLUTION = 6
+
+
+def _to_matrix(to_world) -> np.ndarray:
+    if to_world is None:
+        return np.eye(4)
+    if hasattr(to_world, 'matrix'):
+        to_world = to_world.matrix
+    return np.asarray(to_world, dtype=np.float64).reshape(4, 4)
+
+
+def _to_jsonable(v):
+    if isinstance(v, dict):
+        return {k: _to_jsonable(vv) for k, vv in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_to_jsonable(vv) for vv in v]
+    if isinstance(v, (str, bool)) or v is None:
+        return v
+    if isinstance(v, (int, float, np.number)):
+        return round(float(v), 6)
+    if isinstance(v, np.ndarray):
+        return [round(float(vv), 6) for vv in v.ravel()]
+    raise TypeError(type(v))
+
+
+def bsdf_key(bsdf: Optional[dict]) -> Optional[str]:
+    # canonical string of a bsdf dict, `None` if it holds objects that can't be compared by value
+    try:
+        return json.dumps(_to_jsonable(bsdf), sort_keys=True)
+    except TypeError:
+        return None
+
+
+def tessellate_cube() -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Mitsuba `cube` spans [-1, 1]^3; 4 vertices per face so that normals stay flat
+    vertices, normals, faces = [], [], []
+    for axis in range(3):
+        for sign in [-1., 1.]:
+            n = np.zeros(3)
+            n[axis] = sign
+            u = np.zeros(3)
+            u[(axis + 1) % 3] = 1.
+            v = np.cross(n, u)
+            base = len(vertices)
+            for du, dv in [(-1, -1), (1, -1), (1, 1), (-1, 1)]:
+                vertices.append(n + du * u + dv * v)
+                normals.append(n)
+            faces.extend([(base, base + 1, base + 2), (base, base + 2, base + 3)])
+    return np.asarray(vertices), np.asarray(normals), np.asarray(faces)
+
+
+def tessellate_sphere(resolution: tuple[int, int] = SPHERE_RESOLUTION) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # unit sphere centered at the origin
+    n_lat, n_lon = resolution
+    theta = np.linspace(0, np.pi, n_lat + 1)[:, None]
+    phi = np.linspace(0, 2 * np.pi, n_lon + 1)[None, :]
+    vertices = np.stack(np.broadcast_arrays(np.sin(theta) * np.cos(phi),
+                                            np.cos(theta),
+                                            -np.sin(theta) * np.sin(phi)), axis=-1).reshape(-1, 3)
+    i, j = np.meshgrid(np.arange(n_lat), np.arange(n_lon), indexing='ij')
+    v00 = (i * (n_lon + 1) + j).ravel()
+    v01 = v00 + 1
+    v10 = v00 + n_lon + 1
+    v11 = v10 + 1
+    faces = np.concatenate([np.stack([v00, v10, v11], axis=-1), np.stack([v00, v11, v01], axis=-1)])
+    return vertices, vertices.copy(), faces
+
+
+def tessellate_cylinder(p0, p1, radius: float,
+                        resolution: int = CYLINDER_RESOLUTION) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Mitsuba `cylinder` is open, i.e. there are no caps
+    p0 = np.asarray(p0, dtype=np.float64)
+    p1 = np.asarray(p1, dtype=np.float64)
+    axis = p1 - p0
+    axis = axis / max(np.linalg.norm(axis), 1e-12)
+    helper = np.array([1., 0., 0.]) if abs(axis[0]) < .9 else np.array([0., 1., 0.])
+    u = np.cross(axis, helper)
+    u = u / np.linalg.norm(u)
+    v = np.cross(axis, u)
+    phi = np.linspace(0, 2 * np.pi, resolution + 1)
+    ring = np.cos(phi)[:, None] * u + np.sin(phi)[:, None] * v  # (resolution + 1, 3)
+    vertices = np.concatenate([p0 + radius * ring, p1 + radius * ring])
+    normals = np.concatenate([ring, ring])
+    j = np.arange(resolution)
+    a, b = j, j + 1
+    c, d = j + resolution + 1, j + resolution + 2
+    faces = np.concatenate([np.stack([a, b, d], axis=-1), np.stack([a, d, c], axis=-1)])
+    return vertices, normals, faces
+
+
+def tessellate(s: dict, sphere_resolution: tuple[int, int] = SPHERE_RESOLUTION,
+               cylinder_resolution: int = CYLINDER_RESOLUTION) -> Optional[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    # returns world-space (vertices, normals, faces), or None if `s` can't be tessellated
+    if s.get('type') not in TESSELLATED_TYPES or not set(s.keys()) <= MERGEABLE_KEYS:
+        return None
+    if s['type'] == 'cube':
+        vertices, normals, faces = tessellate_cube()
+    elif s['type'] == 'sphere':
+        vertices, normals, faces = tessellate_sphere(sphere_resolution)
+        vertices = vertices * float(s.get('radius', 1.)) + np.asarray(s.get('center', (0, 0, 0)), dtype=np.float64)
+    else:
+        vertices, normals, faces = tessellate_cylinder(s.get('p0', (0, 0, 0)), s.get('p1', (0, 0, 1)),
+                                                       float(s.get('radius', 1.)), cylinder_resolution)
+    mat = _to_matrix(s.get('to_world'))
+    vertices = vertices @ mat[:3, :3].T + mat[:3, 3]
+    normals = normals @ np.linalg.inv(mat[:3, :3])  # inverse transpose
+    normals = normals / np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-12)
+    if np.linalg.det(mat[:3, :3]) < 0:
+        faces = faces[:, ::-1]
+    return vertices, normals, faces
+
+
+def create_mesh(name: str, vertices: np.ndarray, normals: np.ndarray, faces: np.ndarray,
+                bsdf: Optional[dict] = None) -> mi.Mesh:
+    props = mi.Properties()
+    if bsdf is not None:
+        props['bsdf'] = mi.load_dict(bsdf)
+    mesh = mi.Mesh(name, vertex_count=len(vertices), face_count=len(faces), props=props,
+                   has_vertex_normals=True, has_vertex_texcoords=False)
+    params = mi.traverse(mesh)
+    params['vertex_positions'] = np.ascontiguousarray(vertices, dtype=np.float32).ravel()
+    params['vertex_normals'] = np.ascontiguousarray(normals, dtype=np.float32).ravel()
+    params['faces'] = np.ascontiguousarray(faces, dtype=np.uint32).ravel()
+    params.update()
+    return mesh
+
+
+def merge_primitives(shape: list[dict], min_group_size: int = 2) -> list[Union[dict, mi.Mesh]]:
+    """
+    Tessellates primitives of a preprocessed shape (i.e. the output of `mi_helper._preprocess_shape`),
+    bakes their transforms, and merges all primitives sharing an identical bsdf into one in-memory `mi.Mesh`.
+    Shapes that can't be tessellated, and bsdf groups smaller than `min_group_size`, are returned unchanged.
+    """
+    groups: dict[str, list[int]] = {}
+    for ind, s in enumerate(shape):
+        if not isinstance(s, dict) or s.get('type') not in TESSELLATED_TYPES or not set(s.keys()) <= MERGEABLE_KEYS:
+            continue
+        key = bsdf_key(s.get('bsdf'))
+        if key is None:
+            continue
+        groups.setdefault(key, []).append(ind)
+
+    merged_inds = set()
+    merged = []
+    for group_ind, inds in enumerate(groups.values()):
+        if len(inds) < min_group_size:
+            continue
+        vertices, normals, faces = [], [], []
+        offset = 0
+        for ind in inds:
+            out = tessellate(shape[ind])
+            vertices.append(out[0])
+            normals.append(out[1])
+            faces.append(out[2] + offset)
+            offset += len(out[0])
+        merged.append(create_mesh(f'merged_{group_ind:03d}', np.concatenate(vertices), np.concatenate(normals),
+                                  np.concatenate(faces), bsdf=shape[inds[0]].get('bsdf')))
+        merged_inds.update(inds)
+    return [s for ind, s in enumerate(shape) if ind not in merged_inds] + merged
+
+
+def bounding_sphere(s: dict) -> Optional[tuple[np.ndarray, float]]:
+    # world-space (center, radius) enclosing a primitive, from its object-space box; None if not tessellatable
+    if s.get('type') not in TESSELLATED_TYPES or not set(s.keys()) <= MERGEABLE_KEYS:
+        return None
+    if s['type'] == 'cube':
+        box_min, box_max = -np.ones(3), np.ones(3)
+    elif s['type'] == 'sphere':
+        center = np.asarray(s.get('center', (0, 0, 0)), dtype=np.float64)
+        radius = float(s.get('radius', 1.))
+        box_min, box_max = center - radius, center + radius
+    else:
+        ends = np.asarray([s.get('p0', (0, 0, 0)), s.get('p1', (0, 0, 1))], dtype=np.float64)
+        radius = float(s.get('radius', 1.))
+        box_min, box_max = ends.min(axis=0) - radius, ends.max(axis=0) + radius
+    mat = _to_matrix(s.get('to_world'))
+    corners = np.stack(np.meshgrid(*zip(box_min, box_max), indexing='ij'), axis=-1).reshape(-1, 3)
+    corners = corners @ mat[:3, :3].T + mat[:3, 3]
+    center = (corners.min(axis=0) + corners.max(axis=0)) / 2
+    return center, float(np.linalg.norm(corners - center, axis=-1).max())
+
+
+def camera_params(sensor: mi.Sensor) -> tuple[np.ndarray, np.ndarray, float, int]:
+    # (eye, forward, tan of half the horizontal fov, film width) of a perspective sensor
+    params = mi.traverse(sensor)
+    to_world = np.asarray(params['to_world'].matrix, dtype=np.float64).reshape(4, 4)
+    width = int(np.asarray(params['film.size']).ravel()[0])
+    return to_world[:3, 3], to_world[:3, 2], float(np.tan(np.deg2rad(np.asarray(params['x_fov']).item()) / 2)), width
+
+
+def projected_sizes(spheres: list[tuple[np.ndarray, float]], cameras: list[tuple[np.ndarray, np.ndarray, float, int]]) -> np.ndarray:
+    # largest projected diameter (pixels) of each bounding sphere over all cameras
+    if len(spheres) == 0:
+        return np.zeros((0,))
+    centers = np.stack([c for c, _ in spheres])
+    radii = np.asarray([r for _, r in spheres])
+    sizes = np.zeros(len(spheres))
+    for eye, forward, tan_half_fov, width in cameras:
+        depth = (centers - eye) @ forward
+        # spheres reaching the image plane (or behind it) are treated as large
+        size = np.where(depth > radii, radii / np.maximum(depth, 1e-12) / tan_half_fov * width, np.inf)
+        sizes = np.maximum(sizes, size)
+    return sizes
+
+
+def simplify_primitives(shape: list, sensors: list[mi.Sensor], lod_pixels: float = LOD_PIXELS) -> tuple[list, dict]:
+    """
+    Level of detail for a preprocessed shape rendered from `sensors`. Primitives whose projected diameter stays below
+    `lod_pixels` in every view are tessellated coarsely and merged into one proxy mesh per bsdf; those below
+    `lod_pixels * LOD_CULL_RATIO` are culled. Primitive order (and thus per-primitive ids) is not preserved.
+    Returns the new shape and the number of primitives that were culled or simplified.
+    """
+    stats = {'primitives': len(shape), 'culled': 0, 'coarse': 0}
+    if lod_pixels <= 0 or len(sensors) == 0:
+        return shape, stats
+    cameras = [camera_params(sensor) for sensor in sensors]
+    inds = []
+    spheres = []
+    for ind, s in enumerate(shape):
+        sphere = bounding_sphere(s) if isinstance(s, dict) else None
+        if sphere is not None and bsdf_key(s.get('bsdf')) is not None:
+            inds.append(ind)
+            spheres.append(sphere)
+    sizes = projected_sizes(spheres, cameras)
+
+    removed = set()
+    groups: dict[str, list[int]] = {}
+    for ind, size in zip(inds, sizes):
+        if size < lod_pixels * LOD_CULL_RATIO:
+            removed.add(ind)
+            stats['culled'] += 1
+        elif size < lod_pixels:
+            removed.add(ind)
+            groups.setdefault(bsdf_key(shape[ind].get('bsdf')), []).append(ind)
+            stats['coarse'] += 1
+
+    proxies = []
+    for group_ind, group in enumerate(groups.values()):
+        vertices, normals, faces = [], [], []
+        offset = 0
+        for ind in group:
+            out = tessellate(shape[ind], sphere_resolution=LOD_SPHERE_RESOLUTION, cylinder_resolution=LOD_CYLINDER_RESOLUTION)
+            vertices.append(out[0])
+            normals.append(out[1])
+            faces.append(out[2] + offset)
+            offset += len(out[0])
+        proxies.append(create_mesh(f'lod_{group_ind:03d}', np.concatenate(vertices), np.concatenate(normals),
+                                   np.concatenate(faces), bsdf=shape[group[0]].get('bsdf')))
+    print(f"[INFO] LOD: {stats['culled']} culled and {stats['coarse']} simplified into {len(proxies)} proxies, "
+          f"out of {stats['primitives']} primitives")
+    return [s for ind, s in enumerate(shape) if ind not in removed] + proxies, stats
+
+
+def benchmark_merge_primitives(counts: tuple[int, ...] = (10, 100, 1000, 5000), num_colors: int = 4,
+                               resolution: int = 256, spp: int = 4):
+    sensor = mi.load_dict({
+        'type': 'perspective',
+        'to_world': mi.ScalarTransform4f.look_at(origin=[0, 0, 3], target=[0, 0, 0], up=[0, 1, 0]),
+        'fov': 45,
+        'film': {'type': 'hdrfilm', 'width': resolution, 'height': resolution},
+    })
+    rng = np.random.default_rng(0)
+    print(f'{"#primitives":>12} {"merge":>6} {"#shapes":>8} {"load (s)":>9} {"render (s)":>11}')
+    for count in counts:
+        shape = []
+        for ind in range(count):
+            to_world = np.eye(4)
+            to_world[:3, :3] *= rng.uniform(.01, .05)
+            to_world[:3, 3] = rng.uniform(-1, 1, size=3)
+            color = np.eye(3)[ind % num_colors % 3] * (1 - .2 * (ind % num_colors // 3))
+            shape.append({'type': 'cube' if ind % 2 == 0 else 'sphere',
+                          'to_world': mi.ScalarTransform4f(to_world),
+                          'bsdf': {'type': 'diffuse', 'reflectance': {'type': 'rgb', 'value': color}}})
+        for merge in [False, True]:
+            start = time.time()
+            scene_shape = merge_primitives(shape) if merge else shape
+            scene = mi.load_dict({'type': 'scene', 'integrator': {'type': 'path', 'max_depth': 4},
+                                  'light': {'type': 'constant'},
+                                  **{f'{i:02d}': s for i, s in enumerate(scene_shape)}})
+            load_time = time.time() - start
+            start = time.time()
+            image = mi.render(scene, sensor=sensor, spp=spp)
+            _ = np.asarray(image)
+            render_time = time.time() - start
+            print(f'{count:>12} {str(merge):>6} {len(scene_shape):>8} {load_time:>9.3f} {render_time:>11.3f}')
+
+
+if __name__ == "__main__":
+    mi.set_variant('scalar_rgb')
+    benchmark_merge_primitives()
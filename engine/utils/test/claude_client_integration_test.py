@@ -18,9 +18,10 @@ class TestClaudeClient(unittest.TestCase):
         self.generator = ClaudeClient(cache=TestClaudeClient._test_cache_path)
 
     def tearDown(self):
-        """Clean up by deleting the cache file after each test."""
-        if os.path.exists(self._test_cache_path):
-            os.remove(self._test_cache_path)
+        """Clean up by deleting the cache database after each test."""
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.generator.cache_file + suffix):
+                os.remove(self.generator.cache_file + suffix)
     
     def test_generate_basic_query(self):
         """Test a basic generation query to the API."""
@@ -30,16 +31,15 @@ class TestClaudeClient(unittest.TestCase):
 
         self.assertTrue(os.path.exists(self.generator.cache_file))
 
-        # Confirm that it is in the cache
-        with open(self.generator.cache_file, "r") as f:
-            cache = json.load(f)
-            self.assertTrue(cache_key in cache)
-            self.assertTrue("Paris" in cache[cache_key][0])
+        # Confirm that it is in the cache, also for another client
+        cache = ClaudeClient(cache=TestClaudeClient._test_cache_path).cache
+        self.assertTrue(cache_key in cache)
+        self.assertTrue("Paris" in cache[cache_key][0])
 
     def test_concurrent_cache_updates(self):
-        """Test concurrent updates to ensure .tmp and .lock files are managed correctly."""
+        """Test concurrent updates and appends to the same key."""
         def update_cache():
-            self.generator.update_cache("test_key", {"data": "value"})
+            self.generator.update_cache("test_key", [["value"]])
 
         # Start multiple threads to update the cache simultaneously
         threads = [threading.Thread(target=update_cache) for _ in range(2)]
@@ -47,10 +47,14 @@ class TestClaudeClient(unittest.TestCase):
             thread.start()
         for thread in threads:
             thread.join()
+        self.assertEqual(self.generator.cache["test_key"], [["value"]])
 
-        # Check for presence of .lock or .tmp files indicating incomplete or overlapping operations
-        self.assertFalse(os.path.exists(self.generator.cache_file + ".lock"), ".lock file should not exist after operations complete.")
-        self.assertFalse(os.path.exists(self.generator.cache_file + ".tmp"), ".tmp file should not exist after operations complete.")
+        threads = [threading.Thread(target=self.generator.cache.append, args=("test_key", [["more"]])) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.generator.cache["test_key"]), 5, "Appends should not overwrite each other.")
 
 if __name__ == '__main__':
     unittest.main()
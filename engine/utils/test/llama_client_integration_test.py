@@ -20,8 +20,9 @@ class TestLlamaClient(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         """Clean up by deleting the cache file after all tests."""
-        if os.path.exists(cls._test_cache_path):
-            os.remove(cls._test_cache_path)
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(cls.generator.cache_file + suffix):
+                os.remove(cls.generator.cache_file + suffix)
         # Clear CUDA cache
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
@@ -39,10 +40,9 @@ class TestLlamaClient(unittest.TestCase):
         self.assertTrue(os.path.exists(self.generator.cache_file))
 
         # Confirm that it is in the cache
-        with open(self.generator.cache_file, "r") as f:
-            cache = json.load(f)
-            self.assertTrue(cache_key in cache)
-            self.assertTrue(any("Paris" in resp for resp in cache[cache_key][0]), "Expected 'Paris' in the cached response")
+        cache = self.generator.cache
+        self.assertTrue(cache_key in cache)
+        self.assertTrue(any("Paris" in resp for resp in cache[cache_key][0]), "Expected 'Paris' in the cached response")
 
     def test_multiple_completions(self):
         """Test generating multiple completions."""
@@ -76,5 +76,18 @@ class TestLlamaClient(unittest.TestCase):
         
         self.assertNotEqual(response1, response3, "New response should be generated when skipping cache")
 
+    def test_generate_batch(self):
+        """Test batched sampling across prompts of different lengths."""
+        prompts = [("Name a fruit.", "You are a helpful assistant."),
+                   ("Name a vegetable that is commonly used in soups.", "You are a helpful cooking assistant.")]
+        results = self.generator.generate_batch(prompts, num_completions=3, temperature=0.8, max_tokens=32)
+        self.assertEqual([len(r) for r in results], [3, 3])
+
+        # completions are cached under the same keys as `generate`
+        for (user_prompt, system_prompt), result in zip(prompts, results):
+            _, response = self.generator.generate(user_prompt, system_prompt, num_completions=3, temperature=0.8,
+                                                  max_tokens=32)
+            self.assertEqual(response, result)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,69 @@
+import unittest
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import mitsuba as mi
+
+if mi.variant() is None:
+    mi.set_variant('scalar_rgb')
+os.environ['MESH_CACHE_DIR'] = tempfile.mkdtemp()
+
+from engine.utils.mesh_asset_utils import create_asset_mesh, compute_asset_bbox
+
+T = mi.scalar_rgb.Transform4f
+PLY = '''ply
+format ascii 1.0
+element vertex 4
+property float x
+property float y
+property float z
+property uchar red
+property uchar green
+property uchar blue
+element face 4
+property list uchar int vertex_indices
+end_header
+0 0 0 255 0 0
+1 0 0 0 255 0
+0 2 0 0 0 255
+0 0 3 255 255 255
+3 0 2 1
+3 0 1 3
+3 0 3 2
+3 1 2 3
+'''
+
+
+class TestMeshAsset(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.path = (Path(cls.tmp_dir.name) / 'tetra.ply').as_posix()
+        with open(cls.path, 'w') as f:
+            f.write(PLY)
+        cls.to_world = T.translate([1, -2, .5]).scale([2, 1, .5])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        """In-memory meshes from converted PLYs match the PLY loaded by Mitsuba."""
+        reference = mi.load_dict({'type': 'ply', 'filename': self.path, 'to_world': self.to_world})
+        for _ in range(2):  # converted, then loaded from the asset cache
+            mesh = create_asset_mesh('tetra', self.path, self.to_world)
+            expected, actual = mi.traverse(reference), mi.traverse(mesh)
+            for key in ['vertex_positions', 'faces']:
+                np.testing.assert_allclose(np.asarray(actual[key]), np.asarray(expected[key]), atol=1e-6)
+            self.assertEqual(mesh.face_count(), reference.face_count())
+
+    def test_bbox(self):
+        reference = mi.load_dict({'type': 'ply', 'filename': self.path, 'to_world': self.to_world}).bbox()
+        box = compute_asset_bbox(self.path, self.to_world)
+        np.testing.assert_allclose(box.min, np.asarray(reference.min), atol=1e-6)
+        np.testing.assert_allclose(box.max, np.asarray(reference.max), atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import os
+import sys
+from pathlib import Path
+import numpy as np
+import mitsuba as mi
+
+if mi.variant() is None:
+    mi.set_variant('scalar_rgb')
+os.environ.setdefault('RENDER_CACHE', '0')
+sys.path.append((Path(__file__).parents[3] / 'scripts' / 'prompts').as_posix())
+
+from mi_helper import (SCENE_PRESETS, create_preset_scene_dict, compute_normalization, create_orbit_sensors,
+                       _preprocess_shape, _load_scaled_sensor, suppress_output, cube_fn, sphere_fn)
+from _shape_utils import transform_shape, compute_bbox
+from math_utils import translation_matrix
+from engine.utils.tessellate_utils import merge_primitives
+
+
+class TestPresetScene(unittest.TestCase):
+    preset_id = 'rover_background'
+    spp = 64
+
+    @classmethod
+    def setUpClass(cls):
+        shape = []
+        for i in range(4):
+            shape += transform_shape(cube_fn(scale=[.4, .8, .4], color=[.8, .2, .2]), translation_matrix([i * .6, .4, 0]))
+            shape += transform_shape(sphere_fn(color=[.2, .2, .8], scale=.3), translation_matrix([i * .6, 1., 0]))
+        shape = transform_shape(shape, compute_normalization(shape, cls.preset_id))
+        cls.shape = _preprocess_shape(shape)
+        sensors, _ = create_orbit_sensors(compute_bbox(shape))
+        cls.sensor = _load_scaled_sensor(next(iter(sensors.values())), .25)
+
+    def render(self, scene) -> np.ndarray:
+        if isinstance(scene, dict):
+            with suppress_output():
+                scene = mi.load_dict(scene)
+        image = np.asarray(mi.render(scene, sensor=self.sensor, spp=self.spp, seed=0))[..., :3]
+        # 4x4 block means, so that the comparison is not dominated by per-pixel noise
+        h, w = image.shape[0] // 4 * 4, image.shape[1] // 4 * 4
+        return image[:h, :w].reshape(h // 4, 4, w // 4, 4, 3).mean(axis=(1, 3))
+
+    def shapes_dict(self, shape: list) -> dict:
+        return {f'{i:02d}': s for i, s in enumerate(shape)}
+
+    def test_merged_matches_unmerged(self):
+        """Merged primitives render like the primitives they replace."""
+        merged = merge_primitives(self.shape)
+        self.assertLess(len(merged), len(self.shape))
+        image = self.render(create_preset_scene_dict(self.preset_id) | self.shapes_dict(self.shape))
+        image_merged = self.render(create_preset_scene_dict(self.preset_id) | self.shapes_dict(merged))
+        self.assertLess(np.abs(image - image_merged).mean(), .02)
+
+    def test_preset_dict_matches_xml(self):
+        """Scenes built with `create_preset_scene_dict` render like the preset xml itself, everywhere in the frame."""
+        with suppress_output():
+            xml_scene = mi.load_file(SCENE_PRESETS[self.preset_id]['xml_path'])
+        image = self.render(xml_scene)
+        image_dict = self.render(create_preset_scene_dict(self.preset_id))
+        # max, so that a misplaced small preset object is not averaged away
+        self.assertLess(np.abs(image - image_dict).max(), .05)
+
+    def test_preset_objects_not_shared(self):
+        """Every scene gets its own preset objects, so scenes can be built and rendered from several threads."""
+        first = create_preset_scene_dict(self.preset_id)
+        second = create_preset_scene_dict(self.preset_id)
+        for key, value in first.items():
+            if isinstance(value, mi.Object):
+                self.assertIsNot(value, second[key])
+
+
+if __name__ == '__main__':
+    unittest.main()
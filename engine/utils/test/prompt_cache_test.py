@@ -0,0 +1,58 @@
+import unittest
+from engine.utils.claude_client import ClaudeClient
+from engine.utils.parsel_utils import CodeGen
+from engine.utils.mock_llm_server import start_server
+from engine.utils.prompt_cache_utils import EXAMPLE_END, prompt_cache_stats
+import os
+
+
+class TestPromptCache(unittest.TestCase):
+    current_script = os.path.abspath(__file__)
+    parent_dir = os.path.dirname(current_script)
+    _test_cache_path = parent_dir + '/test_prompt_cache.json'
+    system_prompt = 'You are provided with the following `helper.py`:\n' + 'def helper(): ...\n' * 1000
+    user_prompt = 'Here are some examples:\n' + 'example()\n' * 1000 + EXAMPLE_END + '\nNow, write a program for: {task}'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server, cls.url = start_server(latency=.01, prefill=.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        prompt_cache_stats.reset()
+
+    def tearDown(self):
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.generator.cache_file + suffix):
+                os.remove(self.generator.cache_file + suffix)
+
+    def check_stats(self):
+        self.assertEqual(prompt_cache_stats.calls, 2)
+        self.assertEqual(prompt_cache_stats.hits, 1)
+        self.assertGreater(prompt_cache_stats.cache_read, prompt_cache_stats.uncached)
+        self.assertLess(prompt_cache_stats.ttft[True][0], prompt_cache_stats.ttft[False][0])
+
+    def test_claude(self):
+        """The system prompt and examples are cached across tasks."""
+        self.generator = ClaudeClient(cache=TestPromptCache._test_cache_path, base_url=self.url)
+        for task in ['a chair', 'a table']:
+            _, response = self.generator.generate(self.user_prompt.format(task=task), self.system_prompt, skip_cache=True)
+            self.assertTrue('```python' in response[0])
+        self.check_stats()
+        # the second request reads both breakpoints, i.e. everything but the task
+        self.assertEqual(prompt_cache_stats.cache_write, prompt_cache_stats.cache_read)
+
+    def test_gpt(self):
+        """Prefixes are cached without markers."""
+        self.generator = CodeGen(cache=TestPromptCache._test_cache_path, base_url=self.url + '/v1')
+        for task in ['a chair', 'a table']:
+            _, response = self.generator.generate(self.user_prompt.format(task=task), self.system_prompt)
+            self.assertTrue('```python' in response[0])
+        self.check_stats()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,352 @@
+import argparse
+import atexit
+import hashlib
+import json
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import mitsuba as mi
+from engine.utils.render_cache_utils import hash_scene
+from engine.utils.tessellate_utils import merge_primitives, simplify_primitives
+from engine.utils.mesh_asset_utils import create_asset_mesh
+
+# e.g. `TILE_WORKERS=8`; 0 disables tiled rendering
+TILE_WORKERS: int = int(os.environ.get('TILE_WORKERS', 0))
+TILE_SIZE: int = int(os.environ.get('TILE_SIZE', 128))
+# shared directory polled by `python engine/utils/tile_utils.py serve`; tiles go to a local process pool if unset
+TILE_QUEUE_DIR: str = os.environ.get('TILE_QUEUE_DIR', '')
+TILE_MIN_SAMPLES = 2 ** 24  # width * height * spp below which a single process is faster than paying for scene loads
+TILE_TIMEOUT = 600  # seconds to wait for remote workers before rendering the missing tiles locally
+POLL_INTERVAL = .05
+SCENE_CACHE_SIZE = 4  # loaded scenes kept per worker process
+
+_pool: Optional[ProcessPoolExecutor] = None
+_scenes: OrderedDict[str, mi.Scene] = OrderedDict()  # per worker process, keyed by scene spec hash, least recently used evicted first
+_tile_costs: dict[str, list[float]] = {}  # seconds per tile of previous renders, for scheduling
+
+
+def _to_picklable(v):
+    if isinstance(v, dict):
+        return {k: _to_picklable(vv) for k, vv in v.items()}
+    if isinstance(v, (list, tuple)):
+        return type(v)(_to_picklable(vv) for vv in v)
+    if hasattr(v, 'matrix'):  # mi.Transform4f
+        return {'__transform__': np.asarray(v.matrix, dtype=np.float64).reshape(4, 4)}
+    return v
+
+
+def _from_picklable(v):
+    if isinstance(v, dict):
+        if '__transform__' in v:
+            return mi.scalar_rgb.Transform4f(v['__transform__'])
+        return {k: _from_picklable(vv) for k, vv in v.items()}
+    if isinstance(v, (list, tuple)):
+        return type(v)(_from_picklable(vv) for vv in v)
+    return v
+
+
+def _to_json(v):
+    # payloads of the queue directory are JSON and npz, so that workers never unpickle files other processes wrote
+    if isinstance(v, dict):
+        return {k: _to_json(vv) for k, vv in v.items()}
+    if isinstance(v, (list, tuple)):
+        return [_to_json(vv) for vv in v]
+    if isinstance(v, np.ndarray):
+        return {'__array__': v.tolist(), 'dtype': v.dtype.str}
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def _from_json(v):
+    if isinstance(v, dict):
+        if '__array__' in v:
+            return np.asarray(v['__array__'], dtype=v['dtype'])
+        return {k: _from_json(vv) for k, vv in v.items()}
+    if isinstance(v, list):
+        return [_from_json(vv) for vv in v]
+    return v
+
+
+def make_scene_spec(xml_path: str, shapes: list[dict], merge: bool = False, aovs: Optional[str] = None,
+                    lod_sensors: Optional[list[mi.Sensor]] = None, lod_pixels: float = 0.) -> dict:
+    """
+    Picklable (and JSON-serializable, see `_to_json`) description of a scene that every worker loads on its own: the
+    preset xml plus preprocessed shapes, optionally simplified for `lod_sensors` (see `simplify_primitives`) and
+    merged, and optionally with the preset integrator wrapped in an aov integrator with `aovs`.
+    File paths in shapes (ply, curves) must be readable by the workers, i.e. on shared storage for remote workers.
+    """
+    spec = {'xml_path': xml_path, 'shapes': _to_picklable(shapes), 'merge_primitives': merge, 'aovs': aovs}
+    if lod_pixels > 0 and lod_sensors is not None:
+        # proxy meshes are Mitsuba objects, so workers simplify on their own, as deterministically as locally
+        spec['lod'] = {'sensors': [sensor_spec(sensor) for sensor in lod_sensors], 'pixels': lod_pixels}
+    return spec
+
+
+def sensor_spec(sensor: mi.Sensor) -> dict:
+    params = mi.traverse(sensor)
+    width, height = np.asarray(params['film.size']).ravel().tolist()
+    return {
+        'to_world': np.asarray(params['to_world'].matrix, dtype=np.float64).reshape(4, 4),
+        'fov': np.asarray(params['x_fov']).item(),
+        'width': int(width),
+        'height': int(height),
+        'rfilter': 'box' if 'Box' in sensor.film().rfilter().class_().name() else 'gaussian',
+    }
+
+
+def load_tile_sensor(spec: dict, offset: tuple[int, int], size: tuple[int, int]) -> mi.Sensor:
+    return mi.load_dict({
+        'type': 'perspective',
+        'to_world': mi.scalar_rgb.Transform4f(spec['to_world']),
+        'fov': spec['fov'],
+        'film': {
+            'type': 'hdrfilm',
+            'width': spec['width'],
+            'height': spec['height'],
+            'crop_offset_x': offset[0],
+            'crop_offset_y': offset[1],
+            'crop_width': size[0],
+            'crop_height': size[1],
+            'rfilter': {'type': spec['rfilter']},
+            'pixel_format': 'rgba',
+        }
+    })
+
+
+def load_spec_scene(spec: dict) -> mi.Scene:
+    key = hash_scene(spec)
+    if key is not None and key in _scenes:
+        _scenes.move_to_end(key)
+        return _scenes[key]
+    preset_scene = mi.load_file(spec['xml_path'])
+    scene_dict = {'type': 'scene', 'integrator': preset_scene.integrator()}
+    for i, emitter in enumerate(preset_scene.emitters()):
+        if not mi.has_flag(emitter.flags(), mi.EmitterFlags.Surface):  # area emitters come with their shapes
+            scene_dict[f'preset_emitter_{i:02d}'] = emitter
+    for i, s in enumerate(preset_scene.shapes()):
+        scene_dict[f'preset_shape_{i:03d}'] = s
+    shapes = _from_picklable(spec['shapes'])
+    if spec.get('lod') is not None:
+        sensors = [load_tile_sensor(s, (0, 0), (s['width'], s['height'])) for s in spec['lod']['sensors']]
+        shapes, _ = simplify_primitives(shapes, sensors, spec['lod']['pixels'])
+    if spec.get('merge_primitives', False):
+        shapes = merge_primitives(shapes)
+    for i, s in enumerate(shapes):
+        if isinstance(s, dict) and s.get('type') == 'ply' and set(s.keys()) <= {'type', 'filename', 'to_world', 'bsdf'}:
+            s = create_asset_mesh(f'{i:02d}', s['filename'], s.get('to_world'), s.get('bsdf'))
+        scene_dict[f'{i:02d}'] = s
+    if spec.get('aovs') is not None:
+        scene_dict['integrator'] = {'type': 'aov', 'aovs': spec['aovs'], 'integrator': scene_dict['integrator']}
+    scene = mi.load_dict(scene_dict)
+    if key is not None:
+        _scenes[key] = scene
+        while len(_scenes) > SCENE_CACHE_SIZE:
+            _scenes.popitem(last=False)
+    return scene
+
+
+def split_tiles(width: int, height: int, tile_size: int = TILE_SIZE) -> list[tuple[tuple[int, int], tuple[int, int]]]:
+    # (offset, size) of each tile, row-major
+    return [((x, y), (min(tile_size, width - x), min(tile_size, height - y)))
+            for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+
+def tile_seed(seed: int, tile_index: int) -> int:
+    # sample sequences restart in every crop window, so tiles sharing a seed would repeat the same noise pattern
+    return int.from_bytes(hashlib.sha256(f'{seed}:{tile_index}'.encode()).digest()[:4], 'little')
+
+
+def render_tile(job: dict) -> tuple[int, np.ndarray, float]:
+    # runs in a worker; returns (tile index, image, seconds)
+    start = time.time()
+    if mi.variant() != job['variant']:
+        mi.set_variant(job['variant'])
+    scene = load_spec_scene(job['scene'])
+    sensor = load_tile_sensor(job['sensor'], job['offset'], job['size'])
+    image = np.asarray(mi.render(scene, sensor=sensor, spp=job['spp'], seed=job['seed']))
+    return job['tile'], image, time.time() - start
+
+
+def _init_worker(variant: str):
+    mi.set_variant(variant)
+
+
+def get_pool(num_workers: int = TILE_WORKERS) -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Dr.Jit state does not survive fork
+        _pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_worker, initargs=(mi.variant(),))
+        atexit.register(_pool.shutdown)
+    return _pool
+
+
+def _write_atomic(path: Path, write_fn):
+    tmp_path = path.with_name(f'{path.stem}.tmp')
+    with open(tmp_path.as_posix(), 'wb') as f:
+        write_fn(f)
+    os.replace(tmp_path.as_posix(), path.as_posix())
+
+
+def _dispatch_queue(jobs: list[dict], queue_dir: str, timeout: float = TILE_TIMEOUT) -> list[tuple[int, np.ndarray, float]]:
+    queue_dir = Path(queue_dir)
+    for d in ['jobs', 'claimed', 'results']:
+        (queue_dir / d).mkdir(parents=True, exist_ok=True)
+    batch = uuid.uuid4().hex
+    pending = {}
+    for position, job in enumerate(jobs):
+        name = f"{batch}_{position:04d}_{job['tile']:04d}"  # workers claim in name order
+        payload = json.dumps(_to_json(job)).encode()
+        _write_atomic(queue_dir / 'jobs' / f'{name}.json', lambda f: f.write(payload))
+        pending[name] = job
+
+    results = []
+    start = time.time()
+    while len(pending) > 0 and time.time() - start < timeout:
+        for name in list(pending.keys()):
+            path = queue_dir / 'results' / f'{name}.npz'
+            if not path.exists():
+                continue
+            with np.load(path.as_posix(), allow_pickle=False) as data:
+                results.append((int(data['tile']), data['image'], float(data['seconds'])))
+            path.unlink()
+            del pending[name]
+        time.sleep(POLL_INTERVAL)
+    if len(pending) > 0:
+        print(f'[WARNING] {len(pending)} tiles not rendered by remote workers within {timeout}s, rendering locally')
+        for name, job in pending.items():
+            # abandoned: a worker that still renders it finds its claim gone and drops the result, see `serve`
+            (queue_dir / 'jobs' / f'{name}.json').unlink(missing_ok=True)
+            for claimed in (queue_dir / 'claimed').glob(f'{name}.*'):
+                claimed.unlink(missing_ok=True)
+            (queue_dir / 'results' / f'{name}.npz').unlink(missing_ok=True)
+            results.append(render_tile(job))
+    return results
+
+
+def serve(queue_dir: str = TILE_QUEUE_DIR):
+    # remote worker loop; claims jobs by renaming them, so any number of workers can share a queue directory
+    queue_dir = Path(queue_dir)
+    for d in ['jobs', 'claimed', 'results']:
+        (queue_dir / d).mkdir(parents=True, exist_ok=True)
+    worker_id = f'{socket.gethostname()}_{os.getpid()}'
+    print(f'[INFO] tile worker {worker_id} serving {queue_dir}')
+    while True:
+        claimed = None
+        for path in sorted((queue_dir / 'jobs').glob('*.json')):
+            claimed = queue_dir / 'claimed' / f'{path.stem}.{worker_id}'
+            try:
+                os.rename(path.as_posix(), claimed.as_posix())
+                break
+            except FileNotFoundError:  # claimed by another worker
+                claimed = None
+        if claimed is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        try:
+            with open(claimed.as_posix(), 'rb') as f:
+                job = _from_json(json.load(f))
+        except FileNotFoundError:  # abandoned by the dispatcher
+            continue
+        tile, image, seconds = render_tile(job)
+        name = claimed.name.split('.')[0]
+        result_path = queue_dir / 'results' / f'{name}.npz'
+        _write_atomic(result_path, lambda f: np.savez(f, tile=tile, image=image, seconds=seconds))
+        try:
+            claimed.unlink()
+        except FileNotFoundError:
+            # the dispatcher timed out and rendered the tile itself; it removes the claim before the result, so
+            # either it cleans up this result or this worker does
+            result_path.unlink(missing_ok=True)
+
+
+def use_tiles(sensor: mi.Sensor, spp: int) -> bool:
+    if TILE_WORKERS <= 0 and TILE_QUEUE_DIR == '':
+        return False
+    width, height = np.asarray(mi.traverse(sensor)['film.size']).ravel().tolist()
+    return width * height * spp >= TILE_MIN_SAMPLES
+
+
+def render_tiled(scene_spec: dict, sensor: mi.Sensor, spp: int, seed: int = 0, tile_size: int = TILE_SIZE,
+                 num_workers: int = TILE_WORKERS, queue_dir: str = TILE_QUEUE_DIR) -> tuple[np.ndarray, list[float]]:
+    """
+    Renders the film of `sensor` as crop windows in parallel, on a local process pool or on the workers serving
+    `queue_dir`, and stitches them. Returns the image and the seconds spent on each tile.
+    """
+    start = time.time()
+    spec = sensor_spec(sensor)
+    tiles = split_tiles(spec['width'], spec['height'], tile_size)
+    jobs = [{'tile': i, 'scene': scene_spec, 'sensor': spec, 'offset': offset, 'size': size, 'spp': spp,
+             'seed': tile_seed(seed, i), 'variant': mi.variant()} for i, (offset, size) in enumerate(tiles)]
+
+    # most expensive tiles of the previous render of this view first, so that no worker is left with a slow tail
+    cost_key = hash_scene({'scene': scene_spec, 'sensor': spec, 'tile_size': tile_size})
+    prev_costs = _tile_costs.get(cost_key)
+    if prev_costs is not None and len(prev_costs) == len(jobs):
+        jobs = [jobs[i] for i in np.argsort(prev_costs)[::-1]]
+
+    if queue_dir != '':
+        results = _dispatch_queue(jobs, queue_dir)
+    else:
+        results = list(get_pool(num_workers).map(render_tile, jobs))
+
+    image = None
+    costs = [0.] * len(tiles)
+    for i, tile_image, seconds in results:
+        (x, y), (w, h) = tiles[i]
+        if image is None:
+            image = np.zeros((spec['height'], spec['width'], tile_image.shape[-1]), dtype=tile_image.dtype)
+        image[y:y + h, x:x + w] = tile_image
+        costs[i] = seconds
+    if cost_key is not None:
+        _tile_costs[cost_key] = costs
+    print(f'[INFO] tiled render: {len(tiles)} tiles, {time.time() - start:.2f}s wall, '
+          f'tile min/mean/max {min(costs):.2f}/{np.mean(costs):.2f}/{max(costs):.2f}s')
+    return image, costs
+
+
+def benchmark_tiles(resolution: int = 512, spp: int = 256, num_workers: int = 4, tile_size: int = TILE_SIZE):
+    import tempfile
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False) as f:
+        f.write('<scene version="3.0.0"><integrator type="path"/>'
+                '<emitter type="constant"><rgb name="radiance" value="1"/></emitter></scene>')
+    shapes = [{'type': 'sphere', 'to_world': mi.scalar_rgb.Transform4f.translate([x, 0, 0]).scale(.4),
+               'bsdf': {'type': 'diffuse', 'reflectance': {'type': 'rgb', 'value': [.8, .2, .2]}}}
+              for x in np.linspace(-1.5, 1.5, 4)]
+    scene_spec = make_scene_spec(f.name, shapes)
+    sensor = mi.load_dict({'type': 'perspective', 'fov': 60,
+                           'to_world': mi.scalar_rgb.Transform4f.look_at(origin=[0, 0, 4], target=[0, 0, 0], up=[0, 1, 0]),
+                           'film': {'type': 'hdrfilm', 'width': resolution, 'height': resolution, 'pixel_format': 'rgba'}})
+
+    start = time.time()
+    reference = np.asarray(mi.render(load_spec_scene(scene_spec), sensor=sensor, spp=spp))
+    single_time = time.time() - start
+    render_tiled(scene_spec, sensor, spp, num_workers=num_workers, tile_size=tile_size, queue_dir='')  # warm up workers
+    start = time.time()
+    image, _ = render_tiled(scene_spec, sensor, spp, num_workers=num_workers, tile_size=tile_size, queue_dir='')
+    tiled_time = time.time() - start
+    print(f'single process {single_time:.2f}s, {num_workers} workers {tiled_time:.2f}s, '
+          f'mean abs diff {np.abs(image - reference).mean():.4f}, mean {reference.mean():.4f} vs {image.mean():.4f}')
+    os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve', 'benchmark'])
+    parser.add_argument('--queue-dir', default=TILE_QUEUE_DIR)
+    parser.add_argument('--variant', default=os.environ.get('MI_DEFAULT_VARIANT', 'scalar_rgb'))
+    parser.add_argument('--num-workers', type=int, default=max(TILE_WORKERS, 4))
+    args = parser.parse_args()
+    mi.set_variant(args.variant)
+    if args.command == 'serve':
+        serve(args.queue_dir)
+    else:
+        benchmark_tiles(num_workers=args.num_workers)
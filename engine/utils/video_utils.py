@@ -0,0 +1,142 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Optional, Union
+import numpy as np
+from PIL import Image
+import imageio
+
+# e.g. `VIDEO_FORMATS=gif,mp4,webp`; mp4 and webp are much smaller than gif
+VIDEO_FORMATS: list[str] = os.environ.get('VIDEO_FORMATS', 'gif').split(',')
+# number of decoded frames kept in memory, e.g. the views of the latest frames; older ones are read back from disk
+FRAME_BUFFER_SIZE: int = int(os.environ.get('FRAME_BUFFER_SIZE', 32))
+WRITE_QUEUE_SIZE = 64  # pending writes; producers block beyond this, so buffers waiting to be encoded stay bounded
+NUM_WRITERS = 2
+
+_frame_buffers: OrderedDict[str, np.ndarray] = OrderedDict()
+_frame_buffers_lock = threading.Lock()
+_writer = ThreadPoolExecutor(max_workers=NUM_WRITERS)
+_write_slots = threading.BoundedSemaphore(WRITE_QUEUE_SIZE)
+_pending_writes: dict[str, Future] = {}
+_pending_writes_lock = threading.Lock()
+
+
+def _key(path: Union[str, Path]) -> str:
+    return Path(path).absolute().as_posix()
+
+
+def _put_frame(path: Union[str, Path], image: np.ndarray):
+    with _frame_buffers_lock:
+        _frame_buffers[_key(path)] = image
+        _frame_buffers.move_to_end(_key(path))
+        while len(_frame_buffers) > FRAME_BUFFER_SIZE:
+            _frame_buffers.popitem(last=False)
+
+
+def submit_write(path: Union[str, Path], write_fn: Callable[[str], None]) -> Path:
+    # runs `write_fn(path)` on the writer threads; blocks while `WRITE_QUEUE_SIZE` writes are pending
+    prev = _pending_writes.get(_key(path))
+    if prev is not None:
+        prev.result()  # writes to the same path land in submission order
+    _write_slots.acquire()
+    try:
+        future = _writer.submit(write_fn, Path(path).as_posix())
+    except Exception:
+        _write_slots.release()
+        raise
+    future.add_done_callback(lambda _: _write_slots.release())
+    with _pending_writes_lock:
+        _pending_writes[_key(path)] = future
+    return Path(path)
+
+
+def save_image(image: Union[np.ndarray, Image.Image], path: Union[str, Path]) -> Path:
+    """
+    Keeps the frame in memory for encoders and tables, and writes the PNG in the background.
+    Takes ownership of `image`: it is not copied, so callers must not modify it afterwards.
+    """
+    image = np.asarray(image)
+    _put_frame(path, image)
+    return submit_write(path, lambda p: Image.fromarray(image).save(p))
+
+
+def save_exr(image: np.ndarray, path: Union[str, Path]) -> Path:
+    # float image (h, w, c); takes ownership like `save_image`
+    def write(p: str):
+        import mitsuba as mi
+        mi.Bitmap(image).write(p)
+    return submit_write(path, write)
+
+
+def flush_images(paths: Optional[Iterable[Union[str, Path]]] = None):
+    # blocks until the given files (default: all) passed to `save_image` and `save_exr` are on disk
+    with _pending_writes_lock:
+        keys = list(_pending_writes.keys()) if paths is None else [_key(p) for p in paths]
+        futures = [(key, _pending_writes[key]) for key in keys if key in _pending_writes]
+    for key, future in futures:
+        future.result()
+        with _pending_writes_lock:
+            if _pending_writes.get(key) is future:
+                del _pending_writes[key]
+
+
+def load_frame(path: Union[str, Path]) -> np.ndarray:
+    with _frame_buffers_lock:
+        image = _frame_buffers.get(_key(path))
+    if image is not None:
+        return image
+    flush_images([path])
+    image = np.asarray(Image.open(Path(path).as_posix()))
+    _put_frame(path, image)
+    return image
+
+
+def save_video(path: Union[str, Path], frames: Iterable[Union[np.ndarray, str, Path]], fps: float = 4.,
+               formats: list[str] = VIDEO_FORMATS) -> list[Path]:
+    """
+    Encodes frames (arrays, or paths to images) into `path` with each suffix in `formats`, e.g. `foo.gif` and `foo.mp4`.
+    Frames are streamed to the encoders and never re-decoded from disk if they were saved with `save_image`.
+    """
+    path = Path(path)
+    writers = {}
+    webp_frames = []
+    for fmt in formats:
+        save_path = path.with_suffix(f'.{fmt}')
+        try:
+            if fmt == 'gif':
+                writers[save_path] = imageio.get_writer(save_path.as_posix(), mode='I', fps=fps, loop=0)
+            elif fmt == 'mp4':
+                writers[save_path] = imageio.get_writer(save_path.as_posix(), fps=fps, codec='libx264', quality=8,
+                                                        macro_block_size=1)
+            elif fmt == 'webp':
+                continue  # encoded with PIL once all frames are collected
+            else:
+                print(f'[ERROR] unknown video format {fmt}')
+        except Exception as e:
+            print(f'[ERROR] cannot open {save_path}: {e}')
+
+    num_frames = 0
+    for frame in frames:
+        if not isinstance(frame, np.ndarray):
+            frame = load_frame(frame)
+        num_frames += 1
+        for save_path, writer in writers.items():
+            writer.append_data(frame if save_path.suffix == '.gif' or frame.ndim == 2 else frame[..., :3])
+        if 'webp' in formats:
+            webp_frames.append(Image.fromarray(frame))
+    for writer in writers.values():
+        writer.close()
+    saved_paths = list(writers.keys())
+
+    if 'webp' in formats and num_frames > 0:
+        save_path = path.with_suffix('.webp')
+        webp_frames[0].save(save_path.as_posix(), save_all=True, append_images=webp_frames[1:],
+                            duration=int(1000 / fps), loop=0, quality=80)
+        saved_paths.append(save_path)
+    if num_frames == 0:
+        for save_path in saved_paths:
+            save_path.unlink(missing_ok=True)
+        return []
+    return saved_paths
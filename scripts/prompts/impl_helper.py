@@ -1,11 +1,17 @@
 from engine.utils.graph_utils import calculate_node_depths
 import json
 import inspect
-from typing import Literal
+import copy
+import pickle
+import random
+import numpy as np
+from typing import Literal, Optional
 from _shape_utils import compute_bbox, primitive_call
 from dsl_utils import set_seed
 from mi_helper import box_fn, shap_e_fn, primitive_box_fn
 import hashlib
+import uuid
+from collections import OrderedDict
 import engine_utils
 
 
@@ -19,6 +25,27 @@ PROMPT_KEY = generate_prompt_key()  # prompt_kwargs_29fc3136
 orig_primitive_call = engine_utils.inner_primitive_call
 # should NOT be changed by `make_new_library`
 
+# original subtrees evaluated by `make_target`, shared across engine modes and tree depths;
+# (name, arguments, RNG states) -> (shape, bbox, RNG states after the call), least recently used evicted first
+SUBTREE_CACHE_SIZE = 256
+_subtree_cache: OrderedDict[str, tuple] = OrderedDict()
+
+
+def _subtree_key(name: str, args: tuple, kwargs: dict) -> Optional[str]:
+    # the RNG states are part of the key, as subtrees may sample
+    try:
+        return hashlib.sha256(pickle.dumps((name, args, kwargs, np.random.get_state(), random.getstate()))).hexdigest()
+    except Exception:
+        return None
+
+
+def _restamp_call_ids(shape: list) -> list:
+    # fresh call ids, as if the subtree had been called again; elements of the same call still share an id
+    call_ids = {}
+    for elem in shape:
+        elem['info']['stack'] = [(name, call_ids.setdefault(call_id, uuid.uuid4())) for name, call_id in elem['info']['stack']]
+    return shape
+
 
 def make_new_library(library, library_equiv, tree_depth: int, root: str, engine_mode: Literal['lmd', 'neural', 'omost', 'loosecontrol', 'box', 'densediffusion']):
     decode_docstring = next(iter(library.values()))['docstring'].startswith('{')
@@ -38,7 +65,8 @@ def make_new_library(library, library_equiv, tree_depth: int, root: str, engine_
             library.update(cur_library)
             return shape
 
-        return {'__target__': target, 'docstring': library[_name]['docstring'], 'hist_calls': [], 'last_call': None}
+        return {'__target__': target, 'docstring': library[_name]['docstring'], 'hist_calls': [], 'last_call': None,
+                'is_leaf': False}
 
     def make_target(_name):
         # print(f'[INFO] target: {_name=}')
@@ -47,14 +75,27 @@ def make_new_library(library, library_equiv, tree_depth: int, root: str, engine_
         prompt = docstring if not decode_docstring else json.loads(docstring)['prompt']
 
         def target(*args, **kwargs):
-            cur_library = library.copy()
-            library.clear()
-            library.update(orig_library)
-            # with set_seed(0):
-            shape = orig_library[_name]['__target__'](*args, **kwargs)
-            box = compute_bbox(shape)
-            library.clear()
-            library.update(cur_library)
+            key = _subtree_key(_name, args, kwargs)
+            if key is not None and key in _subtree_cache:
+                _subtree_cache.move_to_end(key)
+                shape, box, state_np, state_random = _subtree_cache[key]
+                shape = _restamp_call_ids(copy.deepcopy(shape))  # callers append to `info['stack']` in place
+                # as if the subtree had been evaluated
+                np.random.set_state(state_np)
+                random.setstate(state_random)
+            else:
+                cur_library = library.copy()
+                library.clear()
+                library.update(orig_library)
+                # with set_seed(0):
+                shape = orig_library[_name]['__target__'](*args, **kwargs)
+                box = compute_bbox(shape)
+                library.clear()
+                library.update(cur_library)
+                if key is not None:
+                    _subtree_cache[key] = (copy.deepcopy(shape), box, np.random.get_state(), random.getstate())
+                    while len(_subtree_cache) > SUBTREE_CACHE_SIZE:
+                        _subtree_cache.popitem(last=False)
 
             sig = inspect.signature(orig_library[_name]['__target__'])
             complete_kwargs = {**{n: arg for n, arg in zip(sig.parameters, args)}, **kwargs}
@@ -92,7 +133,7 @@ def make_new_library(library, library_equiv, tree_depth: int, root: str, engine_
                     return primitive_box_fn(prompt=prompt, shape=shape, kwargs=complete_kwargs, **extra_info)
             raise NotImplementedError(engine_mode)
 
-        return {'__target__': target, 'docstring': docstring, 'hist_calls': [], 'last_call': None}
+        return {'__target__': target, 'docstring': docstring, 'hist_calls': [], 'last_call': None, 'is_leaf': True}
 
     if decode_docstring:
         is_leaf = lambda _name: json.loads(orig_library[_name]['docstring'])['is_leaf']
@@ -68,8 +68,9 @@ def core(engine_modes: list[Literal['neural', 'lmd', 'omost', 'loosecontrol', 'd
                 print('[INFO]', str(args) + str(kwargs))
         setup_vi = lambda x: (None, Helper())
 
-    from mi_helper import execute_from_preset
-    import imageio
+    from mi_helper import execute_from_preset, execute_animation_from_preset
+    from engine.utils.video_utils import save_video, load_frame
+    from engine.utils.render_cache_utils import hash_scene
     save_dir = Path(save_dir)
     save_dir.mkdir(exist_ok=True)
     print_vcv_url(save_dir.as_posix())
@@ -87,21 +88,14 @@ def core(engine_modes: list[Literal['neural', 'lmd', 'omost', 'loosecontrol', 'd
         print(f'[INFO] rendering animation...')
         frames = list(animation_func())
         name = animation_func.__name__
-        final_frame_paths = []
         if len(frames) > 8:
             frame_skip = int(len(frames) / 8)
             frames = frames[::frame_skip]
-        out = execute_from_preset(sum(frames, []), save_dir=None)
-        for i in range(len(frames)):
-            frame_save_dir = save_dir / name / f'{i:02d}'
-            _ = execute_from_preset(frames[i], save_dir=frame_save_dir.as_posix(), prev_out=out)
-            # TODO change `sensor_info`
-            traj_paths = list(sorted(frame_save_dir.glob('rendering_traj_[0-9][0-9][0-9].png')))
-            final_frame_paths.append(traj_paths[0])
-            if i == 0:
-                imageio.mimsave((save_dir / f'{name}_static.gif').as_posix(), [np.asarray(Image.open(p)) for p in traj_paths], fps=4, loop=0)
-                out['sensors'] = {'rendering_traj_000': out['sensors']['rendering_traj_000']}
-        imageio.mimsave((save_dir / f'{name}_animation.gif').as_posix(), [np.asarray(Image.open(p)) for p in final_frame_paths], fps=len(final_frame_paths) / 2, loop=0)
+        out = execute_animation_from_preset(frames, save_dir=(save_dir / name).as_posix())
+        # TODO change `sensor_info`
+        final_frame_paths = [paths[0] for paths in out['frame_paths']]
+        save_video(save_dir / f'{name}_static.gif', out['frame_paths'][0], fps=4)
+        save_video(save_dir / f'{name}_animation.gif', final_frame_paths, fps=len(final_frame_paths) / 2)
 
         return
 
@@ -198,11 +192,15 @@ def core(engine_modes: list[Literal['neural', 'lmd', 'omost', 'loosecontrol', 'd
     extra_frame_paths: dict[tuple[str, int], list[Path]] = {}
 
     def load_image(path: Path, resolution: int = 512):
-        image = Image.open(path.as_posix())
+        image = Image.fromarray(load_frame(path))
         # image = image.resize((resolution, int(resolution * image.height / image.width)), resample=Image.BILINEAR)
         image = image.resize((resolution, resolution), resample=Image.BILINEAR).convert('RGB')
         return image
 
+    # depth variants that assemble to the same scene are rendered once; views of variants that differ are only
+    # reused through the render cache, i.e. when the whole scene matches, since primitives outside a view's frustum
+    # still cast shadows and reflect light into it
+    rendered_variants: dict[tuple[str, str], dict] = {}
     for engine_mode in EXTRA_ENGINE_MODE:
         if engine_mode not in engine_modes:
             continue
@@ -219,11 +217,21 @@ def core(engine_modes: list[Literal['neural', 'lmd', 'omost', 'loosecontrol', 'd
             )
 
             print(f'[INFO] running with {tree_depth=} new library {new_library.keys()}')
-            extra_out = run(root, save_dir=save_dir.as_posix(), preset_id='rover_background',
-                            engine_mode=engine_mode, prev_out=out,
-                            save_suffix=f'depth_{tree_depth:02d}',
-                            new_library=new_library,
-                            overwrite=overwrite)
+            # the assembled scene only depends on which functions are replaced by engine targets and which are
+            # re-assembled from them, e.g. depths beyond the deepest leaf replace the same functions
+            variant_key = hash_scene({'leaves': sorted(name for name, v in new_library.items() if v['is_leaf']),
+                                      'parents': sorted(name for name, v in new_library.items() if not v['is_leaf'])})
+            if variant_key is not None and (engine_mode, variant_key) in rendered_variants:
+                print(f'[INFO] {tree_depth=} assembles the same scene as a previous depth, reusing its renderings')
+                extra_out = rendered_variants[(engine_mode, variant_key)]
+            else:
+                extra_out = run(root, save_dir=save_dir.as_posix(), preset_id='rover_background',
+                                engine_mode=engine_mode, prev_out=out,
+                                save_suffix=f'depth_{tree_depth:02d}',
+                                new_library=new_library,
+                                overwrite=overwrite)
+                if variant_key is not None:
+                    rendered_variants[(engine_mode, variant_key)] = extra_out
 
             extra_frame_paths[(engine_mode, tree_depth)] = extra_out['final_frame_paths']
 
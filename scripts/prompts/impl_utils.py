@@ -33,7 +33,7 @@ import ast
 import sys
 from contextlib import contextmanager
 from PIL import Image
-import imageio
+from engine.utils.video_utils import save_video, flush_images
 import os
 
 
@@ -70,7 +70,7 @@ def run(scene_name: str, preset_id: str, save_dir: Union[str, None] = None,
             return
         # if len(paths) != len(out['sensors']):  # TODO
         #     print(f'[ERROR] {name=} {len(paths)=} {len(out["sensors"])}')
-        imageio.mimsave((save_dir / f'{prefix}_{name}.gif').as_posix(), [np.asarray(Image.open(p.as_posix())) for p in paths], fps=fps, loop=0)
+        save_video(save_dir / f'{prefix}_{name}.gif', paths, fps=fps)
 
     final_seq_name = 'rendering_traj'
     final_seq_path: Path = save_dir / f'{prefix}_{final_seq_name}.gif'
@@ -99,6 +99,8 @@ def run(scene_name: str, preset_id: str, save_dir: Union[str, None] = None,
                                       # sensors=out['sensors'],
                                       timestep=(0, num_views),
                                       prev_out=prev_out,
+                                      # depth and masks for control-image engines come from the same pass as RGB
+                                      render_aovs=engine_mode in ['lmd', 'omost', 'densediffusion', 'densesds', 'migc', 'loosecontrol'],
                                       )
             # traj_types = ['forward_facing', '360_view']
             # fov_types = ['changing', 'fixing']
@@ -147,7 +149,8 @@ def torch(scale: float = 1.0) -> Shape:
                         docstring = docstring.split(';')[0].lower()
                     docstrings.append(docstring)
                 boxes, segm_maps, depth_maps = project(frame, save_dir=save_frame_boxes_dir.as_posix(),
-                                                       normalization=out['normalization'], sensors=out['sensors'])
+                                                       normalization=out['normalization'], sensors=out['sensors'],
+                                                       aovs=out.get('aovs'))
                 if engine_mode == 'lmd':
                     for sensor_name, sensor_boxes in boxes.items():
                         sensor_boxes = [(s, b) for s, b in zip(docstrings, sensor_boxes) if np.all(b.sizes > 5) and s is not None]
@@ -228,7 +231,8 @@ def torch(scale: float = 1.0) -> Shape:
                 save_frame_depth_dir = save_frame_dir / 'depth'
                 save_frame_depth_dir.mkdir(parents=True, exist_ok=True)
                 segm_maps, depth_maps = render_depth(frame, save_dir=save_frame_depth_dir.as_posix(),
-                                                     normalization=out['normalization'], sensors=out['sensors'])
+                                                     normalization=out['normalization'], sensors=out['sensors'],
+                                                     aovs=out.get('aovs'))
                 for sensor_name in out['sensors'].keys():
                     run_loosecontrol(depth=depth_maps[sensor_name],
                                      segm=segm_maps[sensor_name],
@@ -406,9 +410,13 @@ def torch(scale: float = 1.0) -> Shape:
                 pass
             else:
                 raise NotImplementedError(engine_mode)
-    traj_paths = list(sorted(save_frame_dirs[0].glob('rendering_traj_[0-9][0-9][0-9].png')))
+    if 'paths' in out:
+        traj_paths = [out['paths'][k] for k in sorted(out['paths'].keys()) if k.startswith('rendering_traj_')]
+    else:  # renderings from a previous run
+        traj_paths = list(sorted(save_frame_dirs[0].glob('rendering_traj_[0-9][0-9][0-9].png')))
     if engine_mode == 'lmd':
         save_gif('primitives_rendering_traj', traj_paths)
+        flush_images()  # box visualizations from `project` are written in the background, and globbed here
         lmd_boxes_traj_paths = list(sorted(save_frame_dirs[0].glob('boxes/sensor_rendering_traj_[0-9][0-9][0-9]_shape_all.png')))
         save_gif('boxes_rendering_traj', lmd_boxes_traj_paths)
         lm_prompts_traj_paths = list(sorted(save_frame_dirs[0].glob('rendering_traj_[0-9][0-9][0-9]_00/boxes.png')))  # TODO currently these images are not squared
@@ -11,7 +11,7 @@ from PIL import Image, ImageDraw
 from tqdm import tqdm
 import numpy as np
 import numpy.typing
-from engine.constants import ENGINE_MODE, PROJ_DIR
+from engine.constants import ENGINE_MODE, PROJ_DIR, RENDER_BUDGET
 import xml.etree.ElementTree as ET
 import hashlib
 import uuid
@@ -19,8 +19,20 @@ from contextlib import redirect_stdout, contextmanager
 import copy
 import sys
 import os
-from engine.utils.mitsuba_utils import set_bsdf_refs, set_scene_dict_default, set_auto_camera
+import atexit
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from engine.utils.mitsuba_utils import set_bsdf_refs, set_scene_dict_default, set_auto_camera, union_bboxes
+from engine.utils.tessellate_utils import merge_primitives, simplify_primitives, LOD_PIXELS
+from engine.utils.render_cache_utils import hash_scene, cached_render, get_render_cache, xml_dependencies
 from engine.utils.type_utils import BBox
+from engine.utils.video_utils import save_image, save_exr, flush_images, load_frame
+from engine.utils.denoise_utils import DENOISE, DENOISE_SPP, AOVS, denoise_image
+from engine.utils.budget_utils import render_with_budget
+from engine.utils.mesh_asset_utils import create_asset_mesh, compute_asset_bbox
+from engine.utils.tile_utils import use_tiles, render_tiled, make_scene_spec
+from engine.utils.camera_rig_utils import create_orbit_rig, load_rig_sensors
 # from engine.utils.camera_utils import orbit_camera
 
 __all__ = ['execute']
@@ -70,42 +82,166 @@ def _preprocess_shape(shape: Shape, global_transform: Union[T, None] = None) ->
 
     return [
         {kk: (vv if kk != 'to_world' else (global_transform @ mi.scalar_rgb.Transform4f(vv)))
-         for kk, vv in v.items() if kk != 'info'
-         } for v in shape
+         for kk, vv in v.items() if kk not in ['info', 'control_points']
+         } | ({'filename': materialize_curve(v['control_points'])} if 'control_points' in v else {})
+        for v in shape
     ]
 
 
 def render_depth(shape: Shape, save_dir: Union[str, None],
                  sensors: dict[str, mi.Sensor],
                  normalization: Union[T, None] = None,
+                 aovs: Optional[dict[str, dict[str, np.ndarray]]] = None,
 ) -> tuple[dict[str, np.typing.NDArray[np.bool_]], dict[str, np.typing.NDArray[np.float32]]]:
+    # `aovs` from `execute_from_preset(..., render_aovs=True)` skips rendering
     save_dir = Path(save_dir)
-    if normalization is not None:
-        shape = transform_shape(shape, normalization)
-    shape = _preprocess_shape(shape)
-    scene_dict = {'type': 'scene', 'integrator': {'type': 'aov', 'aovs': 'dd:depth'},
-                  **{f'{i:02d}': s for i, s in enumerate(shape)}}
-    scene = mi.load_dict(scene_dict)
+    if aovs is None:
+        if normalization is not None:
+            shape = transform_shape(shape, normalization)
+        shape = _preprocess_shape(shape)
+        scene_dict = {'type': 'scene', 'integrator': {'type': 'aov', 'aovs': 'dd:depth'},
+                      **{f'{i:02d}': s for i, s in enumerate(shape)}}
+        scene = mi.load_dict(scene_dict)
     segm_maps = {}
     depth_maps = {}
     for sensor_name, sensor in sensors.items():
-        image = mi.render(scene, sensor=sensor, spp=4)
-        mi.Bitmap(image).write((save_dir / f'sensor_{sensor_name}_depth.exr').as_posix())
-
-        depth: np.typing.NDArray[np.float32] = np.asarray(image[:, :, 0])
+        if aovs is None:
+            image = mi.render(scene, sensor=sensor, spp=4)
+            depth: np.typing.NDArray[np.float32] = np.asarray(image[:, :, 0])
+        else:
+            # the preset background is excluded
+            depth = np.where(aovs[sensor_name]['ids'] >= 0, aovs[sensor_name]['depth'], 0).astype(np.float32)
+        save_exr(depth[:, :, None], save_dir / f'sensor_{sensor_name}_depth.exr')
         segm: np.typing.NDArray[np.bool_] = depth > 1e-3  # (h, w)
 
-        Image.fromarray((segm * 255).astype(np.uint8)).save((save_dir / f'sensor_{sensor_name}_segm.png').as_posix())
+        save_image((segm * 255).astype(np.uint8), save_dir / f'sensor_{sensor_name}_segm.png')
 
         segm_maps[sensor_name] = segm
         depth_maps[sensor_name] = depth
     return segm_maps, depth_maps
 
 
+def _load_aov_sensor(sensor: mi.Sensor) -> mi.Sensor:
+    # same pose and intrinsics as `sensor`, but with a box filter so that each sample only lands in its own pixel;
+    # otherwise integer AOVs (e.g. `shape_index`) get blended across neighboring pixels
+    params = mi.traverse(sensor)
+    width, height = np.asarray(params['film.size']).ravel().tolist()
+    return mi.load_dict({
+        'type': 'perspective',
+        'to_world': mi.scalar_rgb.Transform4f(np.asarray(params['to_world'].matrix).reshape(4, 4)),
+        'fov': np.asarray(params['x_fov']).item(),
+        'film': {
+            'type': 'hdrfilm',
+            'width': int(width),
+            'height': int(height),
+            'rfilter': {'type': 'box'},
+            'pixel_format': 'rgba',
+        }
+    })
+
+
+def _load_scaled_sensor(sensor: mi.Sensor, scale: float) -> mi.Sensor:
+    # same pose and intrinsics as `sensor`, with film resolution scaled by `scale`
+    params = mi.traverse(sensor)
+    width, height = np.asarray(params['film.size']).ravel().tolist()
+    return mi.load_dict({
+        'type': 'perspective',
+        'to_world': mi.scalar_rgb.Transform4f(np.asarray(params['to_world'].matrix).reshape(4, 4)),
+        'fov': np.asarray(params['x_fov']).item(),
+        'film': {
+            'type': 'hdrfilm',
+            'width': int(round(width * scale)),
+            'height': int(round(height * scale)),
+            'pixel_format': 'rgba',
+        }
+    })
+
+
+def render_instance_ids(scene: mi.Scene, sensor: mi.Sensor, num_shapes: int,
+                        ) -> tuple[np.typing.NDArray[np.int32], np.typing.NDArray[np.float32]]:
+    # `scene` must be loaded with the integrator {'type': 'aov', 'aovs': 'dd:depth,id:shape_index'}
+    # and shapes keyed by f'{i:02d}'; returns per-pixel primitive index (-1 for background) and depth
+    image = mi.render(scene, sensor=_load_aov_sensor(sensor), spp=1)
+    image = np.asarray(image)
+    depth: np.typing.NDArray[np.float32] = image[:, :, -2]
+    return _shape_index_to_ids(shape_index_map(scene), image[:, :, -1], depth, num_shapes), depth
+
+
+def shape_index_map(scene: mi.Scene) -> np.typing.NDArray[np.int64]:
+    # `shape_index` indexes `scene.shapes()`, which is not necessarily the order of the scene dict;
+    # maps it to the primitive index (-1 for preset shapes, and for the background at the end)
+    return np.asarray([int(s.id()) if s.id().isdigit() else -1 for s in scene.shapes()] + [-1])
+
+
+def _shape_index_to_ids(scene_index_to_ind: np.typing.NDArray[np.int64], shape_index: np.typing.NDArray[np.float32],
+                        depth: np.typing.NDArray[np.float32], num_shapes: int) -> np.typing.NDArray[np.int32]:
+    scene_index_to_ind = np.asarray(scene_index_to_ind)
+    shape_index = np.rint(shape_index).astype(np.int64)
+    shape_index = np.where((shape_index >= 0) & (shape_index < len(scene_index_to_ind) - 1), shape_index, -1)
+    ids = scene_index_to_ind[shape_index]
+    ids[(depth <= 1e-2) | (ids >= num_shapes)] = -1
+    return ids.astype(np.int32)
+
+
+AOV_PASS = 'depth:depth,index:shape_index,normal:sh_normal'  # appended after all other channels
+NUM_AOV_PASS_CHANNELS = 5
+
+
+def split_aov_pass(scene_index_to_ind: np.typing.NDArray[np.int64], image: np.typing.NDArray[np.float32],
+                   num_shapes: int) -> tuple[np.typing.NDArray[np.float32], dict[str, np.ndarray]]:
+    # splits an image rendered with `AOV_PASS` into the remaining channels and {'depth', 'ids', 'normal'};
+    # `scene_index_to_ind` is the `shape_index_map` of the rendered scene
+    image = np.asarray(image)
+    aov_image = image[..., -NUM_AOV_PASS_CHANNELS:]
+    depth = aov_image[..., 0]
+    shape_index = aov_image[..., 1]
+    # with many samples per pixel, ids and depth are averaged at boundaries, and an average can still be a valid id
+    # (e.g. 1 between ids 0 and 2); drop non-integer ids, then erode: keep only pixels whose 4 neighbors all agree
+    ids = _shape_index_to_ids(scene_index_to_ind, shape_index, depth, num_shapes)
+    ids[np.abs(shape_index - np.rint(shape_index)) > 1e-3] = -1
+    pad = np.pad(ids, 1, mode='edge')
+    agree = (pad[:-2, 1:-1] == ids) & (pad[2:, 1:-1] == ids) & (pad[1:-1, :-2] == ids) & (pad[1:-1, 2:] == ids)
+    ids[~agree] = -1
+    # blended depth at silhouettes (shape against background or empty space) is dropped the same way
+    depth = np.where(agree, depth, 0)
+    return image[..., :-NUM_AOV_PASS_CHANNELS], {'depth': depth, 'ids': ids, 'normal': aov_image[..., 2:]}
+
+
+def boxes_from_instance_ids(ids: np.typing.NDArray[np.int32], num_shapes: int) -> list[BBox]:
+    ys, xs = np.nonzero(ids >= 0)
+    labels = ids[ys, xs]
+    counts = np.bincount(labels, minlength=num_shapes)
+    h, w = ids.shape
+    x_min = np.full(num_shapes, w, dtype=np.int64)
+    y_min = np.full(num_shapes, h, dtype=np.int64)
+    x_max = np.full(num_shapes, -1, dtype=np.int64)
+    y_max = np.full(num_shapes, -1, dtype=np.int64)
+    np.minimum.at(x_min, labels, xs)
+    np.minimum.at(y_min, labels, ys)
+    np.maximum.at(x_max, labels, xs)
+    np.maximum.at(y_max, labels, ys)
+
+    boxes: list[BBox] = []
+    for ind in range(num_shapes):
+        if counts[ind] == 0:
+            boxes.append(BBox(center=np.zeros(2), size=0, min=np.zeros(2), max=np.zeros(2), sizes=np.zeros(2)))
+            continue
+        box_min = np.asarray((x_min[ind], y_min[ind]))
+        box_max = np.asarray((x_max[ind], y_max[ind]))
+        sizes = box_max - box_min
+        boxes.append(BBox(center=(box_min + box_max) * .5, size=max(sizes), min=box_min, max=box_max, sizes=sizes))
+    return boxes
+
+
 def project(shape: Shape, save_dir: Union[str, None],
             sensors: dict[str, mi.Sensor],
             normalization: Union[T, None] = None,
+            aovs: Optional[dict[str, dict[str, np.ndarray]]] = None,
 ) -> tuple[dict[str, list[BBox]], dict[str, list[np.typing.NDArray[np.bool_]]], dict[str, list[np.typing.NDArray[np.float32]]]]:
+    # One scene and one render per sensor: the AOV integrator outputs the index of the visible primitive
+    # together with depth, and per-primitive boxes, masks and depth maps are recovered from the ID buffer.
+    # Masks and boxes therefore cover the visible (not amodal) part of each primitive.
+    # `aovs` from `execute_from_preset(..., render_aovs=True)` skips rendering.
     if save_dir is None:
         save_dir = Path('outputs/tmp')
         save_dir.mkdir(exist_ok=True)
@@ -115,68 +251,42 @@ def project(shape: Shape, save_dir: Union[str, None],
     if normalization is not None:
         shape = transform_shape(shape, normalization)
     shape = _preprocess_shape(shape)
+    num_shapes = len(shape)
+    if aovs is None:
+        scene_dict = {'type': 'scene', 'integrator': {'type': 'aov', 'aovs': 'dd:depth,id:shape_index'},
+                      **{f'{i:02d}': s for i, s in enumerate(shape)}}
+        scene = mi.load_dict(scene_dict)
+
     boxes_all: dict[str, list[BBox]] = {}
     segm_maps_all: dict[str, list[np.typing.NDArray[np.bool_]]] = {}
     depth_maps_all: dict[str, list[np.typing.NDArray[np.float32]]] = {}
-    # canvas_all: dict[str, MyCanvas] = {}
     for sensor_name, sensor in sensors.items():
-        boxes: list[BBox] = []
+        if aovs is None:
+            ids, depth = render_instance_ids(scene, sensor, num_shapes)
+        else:
+            ids, depth = aovs[sensor_name]['ids'], aovs[sensor_name]['depth']
+        boxes = boxes_from_instance_ids(ids, num_shapes)
+        segm_maps = [ids == ind for ind in range(num_shapes)]
+        depth_maps = [np.where(segm, depth, 0).astype(np.float32) for segm in segm_maps]
         boxes_all[sensor_name] = boxes
-        # canvas = copy.deepcopy(global_canvas) if global_canvas is not None else MyCanvas()
-        # canvas_all[sensor_name] = canvas
-        segm_maps: list[np.typing.NDArray[np.bool_]] = []
         segm_maps_all[sensor_name] = segm_maps
-        depth_maps: list[np.typing.NDArray[np.float32]] = []
         depth_maps_all[sensor_name] = depth_maps
 
-        for ind, s in enumerate(shape):
-            scene_dict = {'type': 'scene', 'integrator': {'type': 'aov', 'aovs': 'dd:depth'}, 'shape': s}
-            scene = mi.load_dict(scene_dict)
-            image = mi.render(scene, sensor=sensor, spp=4)
-            save_to = save_dir / f'sensor_{sensor_name}_shape_{ind:02d}.exr'
-            if False:
-                mi.Bitmap(image).write(save_to.as_posix())
-            if True: #render_segm:
-                depth: np.typing.NDArray[np.float32] = np.asarray(image[:, :, 0])
-                segm: np.typing.NDArray[np.bool_] = depth > 1e-2  # (h, w)
-
-                rows = np.any(segm, axis=1)
-                cols = np.any(segm, axis=0)
-                if not rows.any() or not cols.any():
-                    box = BBox(center=np.zeros(2), size=0, min=np.zeros(2), max=np.zeros(2), sizes=np.zeros(2))
-                else:
-                    y_min, y_max = np.where(rows)[0][[0, -1]]
-                    x_min, x_max = np.where(cols)[0][[0, -1]]
-
-                    if False:
-                        disp = Image.fromarray(np.uint8(segm * 255))
-                        draw = ImageDraw.Draw(disp)
-                        draw.rectangle([x_min, y_min, x_max, y_max], outline="red", width=2)
-                        disp.save(save_to.with_suffix('.png').as_posix())
-
-                    box = BBox(center=np.asarray((x_min + x_max) * .5, (y_min + y_max) * .5),
-                               size=max(x_max - x_min, y_max - y_min),
-                               min=np.asarray((x_min, y_min)),
-                               max=np.asarray((x_max, y_max)),
-                               sizes=np.asarray((x_max - x_min, y_max - y_min)))
-
-                boxes.append(box)
-                segm_maps.append(segm)
-                depth_maps.append(depth)
-
-        disp_all = Image.new("RGB", tuple(mi.Bitmap(image).size()), "white")
+        h, w = ids.shape
+        disp_all = Image.new("RGB", (w, h), "white")
         draw_all = ImageDraw.Draw(disp_all)
         for box in boxes:
             draw_all.rectangle([box.min[0], box.min[1], box.max[0], box.max[1]], outline="red", width=2)
 
-        disp_all = torchvision.transforms.functional.to_pil_image(
-            torchvision.utils.draw_segmentation_masks(
-                image=torchvision.transforms.functional.pil_to_tensor(disp_all),
-                masks=torch.tensor(np.stack(segm_maps, axis=0)))
-        )
+        if num_shapes > 0:
+            disp_all = torchvision.transforms.functional.to_pil_image(
+                torchvision.utils.draw_segmentation_masks(
+                    image=torchvision.transforms.functional.pil_to_tensor(disp_all),
+                    masks=torch.tensor(np.stack(segm_maps, axis=0)))
+            )
 
         save_to = save_dir / f'sensor_{sensor_name}_shape_all.png'
-        disp_all.save(save_to)
+        save_image(disp_all, save_to)
     return boxes_all, segm_maps_all, depth_maps_all
 
 
@@ -327,40 +437,73 @@ def create_coord_system(scale, global_transform: Optional[T] = None):
     return coord
 
 
+# `merge_primitives` tessellates and merges primitives before rendering (see `tessellate_utils.merge_primitives`),
+# which is faster for many primitives but replaces analytic spheres and cylinders with meshes
 SCENE_PRESETS = {
     'rover_background': {
         'xml_path': XML_PATH_ROVER_BACKGROUND,
         'ground_plane': find_ground_plane_rover(),
         'box': find_box_rover(),
         'coord_scale': 1,
+        'merge_primitives': False,
     },
     'indoors_no_window': {
         'xml_path': XML_PATH_INDOORS_NO_WINDOW,
         'ground_plane': find_ground_plane_indoors(shift=0.),    # shift=2.
         'box': find_box_indoors(),
         'coord_scale': 1,
+        'merge_primitives': False,
     },
     'indoors': {
         'xml_path': XML_PATH_INDOORS,
         'ground_plane': find_ground_plane_indoors(),
         'box': find_box_indoors(),
         'coord_scale': 1,
+        'merge_primitives': False,
     },
     'outdoors': {
         'xml_path': XML_PATH_OUTDOORS,
         'ground_plane': find_ground_plane_outdoors(),
         'box': find_box_outdoors(),
         'coord_scale': 1,
+        'merge_primitives': False,
     },
     'table': {
         'xml_path': XML_PATH_TABLE,
         'ground_plane': find_ground_plane_table(),
         'box': find_box_table(),
         'coord_scale': 1,
+        'merge_primitives': False,
     },
 }
 
 
+_preset_lock = threading.Lock()
+
+
+def create_preset_scene_dict(preset_id: str) -> dict:
+    # scene dict holding new objects of the preset scene, not shared with other scenes; add shapes to it and `mi.load_dict`
+    # the xml is loaded for every scene, under a lock since scenes are built from worker threads
+    with _preset_lock, suppress_output():
+        preset_scene = mi.load_file(SCENE_PRESETS[preset_id]['xml_path'])
+    scene_dict = {'type': 'scene', 'integrator': preset_scene.integrator()}
+    for i, sensor in enumerate(preset_scene.sensors()):
+        scene_dict[f'preset_sensor_{i:02d}'] = sensor
+    for i, emitter in enumerate(preset_scene.emitters()):
+        if not mi.has_flag(emitter.flags(), mi.EmitterFlags.Surface):  # area emitters come with their shapes
+            scene_dict[f'preset_emitter_{i:02d}'] = emitter
+    for i, s in enumerate(preset_scene.shapes()):
+        scene_dict[f'preset_shape_{i:03d}'] = s
+    return scene_dict
+
+
+def load_ply_assets(shape: list) -> list:
+    # PLY primitives become in-memory meshes backed by the mesh asset cache; names match the `f'{i:02d}'` scene dict keys
+    return [create_asset_mesh(f'{i:02d}', s['filename'], s.get('to_world'), s.get('bsdf'))
+            if isinstance(s, dict) and s.get('type') == 'ply' and set(s.keys()) <= {'type', 'filename', 'to_world', 'bsdf'}
+            else s for i, s in enumerate(shape)]
+
+
 def concatenate_xml_files(orig_path: str, tmp_path: str):
     original_tree = ET.parse(orig_path)
     original_root = original_tree.getroot()
@@ -637,9 +780,10 @@ def compute_best_views(box, target_box):
     return final_bestviews, final_fovs
 
 
-def compute_normalization(shape, preset_id='rover_background'):
+def compute_normalization(shape, preset_id='rover_background', box: Optional[BBox] = None):
     preset = SCENE_PRESETS[preset_id]
-    box = compute_bbox(shape)
+    if box is None:
+        box = compute_bbox(shape)
     target_box = preset['box']
     scale = min(target_box.sizes / box.sizes)
     normalization = (translation_matrix((target_box.center[0], preset['ground_plane'], target_box.center[2]))
@@ -648,12 +792,28 @@ def compute_normalization(shape, preset_id='rover_background'):
     return normalization
 
 
+def create_orbit_sensors(box: BBox) -> tuple[dict[str, mi.Sensor], dict]:
+    # `box` is **after** normalization
+    target = box.center
+    num_frames = NUM_FRAMES  # 6
+    elev = ELEVATION  # -20
+    radius = np.linalg.norm(box.sizes) / 2 * REL_CAM_RADIUS# * 2
+    # sensors are cached by pose, fov and resolution, and shared across frames and engine modes
+    sensor_info = create_orbit_rig(target, radius=radius, elevation=elev, num_frames=num_frames, fov=FOV)
+    sensors = load_rig_sensors(sensor_info, resolution=RESOLUTION)
+    return sensors, sensor_info
+
+
 def execute_from_preset(shape: Shape, save_dir: Optional[str], preset_id: Literal['rover_background'] = 'rover_background',
                         # normalization: Union[None, T] = None,
                         # sensors: Union[None, dict[str, mi.Sensor]] = None,
                         prev_out: Optional[dict] = None,
                         timestep: Optional[tuple[int, int]] = None,
+                        denoise: bool = DENOISE,
+                        render_budget: float = RENDER_BUDGET,
+                        render_aovs: bool = False,
                         ) -> dict:
+    # `render_aovs`: also render depth, primitive ids and normals in the same pass, see `split_aov_pass`
     out = dict()
     normalization: Union[None, T] = None if prev_out is None else prev_out['normalization']
     sensors: Union[None, dict[str, mi.Sensor]] = None if prev_out is None else prev_out['sensors']
@@ -669,26 +829,11 @@ def execute_from_preset(shape: Shape, save_dir: Optional[str], preset_id: Litera
         # print('target', target_box)
 
     shape = _preprocess_shape(shape)
+    scene_key = hash_scene({'preset_id': preset_id, 'xml_path': xml_dependencies(preset['xml_path']),
+                            'merge_primitives': preset.get('merge_primitives', False), 'denoise': denoise,
+                            'render_aovs': render_aovs, 'lod_pixels': 0 if render_aovs else LOD_PIXELS, 'shape': shape})
 
-    ply_path_to_tmp_ply_path: dict[str, str] = {}
-    tmp_shape = []
-    tmp_ply_dir = Path(preset['xml_path']).parent / 'meshes'
-    tmp_ply_dir.mkdir(exist_ok=True, parents=True)
-    mesh_shape = []
-    for s in shape:
-        if s['type'] == 'ply':
-            ply_path = Path(s['filename']).absolute().as_posix()
-            if ply_path not in ply_path_to_tmp_ply_path:
-                tmp_ply_path = tmp_ply_dir / f'tmp_{uuid.uuid4()}.ply'
-                # print('creating soft link', tmp_ply_path, '->', s['filename'])
-                tmp_ply_path.symlink_to(s['filename'])
-                ply_path_to_tmp_ply_path[ply_path] = tmp_ply_path.as_posix()
-
-            tmp_shape.append({'filename': ply_path_to_tmp_ply_path[ply_path], **{kk: vv for kk, vv in s.items() if kk != 'filename'}})
-            mesh_shape.append({'filename': ply_path_to_tmp_ply_path[ply_path], **{kk: vv for kk, vv in s.items() if kk != 'filename'}})
-        else:
-            tmp_shape.append(s)
-    shape = tmp_shape
+    mesh_shape = [s for s in shape if s['type'] == 'ply']
 
     if False: #engine_mode == 'neural':
         from optimize_utils import layout_optimize, layout_optimize_mi
@@ -703,15 +848,29 @@ def execute_from_preset(shape: Shape, save_dir: Optional[str], preset_id: Litera
     #     if 'filename' in s.keys() and 'tmp' in s['filename']:
     #         need_rescale_ids.append(f'{i:02d}')
     else:
-        tmp_xml_file = Path(preset['xml_path']).with_name(f'tmp_{uuid.uuid4()}.xml')
-        scene_dict = {'type': 'scene', **{f'{i:02d}': s for i, s in enumerate(shape)}}
-        with open(os.devnull, 'w') as f, redirect_stdout(f):
-            mi.xml.dict_to_xml(scene_dict, tmp_xml_file)
-        tree = concatenate_xml_files(preset['xml_path'], tmp_xml_file.as_posix())
-
-        tree.write(tmp_xml_file.as_posix())
-        with suppress_output():
-            scene: mi.Scene = mi.load_file(tmp_xml_file.as_posix())
+        scene: Optional[mi.Scene] = None
+        load_time = 0.
+        # a single aov integrator, so that the channels of `AOV_PASS` come last
+        aovs = ','.join(([AOVS] if denoise else []) + ([AOV_PASS] if render_aovs else []))
+
+        def load_scene() -> mi.Scene:
+            # only loaded on a render cache miss
+            nonlocal scene, load_time
+            if scene is None:
+                load_start = time.time()
+                render_shape = shape
+                if not render_aovs:  # simplified primitives have no per-primitive ids
+                    render_shape, _ = simplify_primitives(render_shape, list(out['sensors'].values()))
+                if preset.get('merge_primitives', False) and not render_aovs:  # merged meshes have no per-primitive ids
+                    render_shape = merge_primitives(render_shape)
+                render_shape = load_ply_assets(render_shape)
+                scene_dict = create_preset_scene_dict(preset_id) | {f'{i:02d}': s for i, s in enumerate(render_shape)}
+                if denoise or render_aovs:
+                    scene_dict['integrator'] = {'type': 'aov', 'aovs': aovs, 'integrator': scene_dict['integrator']}
+                with suppress_output():
+                    scene = mi.load_dict(scene_dict)
+                load_time = time.time() - load_start
+            return scene
     # out['sensors'] = {'rendering': scene.sensors()[0]}
 
     # also for rescale the vertex color
@@ -723,172 +882,8 @@ def execute_from_preset(shape: Shape, save_dir: Optional[str], preset_id: Litera
     #         shape_params.update()
 
     if sensors is None:
-        sensors = {}
         box = compute_bbox(shape)  # box **after** normalization
-        canon_sensor = scene.sensors()[0]
-        # canon_transform = canon_sensor.world_transform()
-
-        # time_step = timestep[0]
-        # all_time_step = timestep[1]
-        # # TODO always 6 views for now
-        #
-        # # points = [
-        # #     np.asarray((box.center[0] - box.sizes[0] * .6, box.center[1] + box.sizes[1] * .6, box.center[2] + box.sizes[2] * 2)),
-        # #     np.asarray((box.center[0], box.center[1] + box.sizes[1] * .6, box.center[2] + box.sizes[2] * 2)),
-        # #     np.asarray((box.center[0] + box.sizes[0] * .6, box.center[1] + box.sizes[1] * .6, box.center[2] + box.sizes[2] * 2)),
-        # #     np.asarray((box.center[0] + box.sizes[0] * .6, box.center[1] + box.sizes[1] * 1, box.center[2] + box.sizes[2] * 2)),
-        # #     np.asarray((box.center[0], box.center[1] + box.sizes[1] * 1, box.center[2] + box.sizes[2] * 2)),
-        # #     np.asarray((box.center[0] - box.sizes[0] * .6, box.center[1] + box.sizes[1] * 1, box.center[2] + box.sizes[2] * 2)),
-        # # ]
-        #
-        # traj_campos = list()
-        #
-        # campos, fovs = generate_forward_facing_spiral(box, num=all_time_step)
-        # sample_fov = max(fovs) * 1.1
-        # if sample_fov > 180:
-        #     # from pdb import set_trace; set_trace()
-        #     sample_fov = 60  # FIXME
-        #     fovs = [sample_fov] * len(fovs)
-        # sample_fovs = [sample_fov for _ in fovs]     # uncomment this if need to use the same fovs
-        # traj_campos.append({
-        #     'campos': campos,
-        #     'fovs_changing': fovs,
-        #     'fovs_fixing': sample_fovs,
-        #     'traj_name': 'forward_facing'
-        # })
-        #
-        # campos, fovs = generate_360_spiral(box, num=all_time_step)
-        # sample_fov = max(fovs) * 1.1
-        # if sample_fov > 180:
-        #     # from pdb import set_trace; set_trace()
-        #     sample_fov = 60  # FIXME
-        #     fovs = [sample_fov] * len(fovs)
-        # sample_fovs = [sample_fov for _ in fovs]     # uncomment this if need to use the same fovs
-        # traj_campos.append({
-        #     'campos': campos,
-        #     'fovs_changing': fovs,
-        #     'fovs_fixing': sample_fovs,
-        #     'traj_name': '360_view'
-        # })
-        #
-        # for traj in traj_campos:
-        #     points = traj['campos']
-        #     all_cam_pos = np.stack(points)
-        #     all_cam_pos = all_cam_pos[time_step:]
-        #
-        #     fovs_changing = traj['fovs_changing']
-        #     fovs_fixing = traj['fovs_fixing']
-        #     traj_name = traj['traj_name']
-        #
-        #     for cidx in range(all_cam_pos.shape[0]):
-        #         cam_pos = all_cam_pos[cidx]
-        #         sensor_changing: mi.Sensor = mi.load_dict({
-        #             'type': 'perspective',
-        #             'to_world': mi.scalar_rgb.Transform4f.look_at(
-        #                 origin=cam_pos,
-        #                 target=box.center,
-        #                 up=[0, 1, 0]
-        #             ),
-        #             'fov': fovs_changing[cidx],
-        #             'film': {
-        #                 'type': 'hdrfilm',
-        #                 'width': 512,
-        #                 'height': 512,
-        #             }
-        #         })
-        #         # sensors[f'rendering_traj_{traj_name}_changing_{cidx:03d}'] = sensor_changing
-        #     for cidx in range(all_cam_pos.shape[0]):
-        #         cam_pos = all_cam_pos[cidx]
-        #         sensor_fixing: mi.Sensor = mi.load_dict({
-        #             'type': 'perspective',
-        #             'to_world': mi.scalar_rgb.Transform4f.look_at(
-        #                 origin=cam_pos,
-        #                 target=box.center,
-        #                 up=[0, 1, 0]
-        #             ),
-        #             'fov': fovs_fixing[cidx],
-        #             'film': {
-        #                 'type': 'hdrfilm',
-        #                 'width': 512,
-        #                 'height': 512,
-        #             }
-        #         })
-        #         # sensors[f'rendering_traj_{traj_name}_fixing_{cidx:03d}'] = sensor_fixing
-        #
-        # sensor: mi.Sensor = mi.load_dict({
-        #     'type': 'perspective',
-        #     # 'type': 'orthographic',
-        #     # 'to_world': mi.scalar_rgb.Transform4f.translate(
-        #     #     box.size * np.asarray(rel_offset),
-        #     # ) @ canon_sensor.world_transform(),
-        #     'to_world': mi.scalar_rgb.Transform4f.look_at(
-        #         # origin=np.array(canon_transform.translation()) + box.size * np.asarray([0, .4, -2]),
-        #         # origin=np.array([target_box.center[0], target_box.max[1], target_box.max[2]]),
-        #         origin=target_box.max,
-        #         # target=np.array(canon_transform.matrix)[:3, :3] @ np.array([0, 0, 1]) + np.array(canon_transform.translation()),
-        #         target=box.center,
-        #         up=[0, 1, 0]
-        #     ),
-        #     'fov': np.array(mi.traverse(canon_sensor)['x_fov']).item(),
-        #     'film': {
-        #         'type': 'hdrfilm',
-        #         'width': 512,
-        #         'height': 512,
-        #         'pixel_format': 'rgba',
-        #     }
-        # })
-        # # sensors['rendering_up'] = sensor
-        #
-        # bestviews, bestview_fovs = compute_best_view_from_z(box)  # compute_best_views(box, target_box)
-        # bestviews, bestview_fovs = compute_best_view_from_z_from_top(box, fov=40, num_frames=6, alpha=-0.1, pad=.1)  # compute_best_views(box, target_box)
-        # # take the first and last view, interpolate the trajectory to be of fixed radius towards box.center
-        # first_view = np.asarray(bestviews[0])
-        target = box.center
-        # dir1 = first_view - target
-        # elev = np.rad2deg(np.arctan2(dir1[1], np.linalg.norm([dir1[0], dir1[2]])))
-        # radius = np.linalg.norm(dir1)
-        # print(f'[INFO] elev: {elev}, radius: {radius}')
-        num_frames = NUM_FRAMES  # 6
-        azims = np.linspace(0, 360, num_frames, endpoint=False).tolist()
-        # bestviews = [orbit_camera(-elev, azim, radius=radius, target=target) for azim in azims]
-        #
-        #     # d = dir1 * (i / (num_frames - 1)) + dir2 * (1 - i / (num_frames - 1))
-        #     # d = d / np.linalg.norm(d) * np.linalg.norm(dir1)
-        #     # bestviews.append(target + d)
-
-        elev = ELEVATION  # -20
-        radius = np.linalg.norm(box.sizes) / 2 * REL_CAM_RADIUS# * 2
-        bestviews = [orbit_camera(elev, azim, radius=radius, target=target) for azim in azims]
-        fov = FOV
-        bestview_fovs = [fov] * len(bestviews)
-
-        sensor_info = {
-            'elev': [elev] * num_frames,
-            'radius': [radius] * num_frames,
-            'azim': azims,
-            'eyes': bestviews,
-            'targets': [target] * num_frames,
-            'fov': bestview_fovs,
-        }
-
-        for vidx in range(len(bestviews)):
-            sensor_bestview: mi.Sensor = mi.load_dict({
-                'type': 'perspective',
-                'to_world': mi.scalar_rgb.Transform4f.look_at(
-                    origin=bestviews[vidx],
-                    # target=np.array(canon_transform.matrix)[:3, :3] @ np.array([0, 0, 1]) + np.array(canon_transform.translation()),
-                    target=box.center,
-                    up=[0, 1, 0]
-                ),
-                'fov': bestview_fovs[vidx],
-                'film': {
-                    'type': 'hdrfilm',
-                    'width': RESOLUTION,
-                    'height': RESOLUTION,
-                    'pixel_format': 'rgba',
-                }
-            })
-            sensors[f'bestview_{vidx:02d}'] = sensor_bestview
+        sensors, sensor_info = create_orbit_sensors(box)
 
     # rename sensors
     sensors_cat = {}
@@ -902,11 +897,49 @@ def execute_from_preset(shape: Shape, save_dir: Optional[str], preset_id: Litera
     save_dir = Path(save_dir)
     save_dir.mkdir(exist_ok=True, parents=True)
     # for k in tqdm(out['sensors'].keys(), desc='rendering RGBs...'):  # cause misformatted outputs in execute_err.txt
+    def render_view(k: str, spp: int, seed: int = 0, scale: float = 1.) -> np.ndarray:
+        # AOVs keep the reconstruction filter of the RGB pass; ids blended across pixels are dropped in `split_aov_pass`
+        sensor = out['sensors'][k] if scale == 1 else _load_scaled_sensor(out['sensors'][k], scale)
+        if use_tiles(sensor, spp):
+            scene_spec = make_scene_spec(preset['xml_path'], shape, merge=preset.get('merge_primitives', False) and not render_aovs,
+                                         aovs=aovs if denoise or render_aovs else None,
+                                         lod_sensors=list(out['sensors'].values()), lod_pixels=0 if render_aovs else LOD_PIXELS)
+            return cached_render(load_scene, scene_key, sensor=sensor, spp=spp, seed=seed,
+                                 render_fn=lambda: render_tiled(scene_spec, sensor, spp, seed=seed)[0])
+        return cached_render(load_scene, scene_key, sensor=sensor, spp=spp, seed=seed)
+
+    spp = DENOISE_SPP if denoise else SPP
+    if render_budget > 0:
+        sizes = {k: tuple(np.asarray(mi.traverse(sensor)['film.size']).ravel().tolist()) for k, sensor in out['sensors'].items()}
+        images = render_with_budget(render_view, list(out['sensors'].keys()), sizes, budget=render_budget, target_spp=spp,
+                                    setup_time=lambda: load_time)
+    index_map: Optional[np.ndarray] = None
+
+    def load_index_map() -> np.ndarray:
+        # cached with the renderings, so that render cache hits don't load the scene
+        nonlocal index_map
+        if index_map is None:
+            cache = get_render_cache()
+            key = None if cache is None or scene_key is None else hash_scene({'scene': scene_key, 'shape_index_map': True})
+            index_map = None if cache is None else cache.get(key)
+            if index_map is None:
+                index_map = shape_index_map(load_scene())
+                if cache is not None:
+                    cache.put(key, index_map)
+        return index_map
+
     for k in out['sensors'].keys():
-        image = mi.render(scene, sensor=out['sensors'][k], spp=SPP)
+        start = time.time()
+        image = images[k] if render_budget > 0 else render_view(k, spp)
+        if render_aovs:
+            image, out.setdefault('aovs', {})[k] = split_aov_pass(load_index_map(), image, num_shapes=len(shape))
+        if denoise:
+            render_time = time.time() - start
+            start = time.time()
+            image = denoise_image(image)
+            print(f'[INFO] {k}: render {render_time:.2f}s, denoise {time.time() - start:.2f}s')
         image = mi.util.convert_to_bitmap(image)
-        image = Image.fromarray(np.asarray(image))
-        image.save(save_dir / f'{k}.png')
+        out.setdefault('paths', {})[k] = save_image(image, save_dir / f'{k}.png')
 
     # coord = mi.load_dict(create_coord_system(preset['coord_scale'], out['normalization']) | {f'{i:02d}': s for i, s in enumerate(shape)})
     coord_dict = mi.load_dict(create_coord_system(preset['coord_scale'], out['normalization']))
@@ -917,36 +950,35 @@ def execute_from_preset(shape: Shape, save_dir: Optional[str], preset_id: Litera
         segm: np.typing.NDArray[np.bool_] = depth > 1e-2  # (h, w)
         coord = np.asarray(coord[:, :, :3]).clip(0, 1)
         # coord[~segm] = 0
-        coord_save_path = (save_dir / f'{k}_coord.png')
-        Image.fromarray(np.dstack([(coord * 255).astype(np.uint8),
-                                   segm.astype(np.uint8) * 255])).save(coord_save_path.as_posix())
-        Image.blend(Image.open(save_dir / f'{k}.png').convert('RGBA'), Image.open(coord_save_path).convert('RGBA'), alpha=.3).save((save_dir / f'{k}_coord_overlay.png'))
-
-    render_depth = False
-    if render_depth:
-        depth_scene_dict = {'type': 'scene', 'integrator': {'type': 'depth'}, **{f'{i:02d}': s for i, s in enumerate(shape)}}
-        depth_scene = mi.load_dict(depth_scene_dict)
+        coord = Image.fromarray(np.dstack([(coord * 255).astype(np.uint8), segm.astype(np.uint8) * 255]))
+        save_image(coord, save_dir / f'{k}_coord.png')
+        save_image(Image.blend(Image.fromarray(load_frame(out['paths'][k])).convert('RGBA'), coord.convert('RGBA'), alpha=.3),
+                   save_dir / f'{k}_coord_overlay.png')
+
+    if render_aovs:
         depth_save_dir = save_dir / 'depth'
         depth_save_dir.mkdir(exist_ok=True)
-        for k in out['sensors'].keys():
-            image = mi.render(depth_scene, sensor=out['sensors'][k], spp=4)
-
-            depth: np.typing.NDArray[np.float32] = np.asarray(image)
-            segm: np.typing.NDArray[np.bool_] = depth > 0  # (h, w)
+        normal_save_dir = save_dir / 'normal'
+        normal_save_dir.mkdir(exist_ok=True)
+        for k, aov in out['aovs'].items():
+            segm: np.typing.NDArray[np.bool_] = aov['ids'] >= 0  # (h, w)
+            depth: np.typing.NDArray[np.float32] = np.where(segm, aov['depth'], 0)
+            normal = np.where(segm[:, :, None], (aov['normal'] + 1) / 2, 0)
+            save_image((normal.clip(0, 1) * 255).astype(np.uint8), normal_save_dir / f'{k}.png')
             if segm.any():
                 valid_depth = depth[segm]
                 dmin = valid_depth.min()
                 dmax = valid_depth.max()
                 depth_normalized = np.zeros_like(depth)
-                depth_normalized[segm] = .2 + .8 * (depth[segm] - dmin) / (dmax - dmin)
+                depth_normalized[segm] = .2 + .8 * (depth[segm] - dmin) / max(dmax - dmin, 1e-6)
             else:
                 depth_normalized = np.zeros_like(depth)
-            Image.fromarray((depth_normalized * 255).astype(np.uint8)).save((depth_save_dir / f'{k}.png').as_posix())
+            save_image((depth_normalized * 255).astype(np.uint8), depth_save_dir / f'{k}.png')
 
     # clean up
-    tmp_xml_file.unlink()
-    for tmp_ply_path in ply_path_to_tmp_ply_path.values():
-        Path(tmp_ply_path).unlink()
+    flush_images()  # downstream engines read the PNGs from disk
+    if get_render_cache() is not None:
+        get_render_cache().print_stats()
 
     # we should do optimization after loading sensors?
     # from optimize_utils import debug_layout_optimize
@@ -955,6 +987,166 @@ def execute_from_preset(shape: Shape, save_dir: Optional[str], preset_id: Litera
     return out
 
 
+ANIMATION_NUM_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def compute_animation_bbox(frames: list[Shape]) -> BBox:
+    # streaming union over frames, instead of computing the bbox of `sum(frames, [])`
+    box = None
+    for frame in frames:
+        if len(frame) == 0:
+            continue
+        frame_box = compute_bbox(frame)
+        box = frame_box if box is None else union_bboxes([box, frame_box])
+    return box if box is not None else union_bboxes([])
+
+
+def match_animation_frames(frames: list[Shape]) -> list[Optional[list[int]]]:
+    """
+    Matches primitives of each frame to primitives of the first frame by provenance, i.e. the function names on
+    `info['stack']` (call ids differ across frames). Returns, for each frame, the index in the first frame of each of its
+    primitives, or None if the frame differs from the first one by more than primitive transforms.
+    """
+    def get_keys(frame: Shape) -> list[tuple]:
+        counts: dict[tuple, int] = {}
+        keys = []
+        for s in frame:
+            signature = hash_scene({k: v for k, v in s.items() if k not in ['to_world', 'info']})
+            key = (tuple(name for name, _ in s.get('info', {}).get('stack', [])), signature)
+            counts[key] = counts.get(key, -1) + 1
+            keys.append((*key, counts[key]))
+        return keys
+
+    keys_first = {key: ind for ind, key in enumerate(get_keys(frames[0]))}
+    matches = []
+    for frame in frames:
+        keys = get_keys(frame)
+        if len(keys) != len(keys_first) or any(key[1] is None or key not in keys_first for key in keys):
+            matches.append(None)
+        else:
+            matches.append([keys_first[key] for key in keys])
+    return matches
+
+
+class _AnimationScene:
+    # preset scene loaded once, primitives are moved with `mi.traverse` parameter updates
+    def __init__(self, shape: Shape, preset_id: str):
+        scene_dict = create_preset_scene_dict(preset_id) | {f'{i:02d}': s for i, s in enumerate(load_ply_assets(shape))}
+        with suppress_output():
+            self.scene: mi.Scene = mi.load_dict(scene_dict)
+        self.params = mi.traverse(self.scene)
+        self.to_worlds = [np.asarray(s['to_world'].matrix, dtype=np.float64).reshape(4, 4) for s in shape]
+        self.vertices: dict[int, tuple[np.ndarray, Optional[np.ndarray]]] = {}
+        for i in range(len(shape)):
+            key = f'{i:02d}'
+            if abs(np.linalg.det(self.to_worlds[i][:3, :3])) < 1e-12:
+                continue  # singular in the first frame, only updated by a rebuild
+            if f'{key}.to_world' not in self.params and f'{key}.vertex_positions' in self.params:
+                # meshes (cube, ply) bake `to_world` into vertices
+                normals = None
+                if f'{key}.vertex_normals' in self.params and len(self.params[f'{key}.vertex_normals']) > 0:
+                    normals = np.asarray(self.params[f'{key}.vertex_normals']).reshape(-1, 3)
+                self.vertices[i] = (np.asarray(self.params[f'{key}.vertex_positions']).reshape(-1, 3), normals)
+
+    def set_frame(self, to_worlds: list[np.ndarray]) -> bool:
+        # returns False if some primitive moved but can't be updated in place
+        for i, mat in enumerate(to_worlds):
+            if i in self.vertices and f'{i:02d}.to_world' not in self.params \
+                    and abs(np.linalg.det(mat[:3, :3])) < 1e-12 and not np.allclose(mat, self.to_worlds[i]):
+                return False  # e.g. scaled to zero, vertices can't be moved back from a singular transform
+        for i, mat in enumerate(to_worlds):
+            key = f'{i:02d}'
+            if f'{key}.to_world' in self.params:
+                self.params[f'{key}.to_world'] = type(self.params[f'{key}.to_world'])(mat)
+            elif i in self.vertices:
+                delta = mat @ np.linalg.inv(self.to_worlds[i])
+                positions, normals = self.vertices[i]
+                self.params[f'{key}.vertex_positions'] = (positions @ delta[:3, :3].T + delta[:3, 3]).astype(np.float32).ravel()
+                if normals is not None:
+                    normals = normals @ np.linalg.inv(delta[:3, :3])
+                    normals = normals / np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-12)
+                    self.params[f'{key}.vertex_normals'] = normals.astype(np.float32).ravel()
+            elif not np.allclose(mat, self.to_worlds[i]):
+                return False
+        self.params.update()
+        return True
+
+
+def execute_animation_from_preset(frames: list[Shape], save_dir: str, preset_id: str = 'rover_background',
+                                  num_workers: int = ANIMATION_NUM_WORKERS) -> dict:
+    """
+    Renders all frames of an animation with shared normalization and sensors.
+    The first frame renders all views, the remaining frames only `rendering_traj_000`.
+    Saves to `save_dir/{frame_ind:02d}/rendering_traj_{view_ind:03d}.png`.
+    """
+    start = time.time()
+    preset = SCENE_PRESETS[preset_id]
+    box = compute_animation_bbox(frames)
+    normalization = compute_normalization(None, preset_id, box=box)
+    # normalization is a scale and a translation, so the box **after** normalization is the normalized box
+    corners = np.stack([box.min, box.max]) @ np.asarray(normalization)[:3, :3].T + np.asarray(normalization)[:3, 3]
+    box_min, box_max = corners.min(axis=0), corners.max(axis=0)
+    box = BBox(center=(box_min + box_max) / 2, min=box_min, max=box_max, sizes=box_max - box_min,
+               size=float(max(box_max - box_min)))
+    sensors, sensor_info = create_orbit_sensors(box)
+    sensors = {f'rendering_traj_{i:03d}': sensor for i, sensor in enumerate(sensors.values())}
+    out = {'normalization': normalization, 'sensors': sensors, 'sensor_info': sensor_info}
+
+    shapes = [_preprocess_shape(transform_shape(frame, normalization)) for frame in frames]
+    merge = preset.get('merge_primitives', False)
+    scene_keys = [hash_scene({'preset_id': preset_id, 'xml_path': xml_dependencies(preset['xml_path']),
+                              'merge_primitives': merge, 'shape': shape}) for shape in shapes]
+    matches = match_animation_frames(frames)
+    save_dir = Path(save_dir)
+    variant = mi.variant()
+
+    def render_frames(frame_inds: list[int]) -> dict[int, list[Path]]:
+        mi.set_variant(variant)  # variants are thread-local
+        # `mi.render` develops into the film of the sensor, so workers must not share sensors
+        worker_sensors = {k: _load_scaled_sensor(sensor, 1.) for k, sensor in sensors.items()}
+        anim_scene: Optional[_AnimationScene] = None
+        frame_paths = {}
+        for frame_ind in frame_inds:
+            def load_scene(frame_ind: int = frame_ind) -> mi.Scene:
+                nonlocal anim_scene
+                match = None if merge else matches[frame_ind]  # merged meshes can't be moved primitive by primitive
+                if match is not None:
+                    if anim_scene is None:
+                        anim_scene = _AnimationScene(shapes[0], preset_id)
+                    to_worlds = [None] * len(match)
+                    for s, ind in zip(shapes[frame_ind], match):
+                        to_worlds[ind] = np.asarray(s['to_world'].matrix, dtype=np.float64).reshape(4, 4)
+                    if anim_scene.set_frame(to_worlds):
+                        return anim_scene.scene
+                if not merge:
+                    print(f'[INFO] reloading scene for frame {frame_ind}')
+                render_shape = merge_primitives(shapes[frame_ind]) if merge else shapes[frame_ind]
+                scene_dict = create_preset_scene_dict(preset_id) | {f'{i:02d}': s for i, s in enumerate(load_ply_assets(render_shape))}
+                with suppress_output():
+                    return mi.load_dict(scene_dict)
+
+            frame_save_dir = save_dir / f'{frame_ind:02d}'
+            frame_save_dir.mkdir(exist_ok=True, parents=True)
+            frame_paths[frame_ind] = []
+            for k in (sensors.keys() if frame_ind == 0 else ['rendering_traj_000']):
+                image = cached_render(load_scene, scene_keys[frame_ind], sensor=worker_sensors[k], spp=SPP)
+                image = mi.util.convert_to_bitmap(image)
+                frame_paths[frame_ind].append(save_image(image, frame_save_dir / f'{k}.png'))
+        return frame_paths
+
+    # contiguous chunks so that each worker loads its scene once and parameter updates are small
+    num_workers = max(1, min(num_workers, len(frames)))
+    chunks = [chunk.tolist() for chunk in np.array_split(np.arange(len(frames)), num_workers)]
+    frame_paths = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for chunk_paths in executor.map(render_frames, chunks):
+            frame_paths.update(chunk_paths)
+    out['frame_paths'] = [frame_paths[i] for i in range(len(frames))]
+    flush_images()
+    print(f'[INFO] rendered {len(frames)} frames with {num_workers} workers in {time.time() - start:.2f}s')
+    return out
+
+
 def execute(shape: Shape, save_dir: Union[str, None] = None, save_prefix: Union[str, None] = None,
             sensor: Union[dict, None, int] = None, extra_scene_dict: Union[dict, None] = None) -> dict:
     if save_dir is None:
@@ -982,11 +1174,12 @@ def execute(shape: Shape, save_dir: Union[str, None] = None, save_prefix: Union[
         scene_dict['sensor'] = sensor
         sensors = [0]
     scene = mi.load_dict(scene_dict)
+    paths = []
     for sensor in sensors:
         image = mi.render(scene, sensor=sensor)
         image = mi.util.convert_to_bitmap(image)
-        image = Image.fromarray(np.asarray(image))
-        image.save(save_dir / f'{save_prefix}sensor_{sensor:02d}.png')
+        paths.append(save_image(image, save_dir / f'{save_prefix}sensor_{sensor:02d}.png'))
+    flush_images(paths)
     return scene_dict
 
 
@@ -1014,22 +1207,40 @@ sphere_fn: Callable[[P, Union[float, P]], Shape] = lambda color=(1, 1, 1), scale
 }]
 
 
+_curve_dir: Optional[Path] = None
+_curve_paths: dict[str, str] = {}
+
+
+def materialize_curve(control_points: np.typing.NDArray[np.float64]) -> str:
+    # Mitsuba curves only load from files; one content-addressed file per distinct curve, shared by all primitives
+    # using it, and removed at exit
+    global _curve_dir
+    control_points = np.ascontiguousarray(control_points, dtype=np.float64)
+    key = hashlib.sha256(control_points.tobytes()).hexdigest()
+    if key not in _curve_paths:
+        if _curve_dir is None:
+            tmpdir = Path(PROJ_DIR) / 'tmp'
+            tmpdir.mkdir(exist_ok=True)
+            _curve_dir = Path(tempfile.mkdtemp(prefix='curves_', dir=tmpdir.as_posix()))
+            atexit.register(shutil.rmtree, _curve_dir.as_posix(), ignore_errors=True)
+        path = _curve_dir / f'{key}.txt'
+        np.savetxt(path.as_posix(), control_points, fmt='%.9g')  # one `x y z radius` per line
+        _curve_paths[key] = path.as_posix()
+    return _curve_paths[key]
+
+
 def curve_fn(name: str, control_points: List[P], radius: Union[float, List[float]], color: P) -> Shape:
     if not isinstance(radius, (list, tuple)):
         radius = [radius] * len(control_points)
     if len(radius) != len(control_points):
         print(f'[ERROR] len({radius=}) != len({control_points=})')
         radius = [np.mean(radius)] * len(control_points)
-    tmpdir = Path(PROJ_DIR) / 'tmp'
-    tmpdir.mkdir(exist_ok=True)
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.txt', delete=False, dir=tmpdir.as_posix()) as f:
-        for point, r in zip(control_points, radius):
-            f.write(f"{float(point[0])} {float(point[1])} {float(point[2])} {float(r)}\n")
-        fn = f.name
 
     return [{
         'type': name,
-        'filename': fn,
+        # materialized in `_preprocess_shape`
+        'control_points': np.concatenate([np.asarray(control_points, dtype=np.float64).reshape(-1, 3),
+                                          np.asarray(radius, dtype=np.float64).reshape(-1, 1)], axis=1),
         'to_world': identity_matrix(),
         'bsdf': {'type': 'diffuse', 'reflectance': {'type': 'rgb', 'value': np.asarray(color[:3]).clip(0, 1)}},
         'info': {'stack': []}
@@ -1146,8 +1357,7 @@ def shap_e_fn(prompt: str, scale: Union[float, P, None] = None,
         'info': {'docstring': prompt, 'stack': []},
     }]
     if scale is not None:
-        with suppress_output():
-            box = compute_bbox(shape)
+        box = compute_asset_bbox(ply_save_path.as_posix())  # cached bounds, `to_world` is identity
         shape = transform_shape(shape, translation_matrix(-box.center))
 
         # angles = [0, np.pi / 2]
@@ -6,6 +6,7 @@ from pathlib import Path
 from engine.constants import ENGINE_MODE, PROMPT_MODE, DEBUG, LLM_PROVIDER
 from engine.utils.parsel_utils import setup_gpt
 from engine.utils.claude_client import setup_claude
+from engine.utils.replay_client import setup_replay
 from engine.utils.execute_utils import execute_command_retries, execute_command
 import time
 
@@ -13,7 +14,7 @@ root = Path(__file__).parent.parent.absolute()
 
 
 def create_lm():
-    return {'gpt': setup_gpt, 'claude': setup_claude}[LLM_PROVIDER]()
+    return {'gpt': setup_gpt, 'claude': setup_claude, 'replay': setup_replay}[LLM_PROVIDER]()
 
 
 def load_program(path: str):
@@ -2,7 +2,7 @@ from pathlib import Path
 import os
 from engine.utils.argparse_utils import setup_save_dir, modify_string_for_file
 from engine.constants import ENGINE_MODE
-from run_utils import SYSTEM_HEADER, run, read_tasks, SYSTEM_RULES, read_example, save_prompts
+from run_utils import SYSTEM_HEADER, run, read_tasks, SYSTEM_RULES, read_example, save_prompts, report_task_completions, generate_batch
 from engine.utils.parse_utils import create_diff, create_diff2
 import argparse
 
@@ -107,6 +107,9 @@ def get_parser():
     parser.add_argument(
         "--temperature", type=float, default=0.2, help="LM inference temperature"
     )
+    parser.add_argument(
+        "--batch", action="store_true", help="request all completions through the provider's batch endpoint"
+    )
     return parser
 
 
@@ -116,7 +119,12 @@ def main():
     tasks = args.tasks if args.tasks is not None else read_tasks()
 
     save_dir = setup_save_dir(args.log_dir, log_unique=True)
+    lm_config = {
+        "num_completions": args.num_completions,
+        "temperature": args.temperature,
+    }
 
+    user_prompts = []
     for task in tasks:
         name = modify_string_for_file(task)
         save_subdir = save_dir / name
@@ -135,16 +143,23 @@ def main():
             raise NotImplementedError(args.cond)
 
         save_prompts(save_subdir.as_posix(), SYSTEM_PROMPT, user_prompt)
+        user_prompts.append(user_prompt)
 
+    # with --batch, all completions of the sweep are requested up front, then executed task by task
+    batch_results = [None] * len(tasks)
+    if args.batch:
+        batch_results = generate_batch([(user_prompt, SYSTEM_PROMPT) for user_prompt in user_prompts],
+                                       lm_config=lm_config, tasks=tasks)
+
+    for task, user_prompt, results in zip(tasks, user_prompts, batch_results):
+        save_subdir = save_dir / modify_string_for_file(task)
         run(
             save_dir=save_subdir.as_posix(),
             user_prompt=user_prompt,
             system_prompt=SYSTEM_PROMPT,
             extra_info={"task": task},
-            lm_config={
-                "num_completions": args.num_completions,
-                "temperature": args.temperature,
-            },
+            lm_config=lm_config,
+            results=results,
         )
 
         if args.cond == 'edit':
@@ -154,6 +169,8 @@ def main():
                 create_diff(orig_prog, p.as_posix(), p.with_name('diff.txt').as_posix())
                 create_diff2(orig_prog, p.as_posix(), p.with_name('diff2.txt').as_posix())
 
+    report_task_completions(tasks)
+
 
 if __name__ == "__main__":
     main()
@@ -5,12 +5,14 @@ import os
 from enum import Enum
 from engine.utils.parsel_utils import setup_gpt
 from engine.utils.claude_client import setup_claude
+from engine.utils.replay_client import setup_replay
 
 try:
     from engine.utils.code_llama_client import setup_llama
 except:
     print("Unable to import Llama modules. Are you running on cluster?")
 from engine.utils.lm_utils import unwrap_results
+from engine.utils.llm_cache_utils import LLMCache, cache_task
 from engine.utils.execute_utils import execute_command
 from engine.constants import (
     ENGINE_MODE,
@@ -21,8 +23,14 @@ from engine.constants import (
     NUM_COMPLETIONS,
     MAX_TOKENS,
     DRY_RUN,
+    RENDER_BUDGET,
+    STREAM_PROGRAMS,
+    CRITIC_VIEWS,
 )
-from typing import List, Union, Optional
+from typing import Callable, List, Union, Optional
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 
 root = Path(__file__).parent
 
@@ -213,13 +221,16 @@ def generate(
     prepend_messages: Optional[list] = None,
     lm_config: Optional[dict] = None,
     skip_cache: bool = False,
+    on_code: Optional[Callable[[int, list[str]], None]] = None,
 ):
+    # on_code(index, lines) is called once a streamed completion has closed its code block (not for llama)
     if LLM_PROVIDER == "gpt":
         model = setup_gpt()
         _, results = model.generate(
             user_prompt=user_prompt,
             system_prompt=system_prompt,
             prepend_messages=prepend_messages,
+            on_code=on_code,
             **lm_config,
         )
         return results
@@ -231,6 +242,7 @@ def generate(
             user_prompt=user_prompt,
             system_prompt=system_prompt,
             skip_cache=skip_cache,
+            on_code=on_code,
             **lm_config,
         )
         return results
@@ -240,10 +252,66 @@ def generate(
             user_prompt=user_prompt, system_prompt=system_prompt, **lm_config
         )
         return results
+    elif LLM_PROVIDER == "replay":
+        model = setup_replay()
+        _, results = model.generate(
+            user_prompt=user_prompt,
+            system_prompt=system_prompt,
+            prepend_messages=prepend_messages,
+            on_code=on_code,
+            **lm_config,
+        )
+        return results
     else:
         raise NotImplementedError(f"{LLM_PROVIDER=}")
 
 
+def generate_batch(
+    prompts: list[tuple[Union[str, list[dict[str, str]]], str]],
+    lm_config: Optional[dict] = None,
+    tasks: Optional[List[str]] = None,
+) -> list[list[list[str]]]:
+    # completions of each (user_prompt, system_prompt), through the provider's batch endpoint where there is one
+    lm_config = lm_config if lm_config is not None else {}
+    if LLM_PROVIDER == "gpt":
+        model = setup_gpt()
+    elif LLM_PROVIDER == "claude":
+        model = setup_claude()
+    elif LLM_PROVIDER == "replay":
+        model = setup_replay()
+    elif LLM_PROVIDER == "llama":
+        model = setup_llama()
+    else:
+        model = None
+    if model is None or not hasattr(model, "generate_batch"):
+        print(f"[WARNING] {LLM_PROVIDER=} has no batch mode, generating one prompt at a time")
+        results = []
+        for ind, (user_prompt, system_prompt) in enumerate(prompts):
+            with cache_task(None if tasks is None else tasks[ind]):
+                results.append(generate(user_prompt=user_prompt, system_prompt=system_prompt, lm_config=lm_config))
+        return results
+    return model.generate_batch(prompts, tasks=tasks, **lm_config)
+
+
+def get_llm_cache() -> Optional[LLMCache]:
+    if LLM_PROVIDER == "gpt":
+        return setup_gpt().cache
+    if LLM_PROVIDER == "claude":
+        return setup_claude().cache
+    return None  # loading llama just for its cache isn't worth it
+
+
+def report_task_completions(tasks: List[str]):
+    # looked up through the task index of the cache, so it covers previous runs too
+    cache = get_llm_cache()
+    if cache is None:
+        return
+    for task in tasks:
+        completions = cache.completions_for_task(task)
+        print(f"[INFO] {task}: {sum(len(c) for c in completions.values())} cached completions "
+              f"over {len(completions)} prompts")
+
+
 def run(
     save_dir: str,
     user_prompt: Union[str, list[dict[str, str]], None],
@@ -255,7 +323,9 @@ def run(
     lm_config: Optional[dict] = None,
     code_only: bool = False,
     dry_run: bool = False,
+    results: Optional[list[list[str]]] = None,
 ):
+    # `results` are completions already generated, e.g. by `generate_batch`
     save_dir = Path(save_dir)
 
     lm_config = lm_config if lm_config is not None else {}
@@ -263,33 +333,26 @@ def run(
     with open((save_dir / "info.json").as_posix(), "w") as f:
         json.dump(info, f)
 
-    # Generate using GPT
-    results = generate(
-        user_prompt=user_prompt,
-        system_prompt=system_prompt,
-        prepend_messages=prepend_messages,
-        lm_config=lm_config,
-    )
+    programs = {}
+    request_start = time.time()
+    # unused budget of a trial rolls over to the next ones; streamed trials render during generation
+    render_budget_start = request_start
 
-    programs = []
-    for ind, result in enumerate(results):
+    def run_trial(ind: int, result: list[str], num_trials: int):
         trial_save_dir = save_dir / str(ind)
         trial_save_dir.mkdir(exist_ok=True)
-        with open((trial_save_dir / "raw.txt").as_posix(), "w") as f:
-            f.write("\n".join(result))
-
         try:
             lines = unwrap_results(result, code_only)
         except Exception as _:
             with open((trial_save_dir / "error.txt").as_posix(), "w") as f:
                 f.write(traceback.format_exc())
-            continue
+            return
         if lines is None:
             # with open((trial_save_dir / 'response.txt').as_posix(), 'w') as f:
             #     f.write('\n'.join(result))
-            continue
+            return
         program = "\n".join(lines)
-        programs.append(program)
+        programs[ind] = program
         with open((trial_save_dir / "raw.py").as_posix(), "w") as f:
             f.write(program)
         full_program = (
@@ -298,7 +361,8 @@ def run(
         with open((trial_save_dir / "program.py").as_posix(), "w") as f:
             f.write(full_program)
         if not execute:
-            continue
+            return
+        print(f"[INFO] trial {ind}: program ready {time.time() - request_start:.1f}s after the request")
         impl = get_impl(full_program)
 
         save_to = (trial_save_dir / "impl.py").as_posix()
@@ -309,6 +373,10 @@ def run(
             f'ENGINE_MODE={ENGINE_MODE} DEBUG={"1" if DEBUG else "0"} '
             f'PYTHONPATH={Path(__file__).parent / "prompts"}:$PYTHONPATH python {save_to}'
         )
+        if RENDER_BUDGET > 0:
+            # at least 1s, since 0 means unlimited
+            trial_budget = max((RENDER_BUDGET - (time.time() - render_budget_start)) / max(num_trials - ind, 1), 1.)
+            command = f"RENDER_BUDGET={trial_budget:.1f} {command}"
 
         # command_file = (trial_save_dir / "command.txt").as_posix()
         # with open(command_file, "w") as f:
@@ -316,7 +384,66 @@ def run(
 
         execute_command(command, trial_save_dir.as_posix(), dry_run=dry_run)
 
-    return programs
+    # trials run one at a time as before, but a streamed trial starts as soon as its code block is closed, while the
+    # other completions (and its own explanation) are still being generated
+    executor = ThreadPoolExecutor(max_workers=1)
+    futures = {}
+    lock = threading.Lock()
+
+    submitted = {}  # trial -> the completion (or streamed lines) it was started with
+
+    def submit(ind: int, result: list[str], num_trials: int):
+        with lock:
+            if ind not in futures:
+                submitted[ind] = result
+                futures[ind] = executor.submit(run_trial, ind, result, num_trials)
+
+    on_code = None
+    if STREAM_PROGRAMS and execute and results is None:
+        num_completions = lm_config.get("num_completions", NUM_COMPLETIONS)
+        on_code = lambda ind, lines: submit(ind, lines, num_completions)
+
+    try:
+        # Generate using GPT
+        if results is None:
+            with cache_task(info.get("task")):
+                results = generate(
+                    user_prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    prepend_messages=prepend_messages,
+                    lm_config=lm_config,
+                    on_code=on_code,
+                )
+        if on_code is None:
+            render_budget_start = time.time()
+
+        with lock:
+            streamed = set(futures.keys())
+        for ind, result in enumerate(results):
+            trial_save_dir = save_dir / str(ind)
+            trial_save_dir.mkdir(exist_ok=True)
+            with open((trial_save_dir / "raw.txt").as_posix(), "w") as f:
+                f.write("\n".join(result))
+            submit(ind, result, len(results))
+    finally:
+        # trials already started by `on_code` finish even if generation fails
+        executor.shutdown(wait=True)
+    for future in futures.values():
+        future.result()
+
+    # a retried stream may have closed a different code block than the completion it returned, in which case the
+    # executed program wouldn't match raw.txt; those trials run again on the final completion
+    for ind in sorted(streamed):
+        try:
+            changed = unwrap_results(results[ind], code_only=True) != unwrap_results(submitted[ind], code_only=True)
+        except Exception:
+            changed = False
+        if changed:
+            print(f"[WARNING] trial {ind}: streamed program differs from the final completion, running it again")
+            programs.pop(ind, None)
+            run_trial(ind, results[ind], len(results))
+
+    return [programs[ind] for ind in sorted(programs.keys())]
 
 
 ###################################################################################################
@@ -440,7 +567,7 @@ from helper import *
 
 
 def get_critic_prompt(
-    task: str, writer_code: str, image_path: Optional[str]
+    task: str, writer_code: str, image_path: Optional[Union[str, list[str]]]
 ) -> Union[str, list]:
     compilation_blurb = (
         "The current proposal cannot be properly executed and rendered! Analyze code errors in your review."
@@ -475,9 +602,12 @@ Provide your critiques and suggestions for improvement below in a formatted list
 """
     if image_path is None:
         return text
+    # several views are sent as one contact sheet, see `image_payload_utils`
+    image_paths = [image_path] if isinstance(image_path, str) else image_path
     return [
         {"type": "text", "text": text},
-        {"type": "image_url", "image_url": image_path},
+        *[{"type": "image_url", "image_url": path, **({"contact_sheet": True} if len(image_paths) > 1 else {})}
+          for path in image_paths],
     ]
 
 
@@ -523,13 +653,16 @@ def compile_raw_gpt_response_to_program(result: str):
     return "\n".join(lines)
 
 
-def find_rendering(save_dir: Path) -> Optional[str]:
+def find_rendering(save_dir: Path, num_views: int = CRITIC_VIEWS) -> Optional[Union[str, list[str]]]:
+    # the first frame, or the first `num_views` frames of its trajectory
     rendering_path = list(save_dir.glob("renderings/*/rendering_traj_000.png"))
     if len(rendering_path) == 0:
         print(f"[ERROR] no renderings found")
         return None
-    else:
+    elif num_views == 1:
         return rendering_path[0].as_posix()
+    else:
+        return [p.as_posix() for p in sorted(rendering_path[0].parent.glob("rendering_traj_*.png"))[:num_views]]
 
 
 def run_self_reflect_and_moe(
@@ -542,7 +675,7 @@ def run_self_reflect_and_moe(
     lm_config: Optional[dict] = None,
 ):
     assert (
-        LLM_PROVIDER == "claude"
+        LLM_PROVIDER in ["claude", "replay"]
     ), "self-reflect and MOE only works with Claude for now - need to update the other generate functions to skip the cache"
 
     save_dir = Path(save_dir)